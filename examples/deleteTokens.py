@@ -12,23 +12,22 @@ description:
 
 import sys
 
-import couchdb
 import picasconfig
+from picas.clients import CouchDB
 
 
 def deleteDocs(db, viewname="Monitor/error"):
-    v = db.view(viewname)
-    for x in v:
-        document = db[x['key']]
-        db.delete(document)
+    design_doc, view = viewname.split('/')
+    deleted = db.delete_from_view(view, design_doc=design_doc)
+    print("Number of deleted tokens: " + str(sum(deleted)))
 
 
 def get_db():
-    server = couchdb.Server(picasconfig.PICAS_HOST_URL)
-    username = picasconfig.PICAS_USERNAME
-    pwd = picasconfig.PICAS_PASSWORD
-    server.resource.credentials = (username, pwd)
-    db = server[picasconfig.PICAS_DATABASE]
+    db = CouchDB(
+        url=picasconfig.PICAS_HOST_URL,
+        db=picasconfig.PICAS_DATABASE,
+        username=picasconfig.PICAS_USERNAME,
+        password=picasconfig.PICAS_PASSWORD)
     return db
 
 
@@ -29,6 +29,7 @@ import subprocess
 import picasconfig
 from picas.clients import CouchDB
 from picas.documents import Task
+from picas.loaders import BulkLoader
 from create_tokens import create_tokens
 import argparse
 
@@ -77,5 +78,5 @@ if __name__ == '__main__':
     else:
         exit('Unknown example. Options are "quick", "fractals, or "autopilot".')
 
-    # save tokens in database
-    db.save_documents(tokens)
+    # save tokens in database, in concurrent chunks
+    BulkLoader(db).load_all(tokens)
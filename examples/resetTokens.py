@@ -13,16 +13,18 @@ description:
 
 import sys
 
-import couchdb
 from time import time
 import picasconfig
+from picas.clients import CouchDB
 
-def resetDocs(db, viewname="Monitor/locked", locktime=0):
-    v = db.view(viewname)
+
+def resetDocs(db, viewname="Monitor/locked", locktime=0, batch_size=1000):
+    design_doc, view = viewname.split('/')
     max_age = locktime * 3600
     to_update = []
-    for x in v:
-        document = db[x['key']]
+    n_reset = 0
+    # the view is fetched page by page, reset tokens are saved in batches
+    for document in db.iter_from_view(view, batch_size=batch_size, design_doc=design_doc):
         age = time() - document["lock"]
         print(age)
         if (age > max_age):
@@ -34,16 +36,20 @@ def resetDocs(db, viewname="Monitor/locked", locktime=0):
             if '_attachments' in document:
                 del document["_attachments"]
             to_update.append(document)
-    db.update(to_update)
-    print("Number of reset tokens: " + str(len(to_update)))
+        if len(to_update) == batch_size:
+            n_reset += sum(db.save_documents(to_update))
+            to_update = []
+    if to_update:
+        n_reset += sum(db.save_documents(to_update))
+    print("Number of reset tokens: " + str(n_reset))
 
 
 def get_db():
-    server = couchdb.Server(picasconfig.PICAS_HOST_URL)
-    username = picasconfig.PICAS_USERNAME
-    pwd = picasconfig.PICAS_PASSWORD
-    server.resource.credentials = (username, pwd)
-    db = server[picasconfig.PICAS_DATABASE]
+    db = CouchDB(
+        url=picasconfig.PICAS_HOST_URL,
+        db=picasconfig.PICAS_DATABASE,
+        username=picasconfig.PICAS_USERNAME,
+        password=picasconfig.PICAS_PASSWORD)
     return db
 
 
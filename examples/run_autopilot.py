@@ -13,15 +13,18 @@ Usage example:
 
 Description:
     - Connect to PiCaS server
-    - Check if there are tokens in the specified view (by default the SingleCore/todo view)
+    - Check if there are tokens in the specified view (by default the SingleCore/todo view); the
+      result is cached in a file for --cache-ttl seconds, so frequent cron runs do not query the server
     - If there are any tokens in that view, a pilot job is submitted slurm using the slurm_example.sh script
 """
 import argparse
+import os
 
 import picasconfig
 from picas.picaslogger import picaslogger
 from picas.clients import CouchDB
 from picas.executers import execute
+from picas.util import TTLCache
 
 
 picaslogger.propagate = False
@@ -40,6 +43,9 @@ def arg_parser():
     parser.add_argument("--view", default="todo", type=str, help="Select the view used by the actor class")
     parser.add_argument("-v", "--verbose", action="store_true", help="Set verbose")
     parser.add_argument("--cores", default=1, type=str, help="Number of cores for the job")
+    parser.add_argument("--cache-ttl", default=60., type=float, help="Seconds to reuse the result of a previous check")
+    parser.add_argument("--cache-file", default=os.path.expanduser("~/.cache/picas/autopilot.json"), type=str,
+                        help="File to cache the results of previous checks in")
 
     parser.set_defaults(design_doc="SingleCore")
 
@@ -56,7 +62,9 @@ client = CouchDB(
     password=picasconfig.PICAS_PASSWORD)
 
 # check if there is work available, i.e. if there are tokens in the specified view
-work_avail = client.is_view_nonempty(args.view, design_doc=args.design_doc)
+os.makedirs(os.path.dirname(args.cache_file), exist_ok=True)
+cache = TTLCache(ttl=args.cache_ttl, path=args.cache_file)
+work_avail = client.is_view_nonempty(args.view, cache=cache, design_doc=args.design_doc)
 if work_avail:
 
     picaslogger.info(
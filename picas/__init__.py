@@ -17,7 +17,7 @@ from .documents import Document, Task, Job, User
 from .clients import CouchDB
 from .iterators import (ViewIterator, TaskViewIterator, EndlessViewIterator,
                         PrioritizedViewIterator)
-from .actors import RunActor
+from .actors import RunActor, ParallelRunActor
 
 warnings.filterwarnings(
     "ignore",
@@ -32,6 +32,7 @@ __all__ = [
     'Document',
     'EndlessViewIterator',
     'Job',
+    'ParallelRunActor',
     'PrioritizedViewIterator',
     'RunActor',
     'Task',
@@ -5,13 +5,20 @@
 @author: Jan Bot, Joris Borgdorff
 """
 
+import os
+import queue
 import ssl
 import logging
 import signal
 import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from .util import Timer, time_elapsed
-from .iterators import TaskViewIterator, EndlessViewIterator
+from .iterators import TaskViewIterator, EndlessViewIterator, PrefetchIterator
+from .retry import RetryPolicy
 
 from couchdb.http import ResourceConflict
 from stopit import ThreadingTimeout
@@ -21,39 +28,183 @@ log = logging.getLogger(__name__)
 stopit_logger = logging.getLogger('stopit')
 stopit_logger.setLevel(logging.ERROR)
 
+# Seconds after which the parallel actor handles a signal at the latest
+SIGNAL_POLL_INTERVAL = 0.5
+
+
+def _flush_logs():
+    """Flush the handlers of all loggers, e.g. before the process exits without cleaning up."""
+    loggers = [logging.getLogger()] + list(logging.Logger.manager.loggerDict.values())
+    for logger in loggers:
+        for handler in getattr(logger, 'handlers', ()):
+            handler.flush()
+
+
+class _Committer:
+    """
+    Background thread that saves processed tasks, in the order in which they
+    were processed, in batches of up to batch_size tasks. Exceptions of the
+    save function are raised again in the actor at the next put or flush.
+    """
+
+    def __init__(self, save, queue_size, batch_size=1, interval=None):
+        """
+        @param save: function that saves a list of tasks
+        @param queue_size: maximum number of tasks waiting to be saved; put
+                           blocks while the queue is full.
+        @param batch_size: number of tasks that are saved together. Default: 1.
+        @param interval: maximum number of seconds that a task waits for its
+                         batch to fill up, or None to always wait for a full
+                         batch. Default: None.
+        """
+        self.save = save
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.error = None
+        self.thread = threading.Thread(target=self._commit_loop, name='picas-committer', daemon=True)
+        self.thread.start()
+
+    def _save_batch(self, batch):
+        try:
+            self.save(batch)
+        except Exception as ex:
+            self.error = ex
+
+    def _commit_loop(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None
+            if batch and self.interval is not None:
+                timeout = max(0., deadline - time.monotonic())
+            try:
+                task = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                # the oldest task waited interval seconds
+                self._save_batch(batch)
+                batch = []
+                continue
+
+            if task is None:
+                if batch:
+                    self._save_batch(batch)
+                return
+            if not batch and self.interval is not None:
+                deadline = time.monotonic() + self.interval
+            batch.append(task)
+            if len(batch) >= self.batch_size or (self.interval is not None and time.monotonic() >= deadline):
+                self._save_batch(batch)
+                batch = []
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, task):
+        self._raise_error()
+        self.queue.put(task)
+
+    def close(self):
+        """Wait until all tasks are saved and stop the thread."""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
 
 class AbstractRunActor(object):
     """
     Executor class to be overwritten in the client implementation.
     """
 
-    def __init__(self, db, iterator=None, view='todo', token_reset_values=[0, 0], **view_params):
+    def __init__(self, db, iterator=None, view='todo', token_reset_values=[0, 0], save_retry_policy=None,
+                 write_behind=0, commit_batch_size=1, commit_interval=None, prefetch=0, stage_ahead=0,
+                 staging_workers=None, **view_params):
         """
         @param database: the database to get the tasks from.
         @param token_reset_values: values to use in the token when PiCaS is terminated, defaults to values of 'todo' ([0,0])
+        @param save_retry_policy: RetryPolicy for saving processed tasks. Default: retry conflicts
+        and SSLEOFErrors 3 times, with jittered backoff between 0.1 and 5 seconds.
+        @param write_behind: save processed tasks in a background thread, so the next task can be
+        claimed and started at once, with at most this many tasks waiting to be saved. Default: 0,
+        to save each task before the next one is claimed.
+        @param commit_batch_size: save processed tasks in a background thread with a single bulk
+        request per this many tasks. Default: 1, to save tasks one by one.
+        @param commit_interval: maximum number of seconds that a processed task waits before its
+        batch is saved, even if the batch is not full. Default: None, to wait for a full batch.
+        @param prefetch: claim up to this many next tasks in a background thread while a task is
+        processed. Default: 0, to claim each task after the previous one is saved.
+        @param stage_ahead: call stage_inputs for up to this many claimed tasks on a thread pool
+        while the current task is processed; implies a prefetch of at least this many tasks.
+        Default: 0, to not call stage_inputs.
+        @param staging_workers: number of threads that stage inputs. Default: stage_ahead.
         """
         if db is None:
             raise ValueError("Database must be initialized")
         self.db = db
+        # client that saves processed tasks once it was reconnected on another thread than the
+        # one that claims them, see _reconnect_for_save; None to save through db
+        self._save_db = None
+        # thread of the run, which claims the tasks
+        self._claim_thread = None
         self.iterator = iterator
         self.token_reset_values = token_reset_values
+        if save_retry_policy is None:
+            save_retry_policy = RetryPolicy(max_attempts=3, base_delay=0.1, max_delay=5.,
+                                            retry_on=(ResourceConflict, ssl.SSLEOFError))
+        self.save_retry_policy = save_retry_policy
+        self.write_behind = write_behind
+        self.commit_batch_size = commit_batch_size
+        self.commit_interval = commit_interval
+        self._committer = None
+        self.stage_ahead = stage_ahead
+        self.staging_workers = staging_workers or stage_ahead
+        self._stager = None
+        # futures of the staged inputs, by task id
+        self._staging = {}
 
         # current task is needed to reset it when PiCaS is killed
         self.current_task = None
         # the subprocess running the token code is necessary s.t. the handler can cleanly kill it
         self.subprocess = None
         self.tasks_processed = 0
+        # reentrant, since the signal handler may interrupt the main thread while it holds the lock
+        self._lock = threading.RLock()
+        self._env_cleaned = False
 
         if iterator is None:
             self.iterator = TaskViewIterator(self.db, view, **view_params)
         else:
             self.iterator = iterator
+        if stage_ahead:
+            self.iterator = PrefetchIterator(self.iterator, self.db, depth=max(prefetch, stage_ahead),
+                                             on_claim=self._stage)
+        elif prefetch:
+            self.iterator = PrefetchIterator(self.iterator, self.db, depth=prefetch)
 
     def reconnect(self):
         self.db = self.db.copy()
         self.iterator.reconnect(self.db)
+        self._save_db = None
+
+    @property
+    def save_db(self):
+        """Client that saves processed tasks"""
+        return self._save_db if self._save_db is not None else self.db
+
+    def _reconnect_for_save(self):
+        """
+        Reconnect after a failed save. The committer thread and the slots of
+        ParallelRunActor only replace the client that saves tasks, as the run
+        may be claiming tasks through db at the same time.
+        """
+        if threading.current_thread() is self._claim_thread:
+            self.reconnect()
+        else:
+            self._save_db = self.save_db.copy()
 
-    def _run(self, task, timeout):
+    def _run(self, task, timeout, max_scrub=0):
         """
         Execution of the work on the iterator used in the run method.
         """
@@ -63,6 +214,7 @@ class AbstractRunActor(object):
 
         try:
             with ThreadingTimeout(timeout, swallow_exc=False) as context_manager:
+                self._wait_for_inputs(task)
                 self.process_task(task)
         except Exception as ex:
             msg = f"Exception {type(ex)} occurred during processing: {ex}"
@@ -73,36 +225,167 @@ class AbstractRunActor(object):
             msg = f"Token execution exceeded timeout limit of {timeout} seconds"
             log.info(msg)
 
+        # Scrub the token if it failed, scrubbing puts it back in 'todo' state
+        if max_scrub and (task['scrub_count'] < max_scrub) and (task['exit_code'] != 0):
+            log.info(f"Scrubbing token {task['_id']}")
+            task.scrub()
+
+        self._commit(task)
+
+        self.cleanup_run()
+        with self._lock:
+            self.tasks_processed += 1
+
+    def _timed_stage_inputs(self, task):
+        timer = Timer()
+        self.stage_inputs(task)
+        return timer.elapsed()
+
+    def _stage(self, task):
+        """Start staging the inputs of a claimed task on the staging thread pool."""
+        with self._lock:
+            if self._stager is None:
+                self._stager = ThreadPoolExecutor(max_workers=self.staging_workers, thread_name_prefix='picas-staging')
+            self._staging[task.id] = self._stager.submit(self._timed_stage_inputs, task)
+
+    def _wait_for_inputs(self, task):
+        """
+        Wait until the inputs of a task are staged, and record in the task how
+        long staging took and which fraction of that overlapped with earlier work.
+        """
+        if not self.stage_ahead:
+            return
+        with self._lock:
+            future = self._staging.pop(task.id, None)
+        timer = Timer()
+        if future is None:
+            staging_time = self._timed_stage_inputs(task)
+        else:
+            staging_time = future.result()
+        waited = timer.elapsed()
+        overlap = max(0., 1. - waited / staging_time) if staging_time > 0 else 1.
+        task['staging'] = {'time': staging_time, 'overlap': overlap}
+
+    def _stop_staging(self, wait=True):
+        """Cancel staging inputs of tasks that will not be processed."""
+        with self._lock:
+            stager, self._stager = self._stager, None
+            self._staging.clear()
+        if stager is not None:
+            stager.shutdown(wait=wait, cancel_futures=True)
+
+    def _commit(self, task):
+        """
+        Save a processed task, or hand it to the committer thread in
+        write-behind or batched commit mode.
+        """
+        batched = self.commit_batch_size > 1 or self.commit_interval is not None
+        if not self.write_behind and not batched:
+            self._save_task(task)
+            return
+        with self._lock:
+            if self._committer is None:
+                self._committer = _Committer(self._save_tasks, self.write_behind or self.commit_batch_size,
+                                             batch_size=self.commit_batch_size, interval=self.commit_interval)
+            committer = self._committer
+        committer.put(task)
+
+    def flush(self):
+        """
+        Wait until all processed tasks are saved. Raises the error of a task
+        that could not be saved in write-behind mode.
+        """
+        with self._lock:
+            committer, self._committer = self._committer, None
+        if committer is not None:
+            committer.close()
+
+    def _prepare_env(self):
+        self._claim_thread = threading.current_thread()
+        self._env_cleaned = False
+        self.prepare_env()
+
+    def _cleanup_env(self):
+        """Call cleanup_env once per run, also if the handler ends the run."""
+        if not self._env_cleaned:
+            self._env_cleaned = True
+            self.cleanup_env()
+
+    def _finish_run(self):
+        """Release tasks claimed in advance, save processed tasks and clean up the environment."""
+        self.iterator.release()
+        self._stop_staging()
+        try:
+            self.flush()
+        finally:
+            self._cleanup_env()
+
+    def _save_task(self, task):
+        """
+        Save a processed task, overwriting changes by others on conflicts.
+        """
+        def before_retry(ex, attempt, delay):
+            if isinstance(ex, ResourceConflict):
+                # simply overwrite changes - model results are more important
+                log.info(f"Warning: {type(ex)} occurred while saving task to database: "
+                         "Document exists with different revision or was deleted, overwriting it")
+                task['_rev'] = self.save_db.get(task.id).rev
+            else:
+                # SSLEOFError can occur for long-lived connections, re-establish connection
+                log.info(f"Warning: {type(ex)} occurred while saving task to database: "
+                         "Trying to reconnect to database")
+                self._reconnect_for_save()
+
         try:
-            self.db.save(task)
+            self.save_retry_policy.call(lambda: self.save_db.save(task), on_retry=before_retry)
         except ResourceConflict as ex:
-            # simply overwrite changes - model results are more important
             msg = f"Warning: {type(ex)} occurred while saving task to database: " + \
-                "Document exists with different revision or was deleted"
+                "Giving up on overwriting the document"
             log.info(msg)
-            new_task = self.db.get(task.id)
-            task['_rev'] = new_task.rev
-        except ssl.SSLEOFError as ex:
-            # SSLEOFError can occur for long-lived connections, re-establish connection
-            msg = f"Warning: {type(ex)} occurred while saving task to database: " + \
-                "Trying ro reconnect to database"
-            log.info(msg)
-            self.reconnect()
-            try:
-                self.db.save(task)
-            except Exception as ex:
-                msg = f"Error: {type(ex)} occurred while saving task to database: " + \
-                    "Not able to reconnect to database"
-                log.info(msg)
-                raise
         except Exception as ex:
             # re-raise unknown exception, this will terminate the iterator
             msg = f"Error: {type(ex)} occurred while saving task to database: {ex}"
             log.info(msg)
             raise
 
-        self.cleanup_run()
-        self.tasks_processed += 1
+    def _save_tasks(self, tasks):
+        """
+        Save processed tasks with a single bulk request. Tasks that conflict
+        are saved again with the current revision, overwriting changes by
+        others, as in _save_task.
+        """
+        if len(tasks) == 1:
+            self._save_task(tasks[0])
+            return
+
+        pending = list(tasks)
+
+        def save():
+            nonlocal pending
+            saved = self.save_db.save_documents(pending)
+            pending = [task for task, is_saved in zip(pending, saved) if not is_saved]
+            if pending:
+                raise ResourceConflict(f"{len(pending)} of {len(saved)} tasks were not saved")
+
+        def before_retry(ex, attempt, delay):
+            if isinstance(ex, ResourceConflict):
+                log.info(f"Warning: {len(pending)} tasks exist with a different revision or were deleted, overwriting them")
+                for task in pending:
+                    task['_rev'] = self.save_db.get(task.id).rev
+            else:
+                log.info(f"Warning: {type(ex)} occurred while saving tasks to database: "
+                         "Trying to reconnect to database")
+                self._reconnect_for_save()
+
+        try:
+            self.save_retry_policy.call(save, on_retry=before_retry)
+        except ResourceConflict as ex:
+            log.info(f"Warning: {type(ex)} occurred while saving tasks to database: "
+                     f"Giving up on overwriting {len(pending)} documents")
+        except Exception as ex:
+            # re-raise unknown exception, this will terminate the iterator
+            log.info(f"Error: {type(ex)} occurred while saving tasks to database: {ex}")
+            raise
 
     def run(self, max_token_time=None):
         """
@@ -114,13 +397,13 @@ class AbstractRunActor(object):
         self.setup_handler()
 
         self.time = Timer()
-        self.prepare_env()
+        self._prepare_env()
         try:
             for task in self.iterator:
                 self._run(task, timeout=max_token_time)
                 self.current_task = None  # set to None so the handler leaves the token alone when picas is killed
         finally:
-            self.cleanup_env()
+            self._finish_run()
 
     def handler(self, signum, frame):
         """
@@ -135,27 +418,49 @@ class AbstractRunActor(object):
         log.info(f'PiCaS shutting down, called with signal {signum}')
 
         # gracefully kill the process running token code, it needs to stop before we update the token state
-        if self.subprocess and self.subprocess.poll() is None:
-            log.info('Terminating execution of token')
-            self.subprocess.terminate()
-            try:
-                self.subprocess.communicate(timeout=30)  # wait 30 seconds for termination, value chosen to allow complex processes to stop
-            except subprocess.TimeoutExpired:
-                log.info('Killing subprocess')
-                self.subprocess.kill()
-                self.subprocess.communicate()
+        self._terminate_subprocess(self.subprocess)
+
+        # tasks that were processed are saved first, the current task is reset below
+        self._flush_in_handler()
 
         # update the token state, if reset vaue is None, do nothing.
         if self.current_task and self.token_reset_values is not None:
-            # scrub goes first, as it reset lock and done to defaults, which could be overwritten below
-            self.current_task.scrub()
-            self.current_task['lock'] = self.token_reset_values[0]
-            self.current_task['done'] = self.token_reset_values[1]
-            self.db.save(self.current_task)
+            self.db.save(self._reset_task(self.current_task))
+
+        # tasks that were claimed in advance but not started go back to 'todo'
+        self.iterator.release()
+        self._stop_staging(wait=False)
 
-        self.cleanup_env()
+        self._cleanup_env()
         exit(0)
 
+    def _flush_in_handler(self):
+        try:
+            self.flush()
+        except Exception as ex:
+            log.info(f"Error: {type(ex)} occurred while saving processed tasks: {ex}")
+
+    @staticmethod
+    def _terminate_subprocess(process):
+        """Terminate a running subprocess, and kill it if it does not stop within 30 seconds."""
+        if process and process.poll() is None:
+            log.info('Terminating execution of token')
+            process.terminate()
+            try:
+                process.communicate(timeout=30)  # wait 30 seconds for termination, value chosen to allow complex processes to stop
+            except subprocess.TimeoutExpired:
+                log.info('Killing subprocess')
+                process.kill()
+                process.communicate()
+
+    def _reset_task(self, task):
+        """Set the lock and done fields of an unfinished task to the token_reset_values."""
+        # scrub goes first, as it reset lock and done to defaults, which could be overwritten below
+        task.scrub()
+        task['lock'] = self.token_reset_values[0]
+        task['done'] = self.token_reset_values[1]
+        return task
+
     def setup_handler(self):
         """
         Method to set up the handler in the run method with lower redundancy
@@ -176,6 +481,14 @@ class AbstractRunActor(object):
         inputs.
         """
 
+    def stage_inputs(self, task):
+        """
+        Code to fetch the inputs of a task before it gets processed. Only used
+        with stage_ahead, which calls it on a separate thread for the next
+        claimed tasks while the current task is processed.
+        @param task: the task to stage the inputs of
+        """
+
     def process_task(self, task):
         """
         The function to override, which processes the tasks themselves.
@@ -199,6 +512,15 @@ class RunActor(AbstractRunActor):
     RunActor class with added stopping functionality.
     """
 
+    def _limit_total_time(self, timer, max_total_time):
+        """Break the while loop of the EndlessViewIterator if max_total_time is exceeded"""
+        iterator = self.iterator
+        if isinstance(iterator, PrefetchIterator):
+            iterator = iterator.iterator
+        if max_total_time is not None and isinstance(iterator, EndlessViewIterator):
+            iterator.stop_callback = time_elapsed
+            iterator.stop_callback_args = {"timer": timer, "max": max_total_time}
+
     def run(self, max_token_time=None, max_total_time=None, max_tasks=None, max_scrub=0,
             stop_function=None, **stop_function_args):
         """
@@ -215,28 +537,19 @@ class RunActor(AbstractRunActor):
         @param stop_function_args: kwargs to supply to stop_function
         """
         timer = Timer()
-        self.prepare_env()
+        self._prepare_env()
 
         # handler needs to be setup in overwritten method
         self.setup_handler()
 
-        # Break the while loop of the EndlessViewIterator if max_total_time is exceeded
-        if max_total_time is not None and isinstance(self.iterator, EndlessViewIterator):
-            self.iterator.stop_callback = time_elapsed
-            self.iterator.stop_callback_args = {"timer": timer, "max": max_total_time}
+        self._limit_total_time(timer, max_total_time)
 
         try:
             for task in self.iterator:
-                self._run(task, timeout=max_token_time)
+                self._run(task, timeout=max_token_time, max_scrub=max_scrub)
 
                 logging.debug("Tasks executed: ", self.tasks_processed)
 
-                # Scrub the token if it failed, scrubbing puts it back in 'todo' state
-                if (task['scrub_count'] < max_scrub) and (task['exit_code'] != 0):
-                    log.info(f"Scrubbing token {task['_id']}")
-                    task.scrub()
-                    self.db.save(task)
-
                 if (stop_function is not None and stop_function(**stop_function_args)):
                     break
 
@@ -250,4 +563,177 @@ class RunActor(AbstractRunActor):
 
                 self.current_task = None  # set to None so the handler leaves the token alone when picas is killed
         finally:
-            self.cleanup_env()
+            self._finish_run()
+
+
+class ParallelRunActor(RunActor):
+    """
+    RunActor that processes up to a number of tasks at the same time, each
+    in its own slot of a thread pool, so that one pilot job can use all
+    cores of a node. Tasks are claimed by a single claim stream, one task
+    whenever a slot is free.
+
+    process_task is called from several threads at once. Tasks that run an
+    external program, e.g. with execute, run it in a subprocess, which the
+    signal handler terminates.
+    """
+
+    def __init__(self, db, slots=None, **kwargs):
+        """
+        @param db: the database to get the tasks from.
+        @param slots: number of tasks to process at the same time. Default:
+                      the number of cores.
+        @param kwargs: arguments of RunActor, e.g. iterator or view.
+        """
+        # state of the slot of the current thread; must exist before RunActor sets current_task
+        self._slot = threading.local()
+        self._slots_lock = threading.RLock()
+        # thread id -> task or subprocess of each slot
+        self.current_tasks = {}
+        self.subprocesses = {}
+        self.stopping = False
+        # ids of the running tasks that the handler reset, whose results must not be saved
+        self._reset_ids = set()
+        self.slots = slots or os.cpu_count() or 1
+        super().__init__(db, **kwargs)
+
+    def _set_slot(self, name, registry, value):
+        setattr(self._slot, name, value)
+        with self._slots_lock:
+            if value is None:
+                registry.pop(threading.get_ident(), None)
+            else:
+                registry[threading.get_ident()] = value
+
+    @property
+    def current_task(self):
+        """Task that is processed in the slot of the current thread"""
+        return getattr(self._slot, 'task', None)
+
+    @current_task.setter
+    def current_task(self, task):
+        self._set_slot('task', self.current_tasks, task)
+
+    @property
+    def subprocess(self):
+        """Subprocess running in the slot of the current thread"""
+        return getattr(self._slot, 'subprocess', None)
+
+    @subprocess.setter
+    def subprocess(self, process):
+        self._set_slot('subprocess', self.subprocesses, process)
+
+    def _save_task(self, task):
+        if task.id in self._reset_ids:
+            # the handler has reset the task, which must not be overwritten
+            log.info(f"Not saving task {task.id}, PiCaS is shutting down")
+            return
+        super()._save_task(task)
+
+    def _save_tasks(self, tasks):
+        pending = [task for task in tasks if task.id not in self._reset_ids]
+        if len(pending) < len(tasks):
+            log.info(f"Not saving {len(tasks) - len(pending)} tasks, PiCaS is shutting down")
+        if pending:
+            super()._save_tasks(pending)
+
+    def _run_slot(self, task, timeout, max_scrub):
+        self._run(task, timeout=timeout, max_scrub=max_scrub)
+        self.current_task = None
+        self.subprocess = None
+
+    def _wait_for_slot(self, futures, n_free=1):
+        """Wait until at most slots - n_free tasks are running; re-raises errors of finished tasks."""
+        while futures and len(futures) > self.slots - n_free:
+            # wake up regularly: a signal delivered to a slot thread is only handled once
+            # the main thread runs Python code again
+            done, futures = wait(futures, timeout=SIGNAL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        return futures
+
+    def run(self, max_token_time=None, max_total_time=None, max_tasks=None, max_scrub=0,
+            stop_function=None, **stop_function_args):
+        """
+        Run method of the actor, processes the tasks in slots until the
+        iterator has no more tasks or a stop condition is met. Tasks that
+        are running when a stop condition is met are finished first.
+
+        @param max_token_time: maximum time to run a single token before stopping
+        @param max_total_time: maximum time to run picas before stopping
+        @param max_tasks: number of tasks that are claimed before stopping
+        @param max_scrub: number of times a token can be reset ('scrubbed') after failing
+        @param stop_function: custom function to stop the execution, must return bool
+        @param stop_function_args: kwargs to supply to stop_function
+        """
+        timer = Timer()
+        self._prepare_env()
+        self.setup_handler()
+
+        self._limit_total_time(timer, max_total_time)
+
+        claimed = 0
+        futures = set()
+        pool = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix='picas-slot')
+        try:
+            for task in self.iterator:
+                futures.add(pool.submit(self._run_slot, task, max_token_time, max_scrub))
+                claimed += 1
+
+                if (stop_function is not None and stop_function(**stop_function_args)):
+                    break
+                if max_tasks and claimed >= max_tasks:
+                    break
+                if max_total_time is not None and timer.elapsed() > max_total_time:
+                    break
+
+                # claim the next task only when a slot is free
+                futures = self._wait_for_slot(futures)
+            self._wait_for_slot(futures, n_free=self.slots)
+        finally:
+            # once the handler has reset the running tasks, they are not waited for
+            pool.shutdown(wait=not self.stopping, cancel_futures=self.stopping)
+            self._finish_run()
+
+    def handler(self, signum, frame):
+        """
+        Signal handler method. Terminates the subprocesses of all slots and
+        resets all tasks that are being processed to the token_reset_values,
+        with a single bulk save. The tasks that were processed are saved and
+        the logs are flushed, then the process exits at once, without waiting
+        for process_task calls that are still running in the slots; the
+        results of those tasks are not saved.
+
+        @param signum: signal to listen to and act upon
+        @param frame: stack frame, defaults to None, see https://docs.python.org/3/library/signal.html#signal.signal
+        """
+        log.info(f'PiCaS shutting down, called with signal {signum}')
+
+        # a slot sets its current task before it starts and commits it before it clears it, so
+        # each task is either reset here or was handed to the committer before
+        with self._slots_lock:
+            self.stopping = True
+            processes = list(self.subprocesses.values())
+            tasks = list(self.current_tasks.values())
+            self._reset_ids.update(task.id for task in tasks)
+
+        for process in processes:
+            self._terminate_subprocess(process)
+
+        if tasks and self.token_reset_values is not None:
+            saved = self.db.save_documents([self._reset_task(task) for task in tasks])
+            log.info(f"Reset {sum(saved)} of {len(tasks)} running tasks")
+
+        # tasks that were claimed in advance but not started go back to 'todo'
+        self.iterator.release()
+        self._stop_staging(wait=False)
+
+        # tasks that were processed are saved; the reset tasks are left alone
+        self._flush_in_handler()
+        self._cleanup_env()
+        # slots that run Python code are not interrupted, and the interpreter would wait
+        # for them before exiting: stop the process at once, their tasks are reset
+        _flush_logs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+@licence: The MIT License (MIT)
+
+asyncio client for the CouchDB back-end, for tools that need many
+concurrent requests, such as monitoring and pushing tokens.
+
+AsyncCouchDB has the same methods as picas.clients.CouchDB for getting,
+saving and deleting documents and reading views, as coroutines. Requests go
+over a small HTTP/1.1 keep-alive connection pool built on asyncio streams,
+with a bounded number of concurrent requests, so no extra dependencies are
+needed.
+"""
+
+import asyncio
+import base64
+import json
+import ssl
+from urllib.parse import quote, urlencode, urlsplit
+
+from couchdb.client import Row
+from couchdb.http import (Forbidden, PreconditionFailed, ResourceConflict,
+                          ResourceNotFound, ServerError, Unauthorized)
+
+from .documents import Document
+from .picaslogger import picaslogger
+
+
+def _doc_path(doc_id):
+    """URL path of a document, keeping the slash of design documents."""
+    if doc_id.startswith('_design/'):
+        return '_design/' + quote(doc_id[len('_design/'):], safe='')
+    return quote(doc_id, safe='')
+
+
+def _encode_view_options(options):
+    """Encode view options as JSON, like couchdb.client does."""
+    encoded = {}
+    for name, value in options.items():
+        if name in ('key', 'startkey', 'endkey') or not isinstance(value, str):
+            value = json.dumps(value)
+        encoded[name] = value
+    return encoded
+
+
+def _raise_for_status(status, data):
+    """Raise the couchdb.http exception that belongs to an error status."""
+    if isinstance(data, dict):
+        error = data.get('error'), data.get('reason')
+    else:
+        error = data
+    if status == 401:
+        raise Unauthorized(error)
+    if status == 403:
+        raise Forbidden(error)
+    if status == 404:
+        raise ResourceNotFound(error)
+    if status == 409:
+        raise ResourceConflict(error)
+    if status == 412:
+        raise PreconditionFailed(error)
+    raise ServerError((status, error))
+
+
+class AsyncTransport:
+    """
+    Minimal HTTP/1.1 client with a pool of keep-alive connections to a
+    single server, and at most max_concurrency requests in flight.
+    """
+
+    def __init__(self, url, credentials=None, ssl_verification=True, max_concurrency=10):
+        """
+        @param url: URL of the server, e.g. http://localhost:5984.
+        @param credentials: (username, password) tuple for basic
+                            authentication, or None.
+        @param ssl_verification: whether to verify the SSL certificate.
+        @param max_concurrency: maximum number of concurrent requests, and of
+                                open connections. Default: 10.
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.base_path = parts.path.rstrip('/')
+        self.ssl = None
+        if parts.scheme == 'https':
+            self.ssl = ssl.create_default_context()
+            if not ssl_verification:
+                self.ssl.check_hostname = False
+                self.ssl.verify_mode = ssl.CERT_NONE
+
+        self.headers = {
+            'Host': parts.netloc,
+            'Accept': 'application/json',
+            'User-Agent': 'PiCaS-asyncio',
+        }
+        if credentials is not None:
+            token = base64.b64encode(':'.join(credentials).encode()).decode()
+            self.headers['Authorization'] = 'Basic ' + token
+
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._idle = []
+
+    async def _connect(self):
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def _send(self, conn, method, path, body):
+        reader, writer = conn
+        headers = dict(self.headers)
+        headers['Content-Length'] = str(len(body))
+        if body:
+            headers['Content-Type'] = 'application/json'
+        head = f'{method} {path} HTTP/1.1\r\n'
+        head += ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by server')
+        status = int(status_line.split()[1])
+
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        keep_alive = response_headers.get('connection', '').lower() != 'close'
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            data = await reader.readexactly(int(response_headers['content-length']))
+        elif method == 'HEAD' or status in (204, 304):
+            data = b''
+        else:
+            data = await reader.read()
+            keep_alive = False
+
+        return status, response_headers, data, keep_alive
+
+    async def request(self, method, path, body=None, params=None):
+        """
+        Do a request and decode the JSON response.
+
+        @param method: HTTP method.
+        @param path: path relative to the server URL, without leading slash.
+        @param body: object to send as JSON body, or None.
+        @param params: dict of query string parameters, or None.
+        @return: tuple of status, response headers (lower case names) and the
+                 decoded JSON response body.
+        @throws: couchdb.http.HTTPError: for error responses.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        path = f'{self.base_path}/{path}'
+        if params:
+            path += '?' + urlencode(params)
+        payload = b'' if body is None else json.dumps(body).encode()
+
+        async with self._semaphore:
+            reused = bool(self._idle)
+            conn = self._idle.pop() if reused else await self._connect()
+            while True:
+                try:
+                    status, headers, data, keep_alive = await self._send(conn, method, path, payload)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    conn[1].close()
+                    if not reused:
+                        raise
+                    # the server closed the idle connection, retry on a new one
+                    reused = False
+                    conn = await self._connect()
+                except BaseException:
+                    conn[1].close()
+                    raise
+
+            if keep_alive:
+                self._idle.append(conn)
+            else:
+                conn[1].close()
+
+        if 'application/json' in headers.get('content-type', '') and data:
+            data = json.loads(data)
+        if status >= 400:
+            _raise_for_status(status, data)
+        return status, headers, data
+
+    async def close(self):
+        """Close all idle connections."""
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+class AsyncCouchDB:
+    """
+    asyncio client class to handle communication with the CouchDB back-end.
+
+    It mirrors the document and view methods of picas.clients.CouchDB as
+    coroutines. Independent requests, such as the pages of get_documents,
+    are sent concurrently, up to max_concurrency at a time.
+    """
+    def __init__(self,
+                 url: str = "http://localhost:5984",
+                 db: str = "test",
+                 username: str = None,
+                 password: str = "",
+                 ssl_verification: bool = True,
+                 max_concurrency: int = 10):
+        """
+        Create an AsyncCouchDB object. No connection is made until the first
+        request.
+
+        :param url: the location where the CouchDB instance is located,
+          including the port at which it's listening.
+          Default: http://localhost:5984
+        :param db: the database to use. Default: test.
+        :param username: the username to use for authentication. Default: None.
+        :param password: the password to use for authentication. Default: "".
+        :param ssl_verification: whether to verify the SSL certificate of the
+          server. Default: True.
+        :param max_concurrency: maximum number of concurrent requests.
+          Default: 10.
+        """
+        credentials = None if username is None else (username, password)
+        self.transport = AsyncTransport(url, credentials=credentials,
+                                        ssl_verification=ssl_verification,
+                                        max_concurrency=max_concurrency)
+        self.name = db
+        self.path = quote(db, safe='')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self) -> None:
+        """Close the connections to the server."""
+        await self.transport.close()
+
+    async def _request(self, method, path=None, body=None, **params):
+        full_path = self.path if path is None else f'{self.path}/{path}'
+        _, headers, data = await self.transport.request(method, full_path, body=body, params=params)
+        return data
+
+    async def get(self, id: str) -> Document:
+        """
+        Get raw data associated to the given ID
+
+        :param id: _id string of the task
+        """
+        try:
+            data = await self._request('GET', _doc_path(id))
+        except ResourceNotFound:
+            raise ValueError(id + " is not a document ID in the database")
+
+        return Document(data)
+
+    async def get_documents(self, ids: list[str], batch_size: int = 1000) -> list[Document]:
+        """
+        Get the Documents with the given IDs, with concurrent _all_docs
+        requests of batch_size IDs each.
+
+        Documents that do not exist (anymore) are left out of the result.
+
+        :param ids: _id strings of the documents
+        :param batch_size: number of documents to fetch per request.
+          Default: 1000.
+        :return: a list of Document objects, in the order of the given IDs
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be 1 or more")
+
+        pages = await asyncio.gather(*[
+            self._request('POST', '_all_docs', body={'keys': ids[i:i + batch_size]}, include_docs='true')
+            for i in range(0, len(ids), batch_size)])
+
+        return [Document(row['doc']) for page in pages for row in page['rows'] if row.get('doc')]
+
+    async def view(self, view: str, design_doc: str = "Monitor", **view_params) -> list[Row]:
+        """
+        Get the data from a view
+
+        :param view: name of the view
+        :param design_doc: name of the design document (default: Monitor)
+        :param view_params: the parameters that should be added to the view
+          request. Optional.
+        :return: list of the rows of the view.
+        """
+        path = f'_design/{quote(design_doc, safe="")}/_view/{quote(view, safe="")}'
+        body = None
+        if 'keys' in view_params:
+            body = {'keys': view_params.pop('keys')}
+        data = await self._request('GET' if body is None else 'POST', path, body=body,
+                                   **_encode_view_options(view_params))
+        return [Row(row) for row in data['rows']]
+
+    async def get_from_view(self, view: str, batch_size: int = 1000, **view_params) -> list[Document]:
+        """
+        Get Documents from the specified view that has task _id as key.
+
+        :param view: name of the view that has a row id coupled to a document
+        :param batch_size: number of documents to fetch per request.
+          Default: 1000.
+        :param view_params: name of the view optional extra parameters for the
+          view.
+        :return: a list of Task objects in the view
+        """
+        rows = await self.view(view, **view_params)
+        return await self.get_documents([row.id for row in rows], batch_size=batch_size)
+
+    async def save(self, doc: Document) -> Document:
+        """
+        Save a Document to the database.
+
+        Updates the document to have the new _rev value.
+
+        :param doc: Document object
+        :throws couchdb.http.ResourceConflict: when document exists with
+                different revision or was deleted.
+        """
+        if '_id' in doc:
+            data = await self._request('PUT', _doc_path(doc['_id']), body=doc.value)
+        else:
+            data = await self._request('POST', body=doc.value)
+        doc['_rev'], doc['_id'] = data['rev'], data['id']
+        return doc
+
+    async def _bulk_docs(self, docs, batch_size):
+        """Send docs through concurrent _bulk_docs requests, return the rows."""
+        if batch_size < 1:
+            raise ValueError("batch_size must be 1 or more")
+
+        pages = await asyncio.gather(*[
+            self._request('POST', '_bulk_docs', body={'docs': docs[i:i + batch_size]})
+            for i in range(0, len(docs), batch_size)])
+        return [row for page in pages for row in page]
+
+    async def save_documents(self, docs: list[Document], batch_size: int = 1000) -> list[bool]:
+        """
+        Save a sequence of Documents to the database, with concurrent
+        _bulk_docs requests of batch_size documents each.
+
+        - If the document was newly created and the _id is already is in the
+          database the document will not be added.
+        - If the document is an existing document, it will be updated if the
+          _rev key matches.
+
+        :param docs: [task1, task2, ...]; tasks for which the save was
+                succesful will get new _rev values
+        :param batch_size: number of documents to save per request.
+          Default: 1000.
+        :return: a sequence of [succeeded1, succeeded2, ...] values.
+        """
+        rows = await self._bulk_docs([doc.value for doc in docs], batch_size)
+
+        result = [False] * len(docs)
+        for i, row in enumerate(rows):
+            if 'error' not in row:
+                docs[i]['_id'], docs[i]['_rev'] = row['id'], row['rev']
+                result[i] = True
+
+        return result
+
+    async def delete_documents(self, docs: list[Document], batch_size: int = 1000) -> list[bool]:
+        """
+        Delete a sequence of Documents from the database.
+
+        The Documents must have a valid and current _id and _rev; Documents
+        without a _rev are logged and not deleted. They are deleted with
+        concurrent _bulk_docs requests of batch_size documents each.
+
+        :param docs: list of Document objects to be deleted
+        :param batch_size: number of documents to delete per request.
+          Default: 1000.
+        :return: array of booleans indicating whether the respective Document
+          was deleted.
+        """
+        stubs, indices = [], []
+        for i, doc in enumerate(docs):
+            try:
+                stubs.append({'_id': doc.id, '_rev': doc.rev, '_deleted': True})
+                indices.append(i)
+            except AttributeError as ex:
+                picaslogger.info(f"Could not delete document {str(doc)}: {str(ex)}")
+        rows = await self._bulk_docs(stubs, batch_size) if stubs else []
+
+        result = [False] * len(docs)
+        for i, row in zip(indices, rows):
+            doc = docs[i]
+            if 'error' in row:
+                picaslogger.info(f"Could not delete document {doc.id} (rev {doc.rev}): {row.get('reason')}")
+            result[i] = 'error' not in row
+
+        return result
+
+    async def doc_count(self) -> int:
+        """
+        Count number of documents in database
+
+        :return: int
+        """
+        data = await self._request('GET')
+        return data['doc_count']
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+@licence: The MIT License (MIT)
+
+Claim-throughput benchmarks for the iterators and actors.
+
+A benchmark fills a local backend (MemoryCouchDB or SQLiteCouchDB) with
+tokens and lets a number of simulated workers, each in its own thread with
+its own client, claim them until none are left. The latency of a round trip
+to a CouchDB server can be simulated by delaying every request. Results can
+be stored as baselines and later runs compared against them:
+
+    python -m picas.benchmark --workers 1 4 16 --baseline baselines.json --update-baseline
+    python -m picas.benchmark --workers 1 4 16 --baseline baselines.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from couchdb.http import ResourceConflict
+
+from .actors import RunActor
+from .documents import Task
+from .iterators import ViewIterator, TaskViewIterator, PrioritizedViewIterator
+from .memory_clients import MemoryCouchDB
+from .sqlite_clients import SQLiteCouchDB
+
+BACKENDS = ('memory', 'sqlite')
+MODES = ('iterator', 'prioritized', 'actor')
+
+# metrics that are compared against a baseline: True if higher is better
+METRICS = {
+    'claims_per_sec': True,
+    'saves_per_sec': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'conflicts_per_claim': False,
+}
+
+# absolute change that is accepted on top of the tolerance, so that small
+# latencies and conflict rates do not regress on noise
+SLACK = {
+    'p50_ms': 0.5,
+    'p99_ms': 2.,
+    'conflicts_per_claim': 0.01,
+}
+
+
+class BenchmarkStats:
+    """Counters shared by the workers of a benchmark."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.claimed = Counter()
+        self.conflicts = 0
+        self.saves = 0
+
+    def add_claim(self, task_id, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.claimed[task_id] += 1
+
+    def add_conflicts(self, n=1):
+        with self.lock:
+            self.conflicts += n
+
+    def add_saves(self, n=1):
+        with self.lock:
+            self.saves += n
+
+    @property
+    def duplicates(self):
+        """Number of tasks that were claimed more than once"""
+        return sum(count - 1 for count in self.claimed.values() if count > 1)
+
+
+class InstrumentedClient:
+    """
+    Client wrapper that counts conflicts and delays every request, to
+    simulate the round trip to a CouchDB server.
+    """
+
+    def __init__(self, client, stats, latency=0.):
+        """
+        @param client: client to forward the requests to
+        @param stats: BenchmarkStats to count conflicts in
+        @param latency: seconds to wait before each request. Default: 0.
+        """
+        self.client = client
+        self.stats = stats
+        self.latency = latency
+
+    def copy(self):
+        return InstrumentedClient(self.client.copy(), self.stats, self.latency)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def request(*args, **kwargs):
+            if self.latency:
+                time.sleep(self.latency)
+            try:
+                result = attr(*args, **kwargs)
+            except ResourceConflict:
+                self.stats.add_conflicts()
+                raise
+            if name == 'save_documents':
+                self.stats.add_conflicts(result.count(False))
+            return result
+        return request
+
+
+class TimedIterator(ViewIterator):
+    """Iterator that records the latency of every claim of another iterator."""
+
+    def __init__(self, iterator, stats):
+        """
+        @param iterator: ViewIterator to claim tasks from
+        @param stats: BenchmarkStats to record the claims in
+        """
+        super().__init__()
+        self.iterator = iterator
+        self.stats = stats
+
+    def __next__(self):
+        start = time.perf_counter()
+        task = next(self.iterator)
+        self.stats.add_claim(task.id, time.perf_counter() - start)
+        return task
+
+    def reconnect(self, database):
+        self.iterator.reconnect(database)
+
+    def release(self):
+        self.iterator.release()
+
+
+class _BenchmarkActor(RunActor):
+    """Actor that finishes every task immediately."""
+
+    def setup_handler(self):
+        # signal handlers can only be set up in the main thread
+        pass
+
+    def process_task(self, task):
+        task['exit_code'] = 0
+        task.done()
+
+
+def _priority(i):
+    """One in four tokens has a high priority"""
+    return int(i % 4 == 0)
+
+
+def _high_priority_view(doc):
+    if doc.get('type') == 'token' and doc.get('lock') == 0 and doc.get('done') == 0 and doc.get('priority'):
+        yield doc['_id'], doc['_id']
+
+
+def _low_priority_view(doc):
+    if doc.get('type') == 'token' and doc.get('lock') == 0 and doc.get('done') == 0 and not doc.get('priority'):
+        yield doc['_id'], doc['_id']
+
+
+def create_backend(backend, directory):
+    """
+    Create an empty client of the given backend, with the todo_high and
+    todo_low views of the prioritized benchmark.
+
+    @param backend: 'memory' or 'sqlite'
+    @param directory: directory for the database file of backends that need one
+    """
+    if backend == 'memory':
+        client = MemoryCouchDB()
+        client.add_view('todo_high', _high_priority_view)
+        client.add_view('todo_low', _low_priority_view)
+    elif backend == 'sqlite':
+        client = SQLiteCouchDB(os.path.join(directory, 'benchmark.db'))
+        todo = "type = 'token' AND lock = 0 AND done = 0"
+        client.add_view('todo_high', todo + " AND json_extract(body, '$.priority') = 1")
+        client.add_view('todo_low', todo + " AND json_extract(body, '$.priority') = 0")
+    else:
+        raise ValueError(f"Unknown backend {backend}, choose from {', '.join(BACKENDS)}")
+    return client
+
+
+def _iterator(mode, client, batch_size, buckets):
+    if mode == 'prioritized':
+        return PrioritizedViewIterator(client, 'todo_high', 'todo_low')
+    if buckets:
+        return TaskViewIterator(client, 'todo_bucketed', batch_size=batch_size, buckets=buckets)
+    return TaskViewIterator(client, 'todo', batch_size=batch_size)
+
+
+def _percentile(values, q):
+    """Nearest-rank percentile q (0-100) of values"""
+    if not values:
+        return 0.
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100. * len(ordered))) - 1))]
+
+
+def run_benchmark(backend='memory', mode='iterator', workers=4, tasks=1000, batch_size=1, latency=0.,
+                  buckets=None, write_behind=0, prefetch=0, commit_batch_size=1):
+    """
+    Let a number of simulated workers claim tokens until none are left.
+
+    @param backend: 'memory' or 'sqlite'. Default: 'memory'.
+    @param mode: 'iterator' to claim with a TaskViewIterator, 'prioritized'
+                 to claim with a PrioritizedViewIterator, or 'actor' to
+                 process and save the tasks with a RunActor. Default: 'iterator'.
+    @param workers: number of concurrent workers. Default: 4.
+    @param tasks: number of tokens to claim. Default: 1000.
+    @param batch_size: number of tasks claimed at once by the iterator.
+                       Default: 1.
+    @param latency: seconds that every request is delayed. Default: 0.
+    @param buckets: claim from a bucketed todo view with this number of
+                    buckets, except in the prioritized benchmark.
+                    Default: None.
+    @param write_behind: queue size of the write-behind saving of the
+                         actor benchmark. Default: 0, to save each task
+                         before the next one is claimed.
+    @param prefetch: number of tasks the actor benchmark claims ahead in
+                     a background thread. Default: 0.
+    @param commit_batch_size: number of tasks the actor benchmark saves
+                              with a single bulk request. Default: 1.
+    @return: dict with the parameters and the claims per second, p50 and
+             p99 claim latency in milliseconds, conflicts per claim, saves
+             per second and number of tasks claimed more than once.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}, choose from {', '.join(MODES)}")
+
+    stats = BenchmarkStats()
+    with tempfile.TemporaryDirectory() as directory:
+        client = create_backend(backend, directory)
+        if buckets:
+            client.add_bucketed_view(n_buckets=buckets)
+        client.save_documents([Task({'_id': f'token_{i:07d}', 'type': 'token', 'priority': _priority(i)})
+                               for i in range(tasks)])
+
+        barrier = threading.Barrier(workers + 1)
+
+        def work():
+            db = InstrumentedClient(client.copy(), stats, latency)
+            iterator = TimedIterator(_iterator(mode, db, batch_size, buckets), stats)
+            barrier.wait()
+            if mode == 'actor':
+                actor = _BenchmarkActor(db, iterator=iterator, write_behind=write_behind, prefetch=prefetch,
+                                        commit_batch_size=commit_batch_size)
+                actor.run()
+                stats.add_saves(actor.tasks_processed)
+            else:
+                for _ in iterator:
+                    pass
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if backend == 'sqlite':
+            client.close()
+
+    claims = len(stats.latencies)
+    return {
+        'backend': backend,
+        'mode': mode,
+        'workers': workers,
+        'tasks': tasks,
+        'batch_size': batch_size,
+        'latency': latency,
+        'buckets': buckets,
+        'write_behind': write_behind,
+        'prefetch': prefetch,
+        'commit_batch_size': commit_batch_size,
+        'claims': claims,
+        'elapsed': elapsed,
+        'claims_per_sec': claims / elapsed if elapsed else 0.,
+        'saves_per_sec': stats.saves / elapsed if elapsed else 0.,
+        'p50_ms': 1000. * _percentile(stats.latencies, 50),
+        'p99_ms': 1000. * _percentile(stats.latencies, 99),
+        'conflicts_per_claim': stats.conflicts / claims if claims else 0.,
+        'duplicates': stats.duplicates,
+    }
+
+
+def baseline_key(result):
+    """Key of a benchmark result in a baseline file"""
+    key = (f"{result['backend']}/{result['mode']}/workers={result['workers']}/"
+           f"batch_size={result['batch_size']}/latency={result['latency']}")
+    if result.get('buckets'):
+        key += f"/buckets={result['buckets']}"
+    if result.get('write_behind'):
+        key += f"/write_behind={result['write_behind']}"
+    if result.get('prefetch'):
+        key += f"/prefetch={result['prefetch']}"
+    if result.get('commit_batch_size', 1) > 1:
+        key += f"/commit_batch_size={result['commit_batch_size']}"
+    return key
+
+
+def load_baselines(path):
+    """Baselines stored in the JSON file at path, or an empty dict if there is none"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(path, results):
+    """Store the metrics of results as baselines in the JSON file at path, keeping other baselines."""
+    baselines = load_baselines(path)
+    for result in results:
+        baselines[baseline_key(result)] = {metric: result[metric] for metric in METRICS}
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(result, baseline, tolerance=0.5):
+    """
+    Compare a benchmark result against its baseline.
+
+    @param result: result of run_benchmark
+    @param baseline: dict with the baseline metrics
+    @param tolerance: relative change of a metric that is accepted, e.g.
+                      0.5 accepts up to half the claims per second of the
+                      baseline. Default: 0.5.
+    @return: list of messages, one for each metric that regressed, and one
+             if tasks were claimed more than once.
+    """
+    regressions = []
+    if result.get('duplicates'):
+        regressions.append(f"{result['duplicates']} tasks were claimed more than once")
+    for metric, higher_is_better in METRICS.items():
+        if metric not in baseline:
+            continue
+        value, reference = result[metric], baseline[metric]
+        if higher_is_better:
+            regressed = value < reference * (1. - tolerance)
+        else:
+            regressed = value > reference * (1. + tolerance) + SLACK.get(metric, 0.)
+        if regressed:
+            regressions.append(f"{metric} is {value:.3f}, baseline {reference:.3f}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the claim throughput of PiCaS iterators and actors")
+    parser.add_argument("--backend", nargs="+", choices=BACKENDS, default=["memory"],
+                        help="backends to benchmark")
+    parser.add_argument("--mode", nargs="+", choices=MODES, default=list(MODES),
+                        help="benchmarks to run")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 4],
+                        help="numbers of concurrent workers")
+    parser.add_argument("--tasks", type=int, default=2000, help="number of tokens per benchmark")
+    parser.add_argument("--batch-size", type=int, default=1, help="number of tasks claimed at once")
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="simulated round trip time of every request in seconds")
+    parser.add_argument("--buckets", type=int, default=None,
+                        help="claim from a bucketed todo view with this number of buckets")
+    parser.add_argument("--write-behind", type=int, default=0,
+                        help="queue size of write-behind saving in the actor benchmark")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="number of tasks claimed ahead in the actor benchmark")
+    parser.add_argument("--commit-batch-size", type=int, default=1,
+                        help="number of tasks saved with a single bulk request in the actor benchmark")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON file with baselines of this machine to compare against; "
+                             "missing baselines are stored in it")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="store the results in the baseline file instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="accepted relative change compared to the baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    print(f"{'benchmark':<72} {'claims/s':>10} {'saves/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'conflicts':>9}")
+    results = []
+    for backend in args.backend:
+        for mode in args.mode:
+            for workers in args.workers:
+                result = run_benchmark(backend, mode, workers, args.tasks, args.batch_size, args.latency,
+                                       args.buckets, args.write_behind, args.prefetch,
+                                       args.commit_batch_size)
+                results.append(result)
+                print(f"{baseline_key(result):<72} {result['claims_per_sec']:>10.1f} {result['saves_per_sec']:>10.1f} "
+                      f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['conflicts_per_claim']:>9.3f}")
+
+    if args.baseline is None:
+        return 0
+    if args.update_baseline:
+        save_baselines(args.baseline, results)
+        print(f"Baselines stored in {args.baseline}")
+        return 0
+
+    baselines = load_baselines(args.baseline)
+    missing = [result for result in results if baseline_key(result) not in baselines]
+    if missing:
+        # baselines depend on the machine, so the first run on a machine records them
+        save_baselines(args.baseline, missing)
+        print(f"Baselines of {len(missing)} benchmarks stored in {args.baseline}")
+    failed = False
+    for result in results:
+        key = baseline_key(result)
+        if key not in baselines:
+            continue
+        for regression in compare(result, baselines[key], args.tolerance):
+            failed = True
+            print(f"{key}: regression, {regression}")
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
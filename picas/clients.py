@@ -6,15 +6,127 @@
 @author: Joris Borgdorff
 """
 
+import json
+import mimetypes
+import os
 import random
-import sys
+import socket
+from typing import IO, Iterable, Iterator, Union
 
 import couchdb
 from couchdb.design import ViewDefinition
 from couchdb.http import ResourceConflict, ResourceNotFound
 
+from . import jobid
 from .documents import Document, Task
 from .picaslogger import picaslogger
+from .transport import PooledSession
+from .util import CHUNK_SIZE, TTLCache, seconds
+
+# View parameters that select a subset of the rows; total_rows ignores them
+ROW_FILTER_PARAMS = frozenset([
+    'key', 'keys', 'startkey', 'start_key', 'endkey', 'end_key', 'startkey_docid', 'start_key_doc_id',
+    'endkey_docid', 'end_key_doc_id', 'inclusive_end', 'skip', 'limit'])
+
+# Mango selector of the tokens in the 'todo' state
+TODO_SELECTOR = {'type': 'token', 'lock': 0, 'done': 0}
+
+# Update handler that locks a task on the server, if it is not locked yet.
+# The lock fields (lock, hostname and job ids) are sent as JSON request body.
+CLAIM_HANDLER_CODE = '''
+function(doc, req) {
+  if (!doc || doc.lock != 0) {
+    return [null, {code: 409, json: {error: "conflict", reason: "Task is not available to claim."}}];
+  }
+  var fields = JSON.parse(req.body);
+  for (var key in fields) {
+    doc[key] = fields[key];
+  }
+  return [doc, {json: doc}];
+}
+'''
+
+# Map function of the status view: emits the state of each token once, to be
+# counted with the builtin _count reduce.
+STATUS_VIEW_CODE = '''
+function(doc) {
+  if (doc.type == "token") {
+    if (doc.lock == 0 && doc.done == 0) {
+      emit("todo", null);
+    } else if (doc.lock > 0 && doc.done == 0) {
+      emit("locked", null);
+    } else if (doc.lock > 0 && doc.done > 0) {
+      emit(parseInt(doc.exit_code) == 0 ? "done" : "error", null);
+    }
+  }
+}
+'''
+STATUS_STATES = ('todo', 'locked', 'done', 'error')
+
+# Map function of the bucketed todo view: emits [bucket, _id] for each token
+# in the 'todo' state, where the bucket is a hash of the _id modulo the
+# number of buckets (formatted into the code as n_buckets). Must give the
+# same bucket as bucket_of.
+BUCKETED_TODO_VIEW_CODE = '''
+function(doc) {
+  if (doc.type == "token" && doc.lock == 0 && doc.done == 0) {
+    var hash = 0;
+    for (var i = 0; i < doc._id.length; i++) {
+      hash = (hash * 31 + doc._id.charCodeAt(i)) %% 4294967296;
+    }
+    emit([hash %% %(n_buckets)d, doc._id], doc._id);
+  }
+}
+'''
+
+
+def bucket_of(doc_id: str, n_buckets: int) -> int:
+    """
+    Bucket of a document in the bucketed todo view: the 32-bit hash
+    h = 31 * h + c over the UTF-16 code units of the _id, modulo n_buckets.
+    """
+    units = doc_id.encode('utf-16-be')
+    hash_value = 0
+    for i in range(0, len(units), 2):
+        hash_value = (hash_value * 31 + (units[i] << 8 | units[i + 1])) & 0xffffffff
+    return hash_value % n_buckets
+
+
+class _ChunkReader:
+    """
+    File-like wrapper around a file or an iterable of byte chunks, that
+    counts the bytes that are read. Seekable files can be rewound to send
+    them again.
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.start = content.tell() if hasattr(content, 'seekable') and content.seekable() else None
+        self._open()
+
+    def _open(self):
+        if hasattr(self.content, 'read'):
+            self.chunks = iter(lambda: self.content.read(CHUNK_SIZE), b'')
+        else:
+            self.chunks = iter(self.content)
+        self.length = 0
+
+    def rewind(self):
+        """Go back to the start of the content. Returns False if it cannot be read again."""
+        if self.start is None:
+            return False
+        self.content.seek(self.start)
+        self._open()
+        return True
+
+    def read(self, size=-1):
+        for chunk in self.chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                self.length += len(chunk)
+                return chunk
+        return b''
 
 
 class CouchDB:
@@ -27,7 +139,8 @@ class CouchDB:
                  username: str = None,
                  password: str = "",
                  ssl_verification: bool = True,
-                 create: bool = False):
+                 create: bool = False,
+                 session: couchdb.http.Session = None):
         """
         Create a CouchClient object.
 
@@ -40,20 +153,43 @@ class CouchDB:
         :param ssl_verification: whether to verify the SSL certificate of the
           server. Default: True.
         :param create: whether to create the database if it does not exist.
+        :param session: the HTTP session to connect with, which may be shared
+          with other clients. Default: a new PooledSession. With
+          ssl_verification=False the session must already skip verification:
+          a ValueError is raised rather than turning verification off for
+          every other client of the session.
         """
-        server = couchdb.Server(url)
+        if session is None:
+            session = PooledSession()
+            if not ssl_verification:
+                session.disable_ssl_verification()
+        elif not ssl_verification and not session._disable_ssl_verification:
+            raise ValueError("ssl_verification=False needs a session without SSL verification, "
+                             "the given session verifies certificates")
+        server = couchdb.Server(url, session=session)
         if username is not None:
             server.resource.credentials = (username, password)
-        if not ssl_verification:
-            server.resource.session.disable_ssl_verification()
 
         if create:
             self.db = server.create(db)
         else:
             self.db = server[db]
+        self._init_state()
+
+    def _init_state(self) -> None:
+        """Set up the client state that does not depend on the connection."""
+        # design documents in which the claim update handler was not found
+        self.missing_claim_handlers = set()
+        # recent results of status, set its ttl to change how long they are reused
+        self.status_cache = TTLCache(ttl=10.)
 
     def copy(self) -> "CouchDB":
-        """Copy the DB connection."""
+        """
+        Copy the DB connection.
+
+        The copy shares the HTTP session, and so the connection pool, with
+        this client.
+        """
         resource = self.db.resource
         try:
             username, password = resource.credentials
@@ -65,29 +201,64 @@ class CouchDB:
             db=self.db.name,
             username=username,
             password=password,
-            ssl_verification=resource.session._disable_ssl_verification)
+            ssl_verification=not resource.session._disable_ssl_verification,
+            session=resource.session)
 
     def __getitem__(self, idx: str) -> Document:
         return self.db[idx]
 
-    def get_from_view(self, view: str, **view_params) -> list[Document]:
+    def get_from_view(self, view: str, bulk: bool = True, batch_size: int = 1000,
+                      **view_params) -> list[Document]:
         """
         Get Documents from the specified view that has task _id as key.
 
         :param view: name of the view that has a row id coupled to a document
+        :param bulk: fetch the documents in pages through _all_docs instead of
+          with one request per document. Default: True.
+        :param batch_size: number of documents to fetch per request in bulk
+          mode. Default: 1000.
         :param view_params: name of the view optional extra parameters for the
           view.
         :return: a list of Task objects in the view
         """
+        ids = [row.id for row in self.view(view, **view_params)]
+        if bulk:
+            return self.get_documents(ids, batch_size=batch_size)
+
         result = []
-        for doc in self.view(view, **view_params):
+        for doc_id in ids:
             try:
-                result.append(self.get(doc.id))
+                result.append(self.get(doc_id))
             except ValueError:
                 pass  # doc was already deleted
 
         return result
 
+    def get_documents(self, ids: list[str], batch_size: int = 1000) -> list[Document]:
+        """
+        Get the Documents with the given IDs, using one _all_docs request per
+        batch of IDs.
+
+        Documents that do not exist (anymore) are left out of the result.
+
+        :param ids: _id strings of the documents
+        :param batch_size: number of documents to fetch per request.
+          Default: 1000.
+        :return: a list of Document objects, in the order of the given IDs
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be 1 or more")
+
+        result = []
+        for i in range(0, len(ids), batch_size):
+            rows = self.db.view('_all_docs', keys=ids[i:i + batch_size], include_docs=True)
+            for row in rows:
+                # missing or deleted documents have no doc in their row
+                if row.doc is not None:
+                    result.append(Document(row.doc))
+
+        return result
+
     def get(self, id: str) -> Document:
         """
         Get raw data associated to the given ID
@@ -100,6 +271,21 @@ class CouchDB:
 
         return Document(data)
 
+    def get_single_id_from_view(self, view: str, window_size: int = 1, **view_params) -> str:
+        """
+        Get the _id of a document from the specified view.
+
+        :param view: the view to get the document _id from.
+        :param view_params: the parameters that should be added to the view
+          request. Optional.
+        :param window_size: the size of the initial request to CouchDB, only
+          one record within that set, which is randomly selected, is returned.
+        :return: _id string of the document.
+        """
+        view = self.view(view, limit=window_size, **view_params)
+        row = random.choice(view.rows)
+        return row.id
+
     def get_single_from_view(self, view: str, window_size: int = 1, **view_params) -> Document:
         """
         Get a document from the specified view.
@@ -111,9 +297,61 @@ class CouchDB:
           one record within that set, which is randomly selected, is returned.
         :return: a CouchDB document.
         """
-        view = self.view(view, limit=window_size, **view_params)
-        row = random.choice(view.rows)
-        return self.get(row.id)
+        return self.get(self.get_single_id_from_view(view, window_size=window_size, **view_params))
+
+    def find(self, selector: dict, limit: int = 25, **query) -> list[Document]:
+        """
+        Get Documents that match a Mango selector, with a _find request.
+
+        :param selector: the Mango selector, e.g. {"type": "token", "lock": 0}
+        :param limit: maximum number of documents to return. Default: 25.
+        :param query: extra fields of the _find query, e.g. sort or use_index.
+        :return: a list of Document objects
+        """
+        mango = dict(query, selector=selector, limit=limit)
+        return [Document(doc) for doc in self.db.find(mango)]
+
+    def get_single_id_from_find(self, selector: dict, window_size: int = 1) -> str:
+        """
+        Get the _id of a document that matches a Mango selector, without
+        fetching the documents themselves.
+
+        :param selector: the Mango selector
+        :param window_size: the number of _ids to request from CouchDB, only
+          one of which, randomly selected, is returned.
+        :return: _id string of the document.
+        :raise: IndexError: if no document matches the selector.
+        """
+        return random.choice(self.find(selector, limit=window_size, fields=['_id'])).id
+
+    def get_single_from_find(self, selector: dict, window_size: int = 1) -> Document:
+        """
+        Get a document that matches a Mango selector.
+
+        :param selector: the Mango selector
+        :param window_size: the size of the initial request to CouchDB, only
+          one record within that set, which is randomly selected, is returned.
+        :return: a CouchDB document.
+        :raise: IndexError: if no document matches the selector.
+        """
+        return random.choice(self.find(selector, limit=window_size))
+
+    def add_index(self, fields: list[str], design_doc: str = "picas", name: str = None) -> None:
+        """
+        Add a JSON index for Mango queries to the database, unless an index on
+        the same fields already exists.
+
+        :param fields: names of the fields to index, in order
+        :param design_doc: name of the design document for a new index
+          (default: picas)
+        :param name: name of a new index. Default: generated by CouchDB.
+        :return: None
+        """
+        wanted = [{field: 'asc'} for field in fields]
+        indexes = self.db.index()
+        if any(index['def']['fields'] == wanted for index in indexes):
+            return
+        indexes[design_doc, name] = list(fields)
 
     def view(self, view: str, design_doc: str = "Monitor", **view_params) -> couchdb.client.View:
         """
@@ -126,6 +364,55 @@ class CouchDB:
         """
         return self.db.view(design_doc + '/' + view, **view_params)
 
+    def iter_view(self, view: str, batch_size: int = 1000, design_doc: str = "Monitor",
+                  **view_params) -> Iterator[couchdb.client.Row]:
+        """
+        Iterate over the rows of a view, fetching them in pages.
+
+        The pages are requested with startkey/startkey_docid continuation, so
+        only one page of rows is kept in memory regardless of the size of the
+        view. Rows that change while iterating may be missed or repeated, but
+        the rows that were already yielded may be modified or deleted safely.
+
+        :param view: name of the view
+        :param batch_size: number of rows to fetch per request. Default: 1000.
+        :param design_doc: name of the design document (default: Monitor)
+        :param view_params: the parameters that should be added to the view
+          request, except limit. Optional.
+        :return: generator of view rows.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be 1 or more")
+
+        while True:
+            # one extra row is fetched to continue the next page from
+            rows = self.view(view, design_doc=design_doc, limit=batch_size + 1, **view_params).rows
+            yield from rows[:batch_size]
+
+            if len(rows) <= batch_size:
+                return
+
+            next_row = rows[batch_size]
+            view_params.update(startkey=next_row.key, startkey_docid=next_row.id, skip=0)
+
+    def iter_from_view(self, view: str, batch_size: int = 1000, **view_params) -> Iterator[Document]:
+        """
+        Iterate over the Documents in a view, fetching them in pages.
+
+        Like get_from_view, but the documents are included in the paginated
+        view requests of iter_view instead of being loaded into a list.
+
+        :param view: name of the view that has a row id coupled to a document
+        :param batch_size: number of documents to fetch per request.
+          Default: 1000.
+        :param view_params: the parameters that should be added to the view
+          request. Optional.
+        :return: generator of Document objects in the view
+        """
+        for row in self.iter_view(view, batch_size=batch_size, include_docs=True, **view_params):
+            if row.doc is not None:
+                yield Document(row.doc)
+
     def save(self, doc: Document) -> Document:
         """
         Save a Document to the database.
@@ -164,6 +451,78 @@ class CouchDB:
 
         return result
 
+    def put_attachment(self, doc: Document, name: str,
+                       content: Union[str, os.PathLike, IO[bytes], Iterable[bytes]],
+                       content_type: str = None) -> Document:
+        """
+        Upload an attachment to a saved document, streaming it in chunks to
+        the attachment endpoint instead of embedding it in the document.
+
+        The memory use does not depend on the size of the attachment. The
+        document gets the new _rev and the stub of the attachment as stored by
+        the server, so it can be saved again without sending the attachment
+        along. The attachment is sent on a new connection; after a connection
+        error, a file is sent once more, an iterable of chunks is not, since
+        it cannot be read twice.
+
+        :param doc: Document with an _rev
+        :param name: name of the attachment
+        :param content: path of a file, a binary file object, or an iterable
+          of bytes chunks
+        :param content_type: mimetype of the attachment. Default: guessed from
+          name, or text/plain.
+        :return: the updated document
+        :throws couchdb.http.ResourceConflict: when the _rev of doc is not
+                the latest revision.
+        :throws IOError: when the server stored a different number of bytes
+                than were sent.
+        """
+        if content_type is None:
+            content_type = mimetypes.guess_type(name)[0] or 'text/plain'
+
+        if isinstance(content, (str, os.PathLike)):
+            with open(content, 'rb') as fobj:
+                return self.put_attachment(doc, name, fobj, content_type=content_type)
+
+        reader = _ChunkReader(content)
+        database = self._attachment_database()
+        retried = False
+        while True:
+            try:
+                database.put_attachment(doc.value, reader, filename=name, content_type=content_type)
+                break
+            except socket.error as exc:
+                # the connection broke while sending: send the content again
+                # on a new connection, if it can be read again
+                if (retried or not exc.args or exc.args[0] not in couchdb.http.RETRYABLE_ERRORS or
+                        not reader.rewind()):
+                    raise
+                retried = True
+                picaslogger.info(f"Connection error {exc} while uploading attachment {name} of {doc.id}, retrying")
+
+        stored = self.db.get(doc.id, rev=doc.rev)
+        stub = dict(stored['_attachments'][name])
+        if stub.get('length') != reader.length:
+            raise IOError(f"Attachment {name} of {doc.id} was stored with {stub.get('length')} "
+                          f"of {reader.length} bytes")
+        doc.value.setdefault('_attachments', {})[name] = stub
+        return doc
+
+    def _attachment_database(self):
+        """
+        Database on a separate HTTP session without retries, to upload
+        attachments with. The session of the client retries requests on
+        connection errors by sending the body again, which would send a
+        stream that was already read.
+        """
+        resource = self.db.resource
+        session = PooledSession(timeout=resource.session._timeout, max_connections=0, retryable_errors=frozenset())
+        if resource.session._disable_ssl_verification:
+            session.disable_ssl_verification()
+        database = couchdb.Database(resource.url, session=session)
+        database.resource.credentials = resource.credentials
+        return database
+
     def add_view(self,
                  view: str,
                  map_fun: str,
@@ -188,6 +547,68 @@ class CouchDB:
             design_doc, view, map_fun, reduce_fun, *args, **kwargs)
         definition.sync(self.db)
 
+    def add_update_handler(self, name: str, func: str, design_doc: str = "Monitor") -> None:
+        """
+        Add an update handler to a design document in the database.
+
+        The design document is created if it does not exist. Update handlers
+        are not part of the view index, so adding one does not trigger a
+        rebuild of the views in the design document.
+
+        :param name: name of the update handler
+        :param func: string of the javascript update function
+        :param design_doc: name of the design document (default: Monitor)
+        :return: None
+        """
+        doc_id = '_design/' + design_doc
+        ddoc = self.db.get(doc_id)
+        if ddoc is None:
+            ddoc = {'_id': doc_id, 'language': 'javascript'}
+
+        if ddoc.get('updates', {}).get(name) != func:
+            ddoc.setdefault('updates', {})[name] = func
+            self.db.save(ddoc)
+        self.missing_claim_handlers.discard(design_doc)
+
+    def add_claim_handler(self, design_doc: str = "Monitor") -> None:
+        """
+        Add the update handler used by claim to a design document.
+
+        :param design_doc: name of the design document (default: Monitor)
+        :return: None
+        """
+        self.add_update_handler('claim', CLAIM_HANDLER_CODE, design_doc=design_doc)
+
+    def claim(self, id: str, design_doc: str = "Monitor") -> Task:
+        """
+        Lock a task with a single request, through the claim update handler.
+
+        The lock is done on the server, and only if the task is not locked
+        yet, so the task does not need to be retrieved first.
+
+        :param id: _id string of the task
+        :param design_doc: name of the design document with the claim update
+          handler, see add_claim_handler (default: Monitor)
+        :return: the locked Task
+        :raise: ResourceConflict: if the task was already locked or deleted
+        :raise: ResourceNotFound: if the design document has no claim handler;
+          this is remembered, so later calls fail without a request.
+        """
+        if design_doc in self.missing_claim_handlers:
+            raise ResourceNotFound(("not_found", f"missing update function claim on design doc {design_doc}"))
+
+        fields = {'lock': seconds(), 'hostname': socket.gethostname()}
+        jobid.add_job_id(fields)
+        try:
+            headers, body = self.db.update_doc(design_doc + '/claim', id, body=fields)
+        except ResourceNotFound:
+            self.missing_claim_handlers.add(design_doc)
+            raise
+
+        task = Task(json.loads(body.read()))
+        task['_rev'] = headers['X-Couch-Update-NewRev']
+        return task
+
     def delete(self, doc: Document) -> None:
         """
         Delete a Document from the database
@@ -200,43 +621,79 @@ class CouchDB:
         """
         self.db.delete(doc.value)
 
-    def delete_documents(self, docs: list[Document]) -> list[bool]:
+    def delete_documents(self, docs: list[Document], batch_size: int = 1000) -> list[bool]:
         """
         Delete a sequence of Documents from the database.
 
         The Documents must have a valid and current _id and _rev, so they must
         be retrieved from the database and not be altered there in the mean
-        time.
+        time. They are deleted with one _bulk_docs request per batch, and the
+        progress is logged after every batch.
 
         :param tasks: list of Document objects to be deleted
+        :param batch_size: number of documents to delete per request.
+          Default: 1000.
         :return: array of booleans indicating whether the respective Document
           was deleted.
         """
-        result = [True] * len(docs)
-        for i, doc in enumerate(docs):
-            try:
-                self.delete(doc)
-            except ResourceConflict as ex:
-                picaslogger.info(
-                    f"Could not delete document {doc.id} (rev {doc.rev}) due to resource conflict: {str(ex)}",
-                    file=sys.stderr)
-                result[i] = False
-            except Exception as ex:
-                picaslogger.info(f"Could not delete document {str(doc)}: {str(ex)}", file=sys.stderr)
-                result[i] = False
+        if batch_size < 1:
+            raise ValueError("batch_size must be 1 or more")
+
+        result = []
+        for i in range(0, len(docs), batch_size):
+            batch = docs[i:i + batch_size]
+            batch_result = [False] * len(batch)
+            stubs, indices = [], []
+            for j, doc in enumerate(batch):
+                try:
+                    stubs.append({'_id': doc.id, '_rev': doc.rev, '_deleted': True})
+                    indices.append(j)
+                except AttributeError as ex:
+                    picaslogger.info(f"Could not delete document {str(doc)}: {str(ex)}")
+
+            updated = self.db.update(stubs) if stubs else []
+            for j, (is_deleted, _, rev_or_exc) in zip(indices, updated):
+                doc = batch[j]
+                if isinstance(rev_or_exc, ResourceConflict):
+                    picaslogger.info(
+                        f"Could not delete document {doc.id} (rev {doc.rev}) due to resource conflict: {str(rev_or_exc)}")
+                elif not is_deleted:
+                    picaslogger.info(f"Could not delete document {str(doc)}: {str(rev_or_exc)}")
+                batch_result[j] = is_deleted
+            result.extend(batch_result)
+
+            picaslogger.info(f"Deleted {sum(result)} of {len(docs)} documents, "
+                             f"{len(result) - sum(result)} failed")
 
         return result
 
-    def delete_from_view(self, view: str, design_doc: str = "Monitor") -> list[bool]:
+    def delete_from_view(self, view: str, design_doc: str = "Monitor",
+                         batch_size: int = 1000) -> list[bool]:
         """
         Delete all documents in a view
 
+        The view is walked page by page with iter_from_view, and every page is
+        deleted before the next one is fetched.
+
         :param view: name of the view from which to delete all documents
+        :param design_doc: name of the design document (default: Monitor)
+        :param batch_size: number of documents to fetch and delete per page.
+          Default: 1000.
         :return: array of booleans indicating whether the respective tasks
           were deleted
         """
-        docs = self.get_from_view(view, design_doc=design_doc)
-        return self.delete_documents(docs)
+        result = []
+        page = []
+        for doc in self.iter_from_view(view, batch_size=batch_size, design_doc=design_doc):
+            page.append(doc)
+            if len(page) == batch_size:
+                result.extend(self.delete_documents(page))
+                page = []
+
+        if page:
+            result.extend(self.delete_documents(page))
+
+        return result
 
     def set_users(self,
                   admins: list[str] = None,
@@ -252,7 +709,7 @@ class CouchDB:
         :param member_roles: list of member roles
         :return: None
         """
-        security = self.db.resource.get_json("_security")[2]
+        security = self._get_security()
 
         def try_set(value, doc, key, subkey):
             if value is not None:
@@ -266,9 +723,66 @@ class CouchDB:
         try_set(admin_roles, security, 'admins', 'roles')
         try_set(member_roles, security, 'members', 'roles')
 
+        self._put_security(security)
+
+    def _get_security(self) -> dict:
+        """The _security document of the database."""
+        return self.db.resource.get_json("_security")[2]
+
+    def _put_security(self, security: dict) -> None:
+        """Replace the _security document of the database."""
         self.db.resource.put("_security", security)
 
-    def is_view_nonempty(self, view: str, **view_params) -> bool:
+    def probe_view(self, view: str, design_doc: str = "Monitor", cache: TTLCache = None,
+                   count_selected: bool = False, **view_params) -> int:
+        """
+        Count the rows of a view with a single request of one row, without
+        document bodies.
+
+        The count is the total_rows of the view, which covers the whole view:
+        view_params that select a subset of the rows, such as a key range,
+        are rejected unless count_selected is set. The rows of views with a
+        reduce function are counted before they are reduced.
+
+        :param view: name of the view
+        :param design_doc: name of the design document. Default: Monitor.
+        :param cache: optional TTLCache to reuse recent results from, so
+          repeated probes within its ttl do not query the server.
+        :param count_selected: fetch and count all rows selected by
+          view_params instead, which is as expensive as the rows are many.
+          Default: False.
+        :param view_params: optional parameters for the view
+        :return: the number of (selected) rows in the view, 0 if it is empty
+        :raise: ValueError: if view_params select rows and count_selected is
+          not set.
+        """
+        selecting = ROW_FILTER_PARAMS.intersection(view_params)
+        if selecting and not count_selected:
+            raise ValueError(f"total_rows of view {view} ignores {', '.join(sorted(selecting))}; "
+                             "set count_selected to count the selected rows")
+
+        key = json.dumps([self.db.name, design_doc, view, view_params], sort_keys=True)
+        if cache is not None:
+            n_rows = cache.get(key)
+            if n_rows is not None:
+                return n_rows
+
+        view_params.pop('include_docs', None)
+        # reduced rows have no total_rows, so count the rows of the map
+        view_params.setdefault('reduce', False)
+        if selecting:
+            n_rows = len(self.view(view, design_doc=design_doc, **view_params).rows)
+        else:
+            result = self.view(view, design_doc=design_doc, limit=1, **view_params)
+            if result.rows and result.total_rows is None:
+                raise ValueError(f"View {view} returned reduced rows, which can not be counted")
+            n_rows = result.total_rows if result.rows else 0
+
+        if cache is not None:
+            cache.put(key, n_rows)
+        return n_rows
+
+    def is_view_nonempty(self, view: str, cache: TTLCache = None, **view_params) -> bool:
         """
         Database view scanner
 
@@ -276,6 +790,7 @@ class CouchDB:
         returns true: a pilot can be started.
 
         :param view: database view to scan for tokens
+        :param cache: optional TTLCache of recent probe results
         :param view_params: optional parameters for the view
         :return: bool
         """
@@ -283,20 +798,114 @@ class CouchDB:
         # the variable is created as the default used in self.view. Otherwise the
         # f-string below breaks on default input.
         design_doc = view_params.setdefault('design_doc', "Monitor")
+        selecting = bool(ROW_FILTER_PARAMS.intersection(view_params))
         try:
-            doc = self.get_single_from_view(view, **view_params)
-            task = Task(doc)
-            picaslogger.debug(doc)
-            picaslogger.debug(task['_id'])
-            picaslogger.info(f"View {view} under design document {design_doc} is non-empty.")
-            return True
-        except IndexError as exc:
-            picaslogger.info(f"View {view} under design document {design_doc} is empty: {exc}")
-            return False
+            if selecting:
+                # total_rows ignores the selection, so only look for its first row
+                n_rows = self.probe_view(view, cache=cache, count_selected=True, **dict(view_params, limit=1))
+            else:
+                n_rows = self.probe_view(view, cache=cache, **view_params)
         except ResourceNotFound:
             picaslogger.info(f"Non-existing view and design document passed: {view} in {design_doc}")
             return False
 
+        if n_rows:
+            picaslogger.info(f"View {view} under design document {design_doc} is non-empty"
+                             f"{'' if selecting else f': {n_rows} rows'}.")
+            return True
+        picaslogger.info(f"View {view} under design document {design_doc} is empty.")
+        return False
+
+    def add_status_view(self, design_doc: str = "Status") -> None:
+        """
+        Add the view used by status to the database.
+
+        The view has its own design document, so that adding it does not
+        rebuild the indexes of the views in Monitor.
+
+        :param design_doc: name of the design document (default: Status)
+        :return: None
+        """
+        self.add_view('status', STATUS_VIEW_CODE, reduce_fun='_count', design_doc=design_doc)
+
+    def add_bucketed_view(self, view: str = "todo_bucketed", n_buckets: int = 16,
+                          design_doc: str = "Monitor") -> None:
+        """
+        Add a view of the tokens in the 'todo' state with [bucket, _id] keys,
+        where the bucket is a hash of the _id (see bucket_of).
+
+        Iterators that start reading this view at different buckets claim
+        from different parts of it, instead of all from its first rows. Pass
+        n_buckets to the iterator as well, e.g.
+        TaskViewIterator(db, "todo_bucketed", buckets=16).
+
+        :param view: name of the view (default: todo_bucketed)
+        :param n_buckets: number of buckets, e.g. about the number of
+          concurrent workers (default: 16)
+        :param design_doc: name of the design document (default: Monitor)
+        :return: None
+        """
+        if n_buckets < 1:
+            raise ValueError("n_buckets must be at least 1")
+        self.add_view(view, BUCKETED_TODO_VIEW_CODE % {'n_buckets': n_buckets}, design_doc=design_doc)
+
+    def status(self, design_doc: str = "Status", cache: TTLCache = None) -> dict[str, int]:
+        """
+        Count the tokens per state with a single request to a view with the
+        builtin _count reduce. The view is added if it does not exist.
+
+        :param design_doc: name of the design document of the view
+          (default: Status)
+        :param cache: TTLCache to reuse recent counts from, so frequent
+          polling does not query the server. Default: self.status_cache,
+          which reuses counts for 10 seconds.
+        :return: dict with the number of todo, locked, done and error tokens
+        """
+        if cache is None:
+            cache = self.status_cache
+        key = json.dumps([self.db.name, design_doc])
+        counts = cache.get(key)
+        if counts is not None:
+            # a copy, so callers can not change the cached counts
+            return dict(counts)
+
+        try:
+            rows = self.view('status', design_doc=design_doc, group=True).rows
+        except ResourceNotFound:
+            picaslogger.info(f"Adding the status view to design document {design_doc}")
+            self.add_status_view(design_doc=design_doc)
+            rows = self.view('status', design_doc=design_doc, group=True).rows
+
+        counts = dict.fromkeys(STATUS_STATES, 0)
+        counts.update((row.key, row.value) for row in rows)
+        cache.put(key, counts)
+        return dict(counts)
+
+    def update_seq(self) -> str:
+        """
+        Get the current update sequence of the database
+
+        :return: sequence, to pass as since to wait_for_changes
+        """
+        return self.db.info()['update_seq']
+
+    def wait_for_changes(self, since: str, selector: dict = None, timeout: float = 60.) -> tuple[bool, str]:
+        """
+        Block on the _changes feed (longpoll) until a document changes.
+
+        :param since: update sequence to wait for changes after
+        :param selector: Mango selector: only wait for documents that match
+          it, e.g. TODO_SELECTOR. Default: None, wait for any document.
+        :param timeout: maximum number of seconds to wait
+        :return: tuple of whether a document changed and the update sequence
+          to wait from next time.
+        """
+        params = {'feed': 'longpoll', 'since': since, 'limit': 1, 'timeout': int(timeout * 1000)}
+        if selector is not None:
+            params.update(filter='_selector', _selector={'selector': selector})
+        changes = self.db.changes(**params)
+        return bool(changes['results']), changes['last_seq']
+
     def doc_count(self) -> int:
         """
         Count number of documents in database
@@ -15,6 +15,8 @@ import time
 # CouchDB imports
 from couchdb import Server
 
+from .retry import RetryPolicy
+
 
 class CouchDBLogger(logging.Handler):
 
@@ -22,13 +24,19 @@ class CouchDBLogger(logging.Handler):
      format.
     """
 
-    def __init__(self, url, db):
+    def __init__(self, url, db, retry_policy=None):
         """Initiation function.
         :param url: the url including the port on which the database
          is located.
         :param db: the name of the database.
+        :param retry_policy: RetryPolicy for writing messages. Default: 10
+         attempts, with jittered backoff between 0.5 and 5 seconds, giving up
+         after 5 seconds so logging never blocks for long.
         """
         logging.Handler.__init__(self)
+        if retry_policy is None:
+            retry_policy = RetryPolicy(max_attempts=10, base_delay=0.5, max_delay=5., max_elapsed=5.)
+        self.retry_policy = retry_policy
         self.server = Server(url=url)
         self.db = self.server[db]
         self.hostname = socket.gethostname()
@@ -50,18 +58,18 @@ class CouchDBLogger(logging.Handler):
             'type': 'log'
         }
 
-        count = 0
-        done = False
-        while (count < 10 and not done):
-            try:
-                id = self.hostname + ":" + str(int(time.time()))
-                self.db[id] = log_dict
-                done = True
-            except Exception as e:
-                print(e)
-                print(log_dict)
-                count += 1
-                time.sleep(0.5)
+        def write():
+            id = self.hostname + ":" + str(int(time.time()))
+            self.db[id] = log_dict
+
+        def report(e, attempt, delay):
+            print(e)
+            print(log_dict)
+
+        try:
+            self.retry_policy.call(write, on_retry=report)
+        except Exception as e:
+            report(e, self.retry_policy.max_attempts, None)
 
 
 default_log_formatter = logging.Formatter(
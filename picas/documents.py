@@ -2,14 +2,16 @@
 @author Joris Borgdorff
 """
 
+import os
 import socket
 import mimetypes
 import base64
+import hashlib
 import traceback
 from uuid import uuid4
 
 from . import jobid
-from .util import merge_dicts, seconds
+from .util import CHUNK_SIZE, merge_dicts, seconds
 
 
 class Document:
@@ -144,6 +146,53 @@ class Document:
 
         return attachment
 
+    def stream_attachment(self, name, dest, retrieve_from_database=None, chunk_size=CHUNK_SIZE):
+        """
+        Write an attachment to a file or a writable buffer in chunks,
+        without keeping it in memory or adding its data to the document.
+
+        The data is taken from the document if it is embedded, otherwise it
+        is downloaded from the CouchDB database set in
+        retrieve_from_database.
+
+        Returns a dict with the content_type, the length in bytes and the
+        digest ('md5-' followed by the base64 md5 checksum, as CouchDB
+        reports it) of the written data.
+
+        Raises KeyError if attachment does not exist.
+        """
+        stub = self.doc.get('_attachments', {}).get(name)
+        if stub is not None and 'data' in stub:
+            data = base64.b64decode(stub['data'])
+            chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+            response = None
+        elif retrieve_from_database is not None:
+            response = retrieve_from_database.db.get_attachment(self.id, name)
+            if response is None:
+                raise KeyError(name)
+            chunks = iter(lambda: response.read(chunk_size), b'')
+        else:
+            raise KeyError(name)
+
+        md5 = hashlib.md5()
+        length = 0
+        try:
+            if isinstance(dest, (str, os.PathLike)):
+                with open(dest, 'wb') as fobj:
+                    length = _write_chunks(chunks, fobj, md5)
+            else:
+                length = _write_chunks(chunks, dest, md5)
+        finally:
+            if response is not None:
+                response.close()
+
+        content_type = stub.get('content_type') if stub is not None else None
+        if content_type is None:
+            content_type = mimetypes.guess_type(name)[0] or 'text/plain'
+        return {'content_type': content_type,
+                'length': length,
+                'digest': 'md5-' + base64.b64encode(md5.digest()).decode()}
+
     def remove_attachment(self, name):
         """Remove attachment from document"""
         del self.doc['_attachments'][name]
@@ -155,6 +204,16 @@ class Document:
         return self
 
 
+def _write_chunks(chunks, dest, md5):
+    """Write chunks to dest, updating the md5 hash; returns the number of bytes."""
+    length = 0
+    for chunk in chunks:
+        dest.write(chunk)
+        md5.update(chunk)
+        length += len(chunk)
+    return length
+
+
 class User(Document):
     """
     CouchDB user
@@ -205,6 +264,15 @@ class Task(Document):
         jobid.add_job_id(self.doc)
         return self._update_hostname()
 
+    def unlock(self):
+        """
+        Function which modifies the task such that it is no longer locked,
+        e.g. when it was claimed but never started.
+        """
+        self.doc['lock'] = 0
+        jobid.remove_job_id(self.doc)
+        return self._update_hostname()
+
     def done(self):
         """
         Function which modifies the task such that it is closed for ever
@@ -5,12 +5,22 @@
 @Copyright (c) 2016, Jan Bot
 """
 
+import random
+import threading
 import time
+from collections import deque
+from functools import partial
 
-from couchdb.http import ResourceConflict
+from couchdb.http import ResourceConflict, ResourceNotFound
 
-from .documents import Task
+from .clients import TODO_SELECTOR
+from .documents import Document, Task
 from .picaslogger import picaslogger
+from .retry import RetryPolicy
+
+# Minimum number of seconds that a request on the _changes feed waits for a change, so that a
+# small sleep_sec does not turn waiting into a busy loop of requests
+MIN_CHANGES_TIMEOUT = 1.
 
 
 class ViewIterator:
@@ -61,36 +71,314 @@ class ViewIterator:
         """Reconnect to database"""
         self.database = database
 
+    def release(self):
+        """Release tasks that were claimed but not handed out."""
+
+
+class ClaimWindow:
+    """
+    Adaptive window of candidate tasks to claim from a view.
+
+    Each worker picks a random row out of the first rows of a view. With W
+    workers and a window of N rows, a claim conflicts with probability of
+    about 1 - (1 - 1/N)^(W - 1): a small window causes conflicts when there
+    are many workers, a large one fetches rows that are never used when
+    there are few. The window grows when the observed conflict rate is above
+    the target rate and shrinks when it is well below it, and never exceeds
+    the size of the view.
+
+    The rows of a window are kept in random order as candidates, so that a
+    conflict moves on to the next candidate instead of querying the view
+    again. Candidates are dropped after max_age seconds.
+
+    On a bucketed view (see CouchDB.add_bucketed_view), windows start at a
+    random bucket, or at a fixed bucket per worker, so that workers read
+    different parts of the view instead of all its first rows.
+    """
+
+    def __init__(self, size=10, min_size=10, max_size=1000, target_conflict_rate=0.1, max_age=30.,
+                 buckets=None, bucket=None):
+        """
+        @param size: initial number of rows to fetch. Default: 10.
+        @param min_size: minimum number of rows to fetch. Default: 10.
+        @param max_size: maximum number of rows to fetch. Default: 1000.
+        @param target_conflict_rate: fraction of claims that may conflict
+                                     before the window grows. Default: 0.1.
+        @param max_age: seconds after which the candidates of a window are
+                        fetched again. Default: 30.
+        @param buckets: number of buckets of a bucketed view, or None if the
+                        view is not bucketed. Default: None.
+        @param bucket: bucket to start every window at, e.g. derived from
+                       the job id of the worker. Default: None, for a
+                       random bucket per window.
+        """
+        if not 1 <= min_size <= size <= max_size:
+            raise ValueError("Window sizes must satisfy 1 <= min_size <= size <= max_size")
+        if bucket is not None and not buckets:
+            raise ValueError("A bucket can only be given for a bucketed view")
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_conflict_rate = target_conflict_rate
+        self.max_age = max_age
+        self.buckets = buckets
+        self.bucket = bucket
+        # exponentially weighted moving average of conflicts per claim attempt
+        self.conflict_rate = 0.
+        self.view_size = None
+        self.candidates = deque()
+        self.fetched = 0.
+
+    @classmethod
+    def fixed(cls, size, **kwargs):
+        """Window that always fetches size rows"""
+        return cls(size=size, min_size=size, max_size=size, **kwargs)
+
+    def query(self, fetch, **view_params):
+        """
+        Fetch the rows of a window with fetch(**view_params). On a bucketed
+        view the rows start at the first key of a bucket, and if there are
+        none from that bucket on, at the first bucket.
+        """
+        if not self.buckets:
+            return fetch(**view_params)
+        bucket = (self.bucket if self.bucket is not None else random.randrange(self.buckets)) % self.buckets
+        rows = fetch(startkey=[bucket], **view_params)
+        if bucket and not len(rows):
+            rows = fetch(**view_params)
+        return rows
+
+    def next_id(self, database, view, selector=None, **view_params):
+        """
+        Next candidate _id, fetching a new window from the view, or of the
+        _ids of the documents that match a Mango selector, if there are none
+        left.
+        @throws: IndexError: if the view is empty.
+        """
+        if self.candidates and time.monotonic() - self.fetched > self.max_age:
+            self.candidates.clear()
+        if not self.candidates:
+            if selector is not None:
+                rows = database.find(selector, limit=self.size, fields=['_id'])
+            else:
+                rows = self.query(partial(database.view, view, limit=self.size), **view_params)
+            ids = [row.id for row in rows]
+            if not ids:
+                raise IndexError(f"No tasks available in view {view}" if selector is None else
+                                 f"No tasks match selector {selector}")
+            random.shuffle(ids)
+            self.candidates.extend(ids)
+            self.fetched = time.monotonic()
+            self.view_size = getattr(rows, 'total_rows', None)
+        return self.candidates.popleft()
+
+    def record(self, conflict):
+        """Adapt the window size to the outcome of a claim attempt."""
+        self.conflict_rate = 0.8 * self.conflict_rate + 0.2 * bool(conflict)
+        if self.conflict_rate > self.target_conflict_rate:
+            self.size = min(self.max_size, self.size * 2)
+        elif self.conflict_rate < self.target_conflict_rate / 2:
+            self.size = max(self.min_size, int(self.size * 0.9))
+        if self.view_size is not None:
+            self.size = max(self.min_size, min(self.size, self.view_size))
+
+    def clear(self):
+        """Drop the candidates, e.g. after reconnecting."""
+        self.candidates.clear()
+
+
+def _claim_retry_policy(allowed_failures=10):
+    """Default retry policy for claiming tasks: back off on conflicts with other clients."""
+    return RetryPolicy(max_attempts=allowed_failures, base_delay=0.05, max_delay=2.,
+                       retry_on=(ResourceConflict,))
 
-def _claim_task(database, view, allowed_failures=10, **view_params):
-    for _ in range(allowed_failures):
+
+def _lock_task(database, doc_id, claim_handler=None):
+    """
+    Lock a task, on the server with the claim update handler of design
+    document claim_handler if given, and otherwise with a get and a save.
+    @throws: ResourceConflict: if the task was deleted or locked by others.
+    """
+    if claim_handler is not None:
+        try:
+            return database.claim(doc_id, design_doc=claim_handler)
+        except ResourceNotFound:
+            picaslogger.info(f"No claim update handler in design document {claim_handler}, "
+                             "locking the task with a separate save")
+    try:
+        doc = database.get(doc_id)
+    except ValueError as exc:
+        raise ResourceConflict(f"Task {doc_id} was deleted") from exc
+    if doc.value.get('lock'):
+        raise ResourceConflict(f"Task {doc_id} is already locked")
+    return database.save(Task(doc).lock())
+
+
+def _claim_from_window(database, view, window, claim_handler=None, selector=None, **view_params):
+    """Lock the candidates of a ClaimWindow in turn until one is not claimed by others."""
+    doc_id = window.next_id(database, view, selector=selector, **view_params)
+    while True:
         try:
-            doc = database.get_single_from_view(view, window_size=100,
-                                                **view_params)
-            task = Task(doc)
-            return database.save(task.lock())
+            task = _lock_task(database, doc_id, claim_handler)
         except ResourceConflict:
-            pass
-    raise EnvironmentError("Unable to claim task.")
+            window.record(conflict=True)
+            if not window.candidates:
+                # back off before querying the view again
+                raise
+            doc_id = window.candidates.popleft()
+        else:
+            window.record(conflict=False)
+            return task
+
+
+def _claim_from_selector(database, selector, claim_handler=None):
+    """Lock a random one of the first tasks that match a Mango selector."""
+    return _lock_task(database, database.get_single_id_from_find(selector, window_size=100), claim_handler)
+
+
+def _claim_with_handler(database, view, claim_handler, **view_params):
+    """Lock a random one of the first tasks of a view with the claim update handler."""
+    doc_id = database.get_single_id_from_view(view, window_size=100, **view_params)
+    return _lock_task(database, doc_id, claim_handler)
+
+
+def _claim_from_view(database, view, **view_params):
+    """Lock a random one of the first tasks of a view with a save."""
+    doc = database.get_single_from_view(view, window_size=100, **view_params)
+    if doc.value.get('lock'):
+        # claimed by another client between the view query and the get
+        raise ResourceConflict(f"Task {doc.id} is already locked")
+    return database.save(Task(doc).lock())
+
+
+def _claim_task(database, view, allowed_failures=10, claim_handler=None, selector=None,
+                retry_policy=None, window=None, **view_params):
+    if selector is None and hasattr(database, 'claim_tasks'):
+        # the database locks tasks atomically, e.g. SQLiteCouchDB
+        return database.claim_tasks(view, 1, **view_params)[0]
+    if retry_policy is None:
+        retry_policy = _claim_retry_policy(allowed_failures)
+
+    if window is not None:
+        claim = partial(_claim_from_window, database, view, window, claim_handler=claim_handler,
+                        selector=selector, **view_params)
+    elif selector is not None:
+        claim = partial(_claim_from_selector, database, selector, claim_handler=claim_handler)
+    elif claim_handler is not None:
+        claim = partial(_claim_with_handler, database, view, claim_handler, **view_params)
+    else:
+        claim = partial(_claim_from_view, database, view, **view_params)
+
+    try:
+        return retry_policy.call(claim)
+    except ResourceConflict as exc:
+        raise EnvironmentError("Unable to claim task.") from exc
+
+
+def _claim_tasks(database, view, n_tasks, allowed_failures=10, selector=None,
+                 retry_policy=None, window=None, **view_params):
+    """Lock up to n_tasks tasks from a view, or selector, with a single bulk save."""
+    if selector is None and hasattr(database, 'claim_tasks'):
+        return database.claim_tasks(view, n_tasks, **view_params)
+    if retry_policy is None:
+        retry_policy = _claim_retry_policy(allowed_failures)
+
+    def claim():
+        if selector is not None:
+            docs = database.find(selector, limit=n_tasks)
+        else:
+            fetch = partial(database.get_from_view, view, limit=n_tasks)
+            docs = window.query(fetch, **view_params) if window is not None else fetch(**view_params)
+        if not docs:
+            raise IndexError(f"No tasks available in view {view}")
+
+        # skip tasks that were claimed by others between the view query and the get
+        tasks = [Task(doc).lock() for doc in docs if not doc.value.get('lock')]
+        saved = database.save_documents(tasks) if tasks else []
+        locked = [task for task, is_saved in zip(tasks, saved) if is_saved]
+        if not locked:
+            raise ResourceConflict(f"All {len(docs)} tasks were claimed by others")
+        return locked
+
+    try:
+        return retry_policy.call(claim)
+    except ResourceConflict as exc:
+        raise EnvironmentError("Unable to claim task.") from exc
 
 
 class TaskViewIterator(ViewIterator):
 
     """Iterator object to fetch tasks while available."""
-    def __init__(self, database, view, **view_params):
+    def __init__(self, database, view, batch_size=1, claim_handler=None, selector=None,
+                 retry_policy=None, window_size=None, buckets=None, bucket=None, **view_params):
         """
         @param database: CouchDB database to get tasks from.
-        @param view: CouchDB view from which to fetch the task.
+        @param view: CouchDB view from which to fetch the task. Not used if a
+                     selector is given.
+        @param batch_size: number of tasks to lock at once. Tasks that are
+                           locked but not yet handed out are kept in a local
+                           buffer until they are released. Default: 1.
+        @param claim_handler: design document with the claim update handler
+                              (see CouchDB.add_claim_handler) to lock single
+                              tasks on the server. If the handler is missing,
+                              tasks are locked with a separate save.
+                              Default: None.
+        @param selector: Mango selector of the tasks to fetch, e.g.
+                         TODO_SELECTOR, to fetch tasks with _find instead of
+                         a view. A JSON index on the fields of the selector
+                         is created if it does not exist. Default: None.
+        @param retry_policy: RetryPolicy for claims that conflict with other
+                             clients. Default: up to 10 attempts, with
+                             jittered backoff between 0.05 and 2 seconds.
+        @param window_size: number of view rows to pick a single task from.
+                            Default: None, to adapt the number to the
+                            observed conflict rate (see ClaimWindow).
+        @param buckets: number of buckets of the view, if it is a bucketed
+                        view (see CouchDB.add_bucketed_view). Tasks are then
+                        claimed starting from a random bucket. Default: None.
+        @param bucket: claim starting from this bucket instead of a random
+                       one. Default: None.
         @param view_params: parameters which need to be passed on to the view
         (optional).
         """
         super().__init__()
         self.database = database
         self.view = view
+        self.batch_size = batch_size
+        self.claim_handler = claim_handler
+        self.selector = selector
+        self.retry_policy = retry_policy
+        if window_size is None:
+            self.window = ClaimWindow(buckets=buckets, bucket=bucket)
+        else:
+            self.window = ClaimWindow.fixed(window_size, buckets=buckets, bucket=bucket)
         self.view_params = view_params
+        self.buffer = deque()
+
+        if selector is not None:
+            database.add_index([field for field in selector if not field.startswith('$')])
 
     def claim_task(self):
-        return _claim_task(self.database, self.view, **self.view_params)
+        if self.batch_size <= 1:
+            return _claim_task(self.database, self.view, claim_handler=self.claim_handler,
+                               selector=self.selector, retry_policy=self.retry_policy,
+                               window=self.window, **self.view_params)
+
+        if not self.buffer:
+            self.buffer.extend(_claim_tasks(self.database, self.view, self.batch_size,
+                                            selector=self.selector, retry_policy=self.retry_policy,
+                                            window=self.window, **self.view_params))
+        return self.buffer.popleft()
+
+    def release(self):
+        """Unlock all buffered tasks in a single bulk save."""
+        if not self.buffer:
+            return
+
+        tasks = [task.unlock() for task in self.buffer]
+        self.buffer.clear()
+        released = self.database.save_documents(tasks)
+        picaslogger.info(f"Released {sum(released)} of {len(tasks)} buffered tasks")
 
 
 class PrioritizedViewIterator(ViewIterator):
@@ -115,16 +403,18 @@ class PrioritizedViewIterator(ViewIterator):
         self.high_priority_view = high_priority_view
         self.low_priority_view = low_priority_view
         self.view_params = view_params
+        self.high_priority_window = ClaimWindow()
+        self.low_priority_window = ClaimWindow()
 
     def claim_task(self):
         try:
             return _claim_task(self.database, self.high_priority_view,
-                               **self.view_params)
+                               window=self.high_priority_window, **self.view_params)
         except IndexError:
             # don't catch the second IndexError:
             # if both views are empty, fail.
             return _claim_task(self.database, self.low_priority_view,
-                               **self.view_params)
+                               window=self.low_priority_window, **self.view_params)
 
 
 class EndlessViewIterator(ViewIterator):
@@ -133,6 +423,7 @@ class EndlessViewIterator(ViewIterator):
     when none are available.
     """
     def __init__(self, view_iterator, sleep_sec=10, stop_callback=None,
+                 use_changes_feed=False, changes_selector=TODO_SELECTOR,
                  **stop_callback_args):
         """
         @param view_iterator: ViewIterator to get actual tasks from.
@@ -140,13 +431,25 @@ class EndlessViewIterator(ViewIterator):
                           view_iterator again. Set to 0 to do a busy wait.
         @param stop_callback: callback function to determine whether this
                               iterator should stop feeding tasks
+        @param use_changes_feed: instead of sleeping, wait on the _changes
+                                 feed of the database of view_iterator until
+                                 a document that matches changes_selector
+                                 changes. The view is not queried while
+                                 waiting, and the stop_callback is checked
+                                 every sleep_sec seconds, but at most once
+                                 per MIN_CHANGES_TIMEOUT seconds.
+        @param changes_selector: Mango selector of the documents to wait for.
+                                 Default: tokens in the 'todo' state.
         @param stop_callback_args: arguments to the stop_callback function.
         """
         super().__init__()
         self.iterator = view_iterator
         self.sleep_sec = sleep_sec
         self.stop_callback = stop_callback
+        self.use_changes_feed = use_changes_feed
+        self.changes_selector = changes_selector
         self.stop_callback_args = stop_callback_args
+        self.since = None
 
     def is_cancelled(self):
         """Bool to check if the while should be stopped"""
@@ -154,17 +457,172 @@ class EndlessViewIterator(ViewIterator):
                 (self.stop_callback is not None and
                  self.stop_callback(**self.stop_callback_args)))
 
+    def release(self):
+        self.iterator.release()
+
+    def wait_for_work(self):
+        """Wait until new tasks may be available."""
+        picaslogger.info("Iterator is waiting for work...")
+        if not self.use_changes_feed:
+            time.sleep(self.sleep_sec)
+            return
+
+        while not self.is_cancelled():
+            changed, self.since = self.iterator.database.wait_for_changes(
+                self.since, selector=self.changes_selector, timeout=max(self.sleep_sec, MIN_CHANGES_TIMEOUT))
+            if changed:
+                return
+
     def __next__(self):
         while not self.is_cancelled():
+            if self.use_changes_feed and self.since is None:
+                # taken before the view is queried, so no change is missed
+                self.since = self.iterator.database.update_seq()
             try:
                 return next(self.iterator)
             except StopIteration:
                 self.iterator.reset()
-                time.sleep(self.sleep_sec)
-                picaslogger.info("Iterator is waiting for work...")
+                self.wait_for_work()
 
         # no longer continue
         self.iterator.stop()
         self.stop()
         picaslogger.info("Iterator is finishing.")
         raise StopIteration
+
+
+# marks the end of the tasks of the iterator of a PrefetchIterator
+_END = object()
+
+
+class PrefetchIterator(ViewIterator):
+    """
+    Iterator that claims the next tasks of another iterator in a background
+    thread, while the current task is processed, so that the claim latency
+    is not paid between tasks.
+    """
+
+    def __init__(self, iterator, database, depth=1, on_claim=None, release_timeout=30.):
+        """
+        @param iterator: ViewIterator to claim tasks from, e.g. a
+                         TaskViewIterator or an EndlessViewIterator.
+        @param database: CouchDB database to unlock prefetched tasks with.
+        @param depth: maximum number of tasks claimed ahead. Default: 1.
+        @param on_claim: function called in the background thread with
+                         each claimed task, before it is handed out.
+                         Default: None.
+        @param release_timeout: maximum number of seconds that release
+                                waits for a claim in progress, so that the
+                                tasks it locks can be unlocked. Default: 30.
+        """
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        super().__init__()
+        self.iterator = iterator
+        self.database = database
+        self.depth = depth
+        self.on_claim = on_claim
+        self.release_timeout = release_timeout
+        # claimed tasks, followed by _END or an exception when the iterator is done
+        self.prefetched = deque()
+        self.changed = threading.Condition()
+        self.thread = None
+        # increased on release, so that threads of earlier generations stop
+        self.generation = 0
+        # generation of the thread that is waiting for the iterator to claim a task
+        self.claiming = None
+
+    def _prefetch(self, generation):
+        while True:
+            with self.changed:
+                while len(self.prefetched) >= self.depth and generation == self.generation:
+                    self.changed.wait()
+                if generation != self.generation:
+                    return
+                self.claiming = generation
+
+            try:
+                item = next(self.iterator)
+            except StopIteration:
+                item = _END
+            except Exception as ex:
+                item = ex
+
+            with self.changed:
+                if self.claiming == generation:
+                    self.claiming = None
+                if generation == self.generation:
+                    if isinstance(item, Document) and self.on_claim is not None:
+                        try:
+                            self.on_claim(item)
+                        except Exception as ex:
+                            picaslogger.info(f"Error: {type(ex)} occurred after claiming task {item.id}: {ex}")
+                    self.prefetched.append(item)
+                    self.changed.notify_all()
+                    if item is _END or isinstance(item, Exception):
+                        return
+                    continue
+            # released while claiming: the task will not be started, and the
+            # iterator may have locked more tasks in the same claim
+            if isinstance(item, Document):
+                self._unlock([item])
+            self.iterator.release()
+            return
+
+    def __next__(self):
+        if self.is_stopped():
+            raise StopIteration
+
+        with self.changed:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._prefetch, args=(self.generation,),
+                                               name='picas-prefetch', daemon=True)
+                self.thread.start()
+            while not self.prefetched:
+                self.changed.wait()
+            item = self.prefetched.popleft()
+            if item is _END or isinstance(item, Exception):
+                self.thread = None
+            self.changed.notify_all()
+
+        if item is _END:
+            self.stop()
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def reset(self):
+        super().reset()
+        self.iterator.reset()
+
+    def reconnect(self, database):
+        self.database = database
+        self.iterator.reconnect(database)
+
+    def _unlock(self, tasks):
+        released = self.database.save_documents([task.unlock() for task in tasks])
+        picaslogger.info(f"Released {sum(released)} of {len(tasks)} prefetched tasks")
+
+    def release(self):
+        """
+        Stop prefetching, and unlock the tasks that were claimed but not handed
+        out. A claim in progress is waited for up to release_timeout seconds;
+        the background thread then unlocks its tasks and releases the
+        iterator itself.
+        """
+        with self.changed:
+            claiming = self.claiming == self.generation
+            thread = self.thread
+            self.generation += 1
+            self.thread = None
+            tasks = [item for item in self.prefetched if isinstance(item, Document)]
+            self.prefetched.clear()
+            self.changed.notify_all()
+
+        if tasks:
+            self._unlock(tasks)
+        if claiming:
+            thread.join(self.release_timeout)
+        else:
+            self.iterator.release()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+@licence: The MIT License (MIT)
+
+Bulk loading of large numbers of documents, e.g. millions of tokens, in
+chunks that are sent to the database concurrently.
+"""
+
+import socket
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
+
+from couchdb.http import ServerError
+
+from .documents import Document
+from .picaslogger import picaslogger
+from .retry import RetryPolicy
+
+
+class BulkLoader:
+    """
+    Save an iterable of documents in chunks of chunk_size documents, one
+    _bulk_docs request per chunk, from a pool of worker threads.
+
+    The input is consumed lazily: at most 2 * workers chunks are kept in
+    memory, so documents may come from a generator of any length.
+    """
+
+    def __init__(self, database, chunk_size=1000, workers=4, retry_policy=None):
+        """
+        @param database: CouchDB client to save the documents with. It is
+                         shared by the workers.
+        @param chunk_size: number of documents per request. Default: 1000.
+        @param workers: number of concurrent requests. Default: 4.
+        @param retry_policy: RetryPolicy for chunks of which the request
+                             fails. Default: 5 attempts on connection and
+                             server errors.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.database = database
+        self.chunk_size = chunk_size
+        self.workers = workers
+        if retry_policy is None:
+            retry_policy = RetryPolicy(max_attempts=5, base_delay=0.5, max_delay=10.,
+                                       retry_on=(socket.error, ServerError))
+        self.retry_policy = retry_policy
+
+        self.saved = 0
+        self.failed = 0
+        self.elapsed = 0.
+
+    @property
+    def throughput(self):
+        """Number of documents processed per second in the last load"""
+        return (self.saved + self.failed) / self.elapsed if self.elapsed else 0.
+
+    def _save_chunk(self, chunk):
+        """Save a chunk of documents, retrying the request if it fails."""
+        def on_retry(exc, attempt, delay):
+            picaslogger.info(f"Saving a chunk of {len(chunk)} documents failed ({exc}), "
+                             f"attempt {attempt} of {self.retry_policy.max_attempts}")
+        return self.retry_policy.call(self.database.save_documents, chunk, on_retry=on_retry)
+
+    def load(self, docs: Iterable[Document]) -> Iterator[tuple[Document, bool]]:
+        """
+        Save documents in concurrent chunks.
+
+        Documents that are saved get their new _rev. Documents that
+        conflict with a document in the database are not saved.
+
+        @param docs: iterable of documents, e.g. a generator of Tasks
+        @return: iterator of (document, saved) tuples, in the input order
+        @raise: the error of a chunk of which the request keeps failing
+        """
+        self.saved = self.failed = 0
+        self.elapsed = 0.
+        start = time.monotonic()
+        docs = iter(docs)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            def submit_chunks():
+                while len(pending) < 2 * self.workers:
+                    chunk = list(islice(docs, self.chunk_size))
+                    if not chunk:
+                        return
+                    pending.append((chunk, executor.submit(self._save_chunk, chunk)))
+
+            submit_chunks()
+            while pending:
+                chunk, future = pending.popleft()
+                results = future.result()
+                submit_chunks()
+
+                n_saved = sum(results)
+                self.saved += n_saved
+                self.failed += len(chunk) - n_saved
+                self.elapsed = time.monotonic() - start
+                picaslogger.info(f"Saved {self.saved} documents, {self.failed} failed, "
+                                 f"{self.throughput:.0f} documents/s")
+                yield from zip(chunk, results)
+
+    def load_all(self, docs: Iterable[Document]) -> tuple[int, int]:
+        """
+        Save documents in concurrent chunks, without keeping the results.
+
+        @param docs: iterable of documents, e.g. a generator of Tasks
+        @return: tuple of the number of saved and failed documents
+        """
+        for _ in self.load(docs):
+            pass
+        return self.saved, self.failed
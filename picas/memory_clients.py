@@ -0,0 +1,677 @@
+# -*- coding: utf-8 -*-
+"""
+@licence: The MIT License (MIT)
+
+In-process, in-memory CouchDB backend, for tests and benchmarks of actors,
+iterators and loaders without a CouchDB server.
+
+MemoryDatabase stands in for couchdb.Database: it keeps _rev conflict
+semantics, bulk updates, attachments, the changes feed and Mango _find.
+Views are Python functions instead of JavaScript; the Monitor views of
+examples/create_views.py and the status view are built in. View indexes are
+kept sorted and updated on every write, like CouchDB does on every query, so
+claiming from a view with millions of tokens stays cheap.
+
+MemoryCouchDB is the CouchDB client on top of it, so it can be passed
+anywhere a CouchDB client is expected.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import threading
+from bisect import bisect_left, bisect_right, insort
+from uuid import uuid4
+
+from couchdb.client import Row
+from couchdb.http import ResourceConflict, ResourceNotFound
+
+from .clients import CouchDB, CLAIM_HANDLER_CODE, bucket_of
+from .util import CHUNK_SIZE, ViewResults
+
+
+class _Max:
+    """Sorts after any document id."""
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+_MAX = _Max()
+
+
+def _collate(value):
+    """Sort key that orders JSON values like CouchDB view collation."""
+    if value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, (list, tuple)):
+        return (4, tuple(_collate(item) for item in value))
+    if isinstance(value, dict):
+        return (5, tuple((key, _collate(item)) for key, item in value.items()))
+    raise TypeError(f"{type(value)} is not a JSON value")
+
+
+def _copy(value):
+    """Deep copy of a JSON value."""
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.loads(json.dumps(value))
+
+
+def _parse_int(value):
+    """Python version of JavaScript parseInt, None for NaN."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _token_state(doc):
+    """State of a token according to the Monitor views, or None."""
+    if doc.get('type') != 'token':
+        return None
+    lock, done = doc.get('lock'), doc.get('done')
+    if lock == 0 and done == 0:
+        return 'todo'
+    if lock is None or done is None or lock <= 0:
+        return None
+    if done == 0:
+        return 'locked'
+    if done > 0:
+        return 'done' if _parse_int(doc.get('exit_code')) == 0 else 'error'
+    return None
+
+
+def _state_view(state):
+    def map_fun(doc):
+        if _token_state(doc) == state:
+            yield doc['_id'], doc['_id']
+    return map_fun
+
+
+def _overview_view(doc):
+    state = _token_state(doc)
+    if state is not None:
+        yield state, 1
+
+
+def _status_view(doc):
+    state = _token_state(doc)
+    if state is not None:
+        yield state, None
+
+
+# Python equivalents of the views of examples/create_views.py and CouchDB.status
+MONITOR_VIEWS = {
+    'Monitor/todo': (_state_view('todo'), None),
+    'Monitor/locked': (_state_view('locked'), None),
+    'Monitor/done': (_state_view('done'), None),
+    'Monitor/error': (_state_view('error'), None),
+    'Monitor/overview_total': (_overview_view, '_sum'),
+    'Status/status': (_status_view, '_count'),
+}
+
+
+_OPERATORS = {
+    '$eq': lambda value, arg: value == arg,
+    '$ne': lambda value, arg: value != arg,
+    '$gt': lambda value, arg: value is not None and _collate(value) > _collate(arg),
+    '$gte': lambda value, arg: value is not None and _collate(value) >= _collate(arg),
+    '$lt': lambda value, arg: value is not None and _collate(value) < _collate(arg),
+    '$lte': lambda value, arg: value is not None and _collate(value) <= _collate(arg),
+    '$in': lambda value, arg: value in arg,
+    '$nin': lambda value, arg: value not in arg,
+    '$exists': lambda value, arg: (value is not None) == arg,
+}
+
+
+def _match(doc, selector):
+    """Bool: doc matches a Mango selector of fields, operators, $and and $or"""
+    for field, condition in selector.items():
+        if field == '$and':
+            if not all(_match(doc, sub) for sub in condition):
+                return False
+        elif field == '$or':
+            if not any(_match(doc, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(op.startswith('$') for op in condition):
+            value = doc.get(field)
+            for op, arg in condition.items():
+                if op not in _OPERATORS:
+                    raise ValueError(f"Unsupported Mango operator {op}")
+                if not _OPERATORS[op](value, arg):
+                    return False
+        elif doc.get(field) != condition:
+            return False
+    return True
+
+
+def _reduce(reduce_fun, keys, values):
+    if reduce_fun == '_count':
+        return len(values)
+    if reduce_fun == '_sum':
+        return sum(values)
+    return reduce_fun(keys, values, False)
+
+
+class _ViewIndex:
+    """Sorted rows of a view, updated per document."""
+
+    def __init__(self, map_fun, reduce_fun):
+        self.map_fun = map_fun
+        self.reduce_fun = reduce_fun
+        # sorted (collation key, doc id, emit number) of all rows
+        self.entries = []
+        # doc id -> [(key, value), ...] emitted for the document
+        self.emitted = {}
+
+    def add(self, doc):
+        rows = [(key, value) for key, value in self.map_fun(doc) or ()]
+        for n, (key, _) in enumerate(rows):
+            insort(self.entries, (_collate(key), doc['_id'], n))
+        if rows:
+            self.emitted[doc['_id']] = rows
+
+    def remove(self, doc_id):
+        for n, (key, _) in enumerate(self.emitted.pop(doc_id, ())):
+            del self.entries[bisect_left(self.entries, (_collate(key), doc_id, n))]
+
+    def row(self, entry):
+        """Key and value of the row of an entry"""
+        return self.emitted[entry[1]][entry[2]]
+
+    def select(self, options, count=None):
+        """Entries in the key range of the view options, in the requested order;
+        only the first count entries if count is given."""
+        descending = options.get('descending', False)
+        if 'key' in options:
+            options = dict(options, startkey=options['key'], endkey=options['key'])
+        startkey = options.get('startkey', options.get('start_key'))
+        endkey = options.get('endkey', options.get('end_key'))
+        start_docid = options.get('startkey_docid', options.get('start_key_doc_id'))
+        end_docid = options.get('endkey_docid', options.get('end_key_doc_id'))
+        if descending:
+            startkey, endkey = endkey, startkey
+            start_docid, end_docid = end_docid, start_docid
+            inclusive_start, inclusive_end = options.get('inclusive_end', True), True
+        else:
+            inclusive_start, inclusive_end = True, options.get('inclusive_end', True)
+
+        low, high = 0, len(self.entries)
+        if startkey is not None:
+            if inclusive_start:
+                low = bisect_left(self.entries, (_collate(startkey), start_docid or ''))
+            else:
+                low = bisect_right(self.entries, (_collate(startkey), _MAX))
+        if endkey is not None:
+            if inclusive_end:
+                high = bisect_right(self.entries, (_collate(endkey), end_docid if end_docid is not None else _MAX, _MAX))
+            else:
+                high = bisect_left(self.entries, (_collate(endkey),))
+
+        if count is not None:
+            if descending:
+                low = max(low, high - count)
+            else:
+                high = min(high, low + count)
+        entries = self.entries[low:high]
+        if descending:
+            entries.reverse()
+        return entries
+
+
+class UnsupportedOperation(NotImplementedError):
+    """A CouchDB server feature that the in-memory database can not emulate."""
+
+
+class MemoryDatabase:
+    """
+    In-memory stand-in for couchdb.Database, safe to use from several
+    threads.
+    """
+
+    def __init__(self, name='test'):
+        """
+        @param name: name of the database
+        """
+        self.name = name
+        self.docs = {}
+        # doc id -> {attachment name: data}
+        self.attachments = {}
+        self.views = dict(MONITOR_VIEWS)
+        self.indexes = {}
+        self.mango_indexes = _MangoIndexes()
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.seq = 0
+        # doc id -> (seq, rev, deleted) of the last change, in order of seq
+        self.doc_seqs = {}
+        # the _security document, see CouchDB.set_users
+        self.security = {}
+
+    def __contains__(self, id):
+        with self.lock:
+            return id in self.docs
+
+    def __len__(self):
+        with self.lock:
+            return len(self.docs)
+
+    def __getitem__(self, id):
+        doc = self.get(id)
+        if doc is None:
+            raise ResourceNotFound(('not_found', 'missing'))
+        return doc
+
+    def get(self, id, default=None, **options):
+        with self.lock:
+            doc = self.docs.get(id)
+            return _copy(doc) if doc is not None else default
+
+    def info(self):
+        with self.lock:
+            return {'db_name': self.name, 'doc_count': len(self.docs), 'update_seq': self.seq}
+
+    def add_view(self, name, map_fun, reduce_fun=None):
+        """
+        Add or replace a view.
+
+        @param name: design document and view name, e.g. Monitor/todo
+        @param map_fun: function that yields (key, value) tuples for a document
+        @param reduce_fun: None, '_count', '_sum' or a function
+                           reduce_fun(keys, values, rereduce)
+        """
+        with self.lock:
+            self.views[name] = (map_fun, reduce_fun)
+            self.indexes.pop(name, None)
+
+    # Writing
+
+    def _new_rev(self, current):
+        generation = int(current['_rev'].split('-')[0]) if current is not None else 0
+        return f'{generation + 1}-{uuid4().hex}'
+
+    def _write(self, doc_id, doc):
+        """Store doc, or delete the document if doc is None, and update the indexes."""
+        old = self.docs.pop(doc_id, None)
+        for index in self.indexes.values():
+            index.remove(doc_id)
+        if doc is None:
+            self.attachments.pop(doc_id, None)
+            rev = self._new_rev(old)
+        else:
+            self.docs[doc_id] = doc
+            if not doc_id.startswith('_design/'):
+                for index in self.indexes.values():
+                    index.add(doc)
+            rev = doc['_rev']
+
+        self.seq += 1
+        self.doc_seqs.pop(doc_id, None)
+        self.doc_seqs[doc_id] = (self.seq, rev, doc is None)
+        self.changed.notify_all()
+        return rev
+
+    def _store_attachments(self, doc_id, doc, current):
+        """Move embedded attachment data to the attachment store, leaving stubs."""
+        attachments = doc.get('_attachments') or {}
+        stored = self.attachments.get(doc_id, {})
+        for name, attachment in attachments.items():
+            if 'data' not in attachment and name not in stored:
+                raise ResourceConflict(('missing_stub', f'Attachment {name} is missing'))
+
+        self.attachments.pop(doc_id, None)
+        if not attachments:
+            return
+        stored = self.attachments[doc_id] = {name: data for name, data in stored.items() if name in attachments}
+        for name, attachment in attachments.items():
+            if 'data' in attachment:
+                data = base64.b64decode(attachment['data'])
+                stored[name] = data
+                attachments[name] = {
+                    'content_type': attachment.get('content_type', 'application/octet-stream'),
+                    'length': len(data),
+                    'digest': 'md5-' + base64.b64encode(hashlib.md5(data).digest()).decode(),
+                    'stub': True}
+            else:
+                attachments[name] = dict(current['_attachments'][name])
+
+    def _update_one(self, doc):
+        """Save or delete a single document; returns the new rev or raises."""
+        doc_id = doc.get('_id') or uuid4().hex
+        current = self.docs.get(doc_id)
+        if current is not None and current['_rev'] != doc.get('_rev'):
+            raise ResourceConflict(('conflict', 'Document update conflict.'))
+        if current is None and '_rev' in doc:
+            tombstone = self.doc_seqs.get(doc_id)
+            if tombstone is None or tombstone[1] != doc['_rev']:
+                raise ResourceConflict(('conflict', 'Document update conflict.'))
+
+        if doc.get('_deleted'):
+            if current is None:
+                raise ResourceNotFound(('not_found', 'deleted'))
+            return doc_id, self._write(doc_id, None)
+
+        new_doc = _copy(doc)
+        new_doc['_id'] = doc_id
+        new_doc['_rev'] = self._new_rev(current)
+        self._store_attachments(doc_id, new_doc, current)
+        return doc_id, self._write(doc_id, new_doc)
+
+    def save(self, doc, **options):
+        with self.lock:
+            doc_id, rev = self._update_one(doc)
+        doc['_id'], doc['_rev'] = doc_id, rev
+        return doc_id, rev
+
+    def update(self, documents, **options):
+        results = []
+        with self.lock:
+            for doc in documents:
+                try:
+                    doc_id, rev = self._update_one(doc)
+                except (ResourceConflict, ResourceNotFound) as exc:
+                    results.append((False, doc.get('_id'), exc))
+                    continue
+                doc.update({'_id': doc_id, '_rev': rev})
+                results.append((True, doc_id, rev))
+        return results
+
+    def delete(self, doc):
+        with self.lock:
+            current = self.docs.get(doc['_id'])
+            if current is None:
+                raise ResourceNotFound(('not_found', 'missing'))
+            self._update_one({'_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True})
+
+    def update_doc(self, name, docid=None, body=None, **options):
+        """
+        Run an update handler. Update handlers are JavaScript, so only the
+        claim handler of CouchDB.add_claim_handler is emulated.
+        @throws: UnsupportedOperation: for any other update handler.
+        """
+        design_doc, handler = name.split('/')
+        with self.lock:
+            code = self.docs.get('_design/' + design_doc, {}).get('updates', {}).get(handler)
+            if code is None:
+                raise ResourceNotFound(('not_found', 'missing update function'))
+            if code != CLAIM_HANDLER_CODE:
+                raise UnsupportedOperation(f"MemoryDatabase can only run the claim update handler, not {name}")
+
+            current = self.docs.get(docid)
+            if current is None or current.get('lock') != 0:
+                raise ResourceConflict(('conflict', 'Task is not available to claim.'))
+            doc = dict(_copy(current), **body)
+            _, rev = self._update_one(doc)
+            doc['_rev'] = rev
+        return {'X-Couch-Update-NewRev': rev}, io.BytesIO(json.dumps(doc).encode())
+
+    # Attachments
+
+    def put_attachment(self, doc, content, filename=None, content_type=None):
+        if hasattr(content, 'read'):
+            chunks = []
+            for chunk in iter(lambda: content.read(CHUNK_SIZE), b''):
+                chunks.append(chunk.encode() if isinstance(chunk, str) else chunk)
+            data = b''.join(chunks)
+        else:
+            data = content.encode() if isinstance(content, str) else content
+
+        with self.lock:
+            current = self.docs.get(doc['_id'])
+            if current is None and '_rev' not in doc:
+                current = {'_id': doc['_id']}
+            elif current is None or current['_rev'] != doc.get('_rev'):
+                raise ResourceConflict(('conflict', 'Document update conflict.'))
+            new_doc = _copy(current)
+            new_doc['_rev'] = self._new_rev(current if '_rev' in current else None)
+            new_doc.setdefault('_attachments', {})[filename] = {
+                'content_type': content_type or 'application/octet-stream',
+                'length': len(data),
+                'digest': 'md5-' + base64.b64encode(hashlib.md5(data).digest()).decode(),
+                'stub': True}
+            self.attachments.setdefault(doc['_id'], {})[filename] = data
+            doc['_rev'] = self._write(doc['_id'], new_doc)
+
+    def get_attachment(self, id_or_doc, filename, default=None):
+        doc_id = id_or_doc['_id'] if isinstance(id_or_doc, dict) else id_or_doc
+        with self.lock:
+            data = self.attachments.get(doc_id, {}).get(filename)
+        if data is None:
+            return default
+        return io.BytesIO(data)
+
+    def delete_attachment(self, doc, filename):
+        with self.lock:
+            current = self.docs.get(doc['_id'])
+            if current is None or current['_rev'] != doc.get('_rev'):
+                raise ResourceConflict(('conflict', 'Document update conflict.'))
+            new_doc = _copy(current)
+            new_doc.get('_attachments', {}).pop(filename, None)
+            new_doc['_rev'] = self._new_rev(current)
+            self.attachments.get(doc['_id'], {}).pop(filename, None)
+            doc['_rev'] = self._write(doc['_id'], new_doc)
+
+    # Querying
+
+    def _index(self, name):
+        """The index of a view, built on first use."""
+        index = self.indexes.get(name)
+        if index is None:
+            if name not in self.views:
+                raise ResourceNotFound(('not_found', 'missing_named_view'))
+            index = _ViewIndex(*self.views[name])
+            for doc_id, doc in self.docs.items():
+                if not doc_id.startswith('_design/'):
+                    index.add(doc)
+            self.indexes[name] = index
+        return index
+
+    def _all_docs(self, options):
+        keys = options.get('keys')
+        if keys is None:
+            keys = sorted(self.docs)
+            if options.get('descending'):
+                keys.reverse()
+        rows = []
+        for key in keys:
+            doc = self.docs.get(key)
+            if doc is None:
+                rows.append(Row(key=key, error='not_found'))
+                continue
+            row = Row(id=key, key=key, value={'rev': doc['_rev']})
+            if options.get('include_docs'):
+                row['doc'] = _copy(doc)
+            rows.append(row)
+        skip = options.get('skip', 0)
+        limit = options.get('limit')
+        rows = rows[skip:skip + limit if limit is not None else None]
+        return ViewResults(rows, len(self.docs), skip)
+
+    def view(self, name, wrapper=None, **options):
+        with self.lock:
+            if name == '_all_docs':
+                return self._all_docs(options)
+
+            index = self._index(name)
+            skip = options.get('skip', 0)
+            limit = options.get('limit')
+            reduce = index.reduce_fun is not None and options.get('reduce', True) and not options.get('include_docs')
+            count = skip + limit if limit is not None and not reduce else None
+            if 'keys' in options:
+                entries = []
+                for key in options['keys']:
+                    entries.extend(index.select(dict(options, key=key)))
+            else:
+                entries = index.select(options, count=count)
+
+            if reduce:
+                return ViewResults(self._reduce_rows(index, entries, options)[skip:][:limit])
+
+            rows = []
+            for entry in entries[skip:skip + limit if limit is not None else None]:
+                key, value = index.row(entry)
+                row = Row(id=entry[1], key=_copy(key), value=_copy(value))
+                if options.get('include_docs'):
+                    row['doc'] = _copy(self.docs[entry[1]])
+                rows.append(row)
+            return ViewResults(rows, len(index.entries), skip)
+
+    def _reduce_rows(self, index, entries, options):
+        group_level = options.get('group_level')
+        if options.get('group') and group_level is None:
+            group_level = 'exact'
+        if group_level is None:
+            keys = [index.row(entry)[0] for entry in entries]
+            values = [index.row(entry)[1] for entry in entries]
+            return [Row(key=None, value=_reduce(index.reduce_fun, keys, values))] if entries else []
+
+        groups = {}
+        for entry in entries:
+            key, value = index.row(entry)
+            if group_level != 'exact' and isinstance(key, list):
+                key = key[:group_level]
+            group = groups.setdefault(json.dumps(key), (key, [], []))
+            group[1].append(key)
+            group[2].append(value)
+        return [Row(key=key, value=_reduce(index.reduce_fun, keys, values))
+                for key, keys, values in groups.values()]
+
+    def find(self, mango, wrapper=None):
+        selector = mango.get('selector', {})
+        with self.lock:
+            docs = [doc for doc_id, doc in sorted(self.docs.items())
+                    if not doc_id.startswith('_design/') and _match(doc, selector)]
+            for sort in reversed(mango.get('sort', [])):
+                field, direction = next(iter(sort.items())) if isinstance(sort, dict) else (sort, 'asc')
+                docs.sort(key=lambda doc: _collate(doc.get(field)), reverse=direction == 'desc')
+            skip = mango.get('skip', 0)
+            docs = docs[skip:skip + mango.get('limit', 25)]
+            fields = mango.get('fields')
+            if fields:
+                return [{field: _copy(doc[field]) for field in fields if field in doc} for doc in docs]
+            return [_copy(doc) for doc in docs]
+
+    def index(self):
+        return self.mango_indexes
+
+    def changes(self, **options):
+        since = options.get('since', 0)
+        limit = options.get('limit')
+        selector = (options.get('_selector') or {}).get('selector') if options.get('filter') == '_selector' else None
+
+        def matching():
+            results = []
+            for doc_id, (seq, rev, deleted) in self.doc_seqs.items():
+                if seq <= since:
+                    continue
+                if selector is not None and (deleted or not _match(self.docs[doc_id], selector)):
+                    continue
+                result = {'id': doc_id, 'seq': seq, 'changes': [{'rev': rev}]}
+                if deleted:
+                    result['deleted'] = True
+                elif options.get('include_docs'):
+                    result['doc'] = _copy(self.docs[doc_id])
+                results.append(result)
+            return sorted(results, key=lambda result: result['seq'])[:limit]
+
+        with self.changed:
+            if since == 'now':
+                since = self.seq
+            if options.get('feed') == 'longpoll':
+                self.changed.wait_for(matching, timeout=options.get('timeout', 60000) / 1000.)
+            results = matching()
+            last_seq = results[-1]['seq'] if results else self.seq
+        return {'results': results, 'last_seq': last_seq}
+
+
+class _MangoIndexes(list):
+    """List of Mango index definitions, with the interface of couchdb.client.Indexes.
+    Queries do not use them: _find always scans all documents."""
+
+    def __setitem__(self, ddoc_name, fields):
+        if not isinstance(ddoc_name, tuple):
+            return super().__setitem__(ddoc_name, fields)
+        ddoc, name = ddoc_name
+        self.append({'ddoc': '_design/' + ddoc, 'name': name or uuid4().hex, 'type': 'json',
+                     'def': {'fields': [{field: 'asc'} for field in fields]}})
+
+
+class MemoryCouchDB(CouchDB):
+    """
+    CouchDB client that keeps the database in memory, in this process.
+
+    Copies share the same MemoryDatabase, so threads of one process can work
+    on the same tokens. Views are Python functions; see add_view.
+    """
+
+    def __init__(self, db: str = "test", database: MemoryDatabase = None):
+        """
+        Create an in-memory database.
+
+        :param db: name of the database. Default: test.
+        :param database: existing MemoryDatabase to connect to. Default: a
+          new, empty database.
+        """
+        self.db = database if database is not None else MemoryDatabase(db)
+        self._init_state()
+
+    def copy(self) -> "MemoryCouchDB":
+        """
+        Copy the DB connection; the copy uses the same database.
+        """
+        return MemoryCouchDB(database=self.db)
+
+    def _get_security(self) -> dict:
+        with self.db.lock:
+            return _copy(self.db.security)
+
+    def _put_security(self, security: dict) -> None:
+        with self.db.lock:
+            self.db.security = _copy(security)
+
+    def _attachment_database(self):
+        # attachments are stored in this process, there is no connection to retry
+        return self.db
+
+    def add_view(self, view: str, map_fun, *args, reduce_fun=None, design_doc: str = "Monitor",
+                 **kwargs) -> None:
+        """
+        Add a view to the database
+
+        :param view: name of the view
+        :param map_fun: Python function that yields (key, value) tuples for a
+          document. JavaScript views can not be evaluated in memory.
+        :param reduce_fun: None, '_count', '_sum', or a Python function
+          reduce_fun(keys, values, rereduce)
+        :param design_doc: name of the design document (default: Monitor)
+        :return: None
+        """
+        if not callable(map_fun):
+            raise TypeError("MemoryCouchDB evaluates views in Python: map_fun must be a function "
+                            "that yields (key, value) tuples")
+        self.db.add_view(design_doc + '/' + view, map_fun, reduce_fun)
+
+    def add_bucketed_view(self, view: str = "todo_bucketed", n_buckets: int = 16,
+                          design_doc: str = "Monitor") -> None:
+        """
+        Add a view of the tokens in the 'todo' state with [bucket, _id] keys,
+        evaluated in Python; see CouchDB.add_bucketed_view.
+        """
+        if n_buckets < 1:
+            raise ValueError("n_buckets must be at least 1")
+
+        def map_fun(doc):
+            if _token_state(doc) == 'todo':
+                yield [bucket_of(doc['_id'], n_buckets), doc['_id']], doc['_id']
+        self.add_view(view, map_fun, design_doc=design_doc)
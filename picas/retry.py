@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+@licence: The MIT License (MIT)
+
+Retry policy with exponential backoff and decorrelated jitter, for requests
+that fail because many clients access the same documents at the same time.
+
+Without a delay, or with a fixed delay, clients that conflicted once retry
+in lockstep and conflict again. Decorrelated jitter spreads the retries
+out: each delay is drawn between the base delay and three times the
+previous delay, capped at max_delay.
+"""
+
+import random
+import time
+
+
+class RetryPolicy:
+    """
+    Configurable policy to call a function again when it raises a retryable
+    exception.
+    """
+
+    def __init__(self, max_attempts=10, base_delay=0.1, max_delay=10., max_elapsed=None,
+                 retry_on=(Exception,), give_up_on=(), sleep=time.sleep):
+        """
+        @param max_attempts: maximum number of calls, including the first.
+                             Default: 10.
+        @param base_delay: minimum delay in seconds between calls. Default: 0.1.
+        @param max_delay: maximum delay in seconds between calls. Default: 10.
+        @param max_elapsed: maximum number of seconds to keep retrying, or
+                            None for no limit. Default: None.
+        @param retry_on: exception types that are retried. Default: all.
+        @param give_up_on: exception types that are never retried, even if
+                           they are a subclass of one in retry_on.
+        @param sleep: function used to wait between calls.
+        """
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.retry_on = tuple(retry_on)
+        self.give_up_on = tuple(give_up_on)
+        self.sleep = sleep
+
+    def is_retryable(self, exc):
+        """Bool: exc should be retried according to this policy"""
+        return isinstance(exc, self.retry_on) and not isinstance(exc, self.give_up_on)
+
+    def next_delay(self, previous_delay):
+        """Draw the delay after a call that was preceded by previous_delay."""
+        return min(self.max_delay, random.uniform(self.base_delay, previous_delay * 3))
+
+    def call(self, func, *args, on_retry=None, **kwargs):
+        """
+        Call func(*args, **kwargs) until it succeeds or the policy gives up.
+
+        @param func: function to call
+        @param on_retry: optional function called as on_retry(exc, attempt, delay)
+                         before waiting for the next attempt, e.g. to reconnect.
+        @return: the return value of func
+        @raise: the last exception of func, when it is not retryable, or the
+                maximum number of attempts or elapsed time is reached.
+        """
+        start = time.monotonic()
+        delay = self.base_delay
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as exc:
+                if not self.is_retryable(exc) or attempt == self.max_attempts:
+                    raise
+                delay = self.next_delay(delay)
+                if self.max_elapsed is not None and time.monotonic() - start + delay > self.max_elapsed:
+                    raise
+                if on_retry is not None:
+                    on_retry(exc, attempt, delay)
+                self.sleep(delay)
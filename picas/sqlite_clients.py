@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+"""
+@licence: The MIT License (MIT)
+
+Token pool in a local SQLite file, for the workers of a single node, where
+running a CouchDB server is not worth it. The file must be on a local file
+system: the database runs in WAL mode, which needs shared memory between the
+processes that use it and does not work on network file systems.
+
+SQLiteCouchDB has the methods of the CouchDB client that are used by the
+actors and iterators. Documents are stored as JSON, with their _rev; the
+fields that the Monitor views select on are indexed generated columns.
+Claiming is a single UPDATE ... RETURNING statement, so it never conflicts
+with other workers and needs no retries. In WAL mode readers do not block
+the writer.
+
+Requires SQLite 3.35 or later, for RETURNING.
+"""
+
+import json
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+from typing import Iterator
+
+from couchdb.client import Row
+from couchdb.http import ResourceConflict, ResourceNotFound
+
+from . import jobid
+from .clients import ROW_FILTER_PARAMS
+from .documents import Document, Task
+from .util import TTLCache, ViewResults, seconds
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    rev TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    type TEXT GENERATED ALWAYS AS (json_extract(body, '$.type')) VIRTUAL,
+    lock INTEGER GENERATED ALWAYS AS (json_extract(body, '$.lock')) VIRTUAL,
+    done INTEGER GENERATED ALWAYS AS (json_extract(body, '$.done')) VIRTUAL,
+    exit_code INTEGER GENERATED ALWAYS AS (json_extract(body, '$.exit_code')) VIRTUAL
+);
+CREATE INDEX IF NOT EXISTS documents_state ON documents (type, lock, done, id);
+CREATE INDEX IF NOT EXISTS documents_seq ON documents (seq);
+CREATE TABLE IF NOT EXISTS views (name TEXT PRIMARY KEY, condition TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('update_seq', 0);
+'''
+
+# SQL conditions equivalent to the views of examples/create_views.py
+MONITOR_VIEWS = {
+    'Monitor/todo': "type = 'token' AND lock = 0 AND done = 0",
+    'Monitor/locked': "type = 'token' AND lock > 0 AND done = 0",
+    'Monitor/done': "type = 'token' AND lock > 0 AND done > 0 AND exit_code = 0",
+    'Monitor/error': "type = 'token' AND lock > 0 AND done > 0 AND (exit_code IS NOT 0)",
+}
+
+# Same states as the status view of CouchDB.status
+STATE_SQL = '''
+CASE
+    WHEN lock = 0 AND done = 0 THEN 'todo'
+    WHEN lock > 0 AND done = 0 THEN 'locked'
+    WHEN lock > 0 AND done > 0 AND exit_code = 0 THEN 'done'
+    WHEN lock > 0 AND done > 0 THEN 'error'
+END
+'''
+
+NEW_REV_SQL = "(CAST(rev AS INTEGER) + 1) || '-' || lower(hex(randomblob(16)))"
+
+
+def _selector_sql(selector):
+    """SQL condition and parameters for a Mango selector of field values."""
+    if not selector:
+        return '1', []
+    conditions, params = [], []
+    for field, value in selector.items():
+        if field.startswith('$') or isinstance(value, (dict, list)):
+            raise ValueError(f"SQLiteCouchDB only supports selectors on field values, not {field}: {value}")
+        conditions.append("json_extract(body, ?) IS ?")
+        params.extend([f'$.{field}', value])
+    return ' AND '.join(conditions), params
+
+
+def _key_range_sql(view_params):
+    """SQL conditions and parameters for the key range of view parameters; the keys are the _ids."""
+    descending = view_params.get('descending', False)
+    conditions, params = [], []
+    if 'key' in view_params:
+        view_params = dict(view_params, startkey=view_params['key'], endkey=view_params['key'])
+    if 'startkey' in view_params:
+        conditions.append('id <= ?' if descending else 'id >= ?')
+        params.append(view_params['startkey'])
+    if 'endkey' in view_params:
+        conditions.append('id >= ?' if descending else 'id <= ?')
+        params.append(view_params['endkey'])
+    return conditions, params
+
+
+def _body(doc):
+    """JSON of a document, without _id and _rev"""
+    return json.dumps({key: value for key, value in doc.items() if key not in ('_id', '_rev')})
+
+
+def _document(row):
+    """Document dict of a (id, rev, body) row"""
+    doc = json.loads(row[2])
+    doc['_id'], doc['_rev'] = row[0], row[1]
+    return doc
+
+
+class SQLiteCouchDB:
+    """
+    Token pool in a SQLite file, with the CouchDB client methods used by
+    the actors and iterators.
+
+    Views are SQL conditions on the documents table; the Monitor views are
+    built in. Each thread uses its own connection.
+    """
+
+    def __init__(self, path: str = "picas.db", timeout: float = 60.):
+        """
+        Open or create a token pool.
+
+        :param path: path of the SQLite file. Default: picas.db
+        :param timeout: seconds to wait for the write lock of other workers.
+          Default: 60.
+        """
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            raise RuntimeError(f"SQLiteCouchDB needs SQLite 3.35 or later, found {sqlite3.sqlite_version}")
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.status_cache = TTLCache(ttl=10.)
+
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """The connection of this thread"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction, that holds the write lock from the start."""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _next_seq(self, conn) -> int:
+        return conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'update_seq' RETURNING value").fetchone()[0]
+
+    def close(self) -> None:
+        """Close the connection of this thread."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def copy(self) -> "SQLiteCouchDB":
+        """
+        Copy the DB connection.
+        """
+        return SQLiteCouchDB(self.path, timeout=self.timeout)
+
+    # Documents
+
+    def get(self, id: str) -> Document:
+        """
+        Get raw data associated to the given ID
+
+        :param id: _id string of the task
+        """
+        row = self._connection().execute('SELECT id, rev, body FROM documents WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            raise ValueError(id + " is not a document ID in the database")
+        return Document(_document(row))
+
+    def __getitem__(self, idx: str) -> Document:
+        return self.get(idx)
+
+    def get_documents(self, ids: list[str], batch_size: int = 1000) -> list[Document]:
+        """
+        Get the documents with the given ids, skipping ids that do not exist.
+
+        :param ids: list of _id strings
+        :param batch_size: number of documents to select per query
+        :return: list of Document objects, in the order of ids
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        conn = self._connection()
+        docs = []
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            rows = conn.execute(f"SELECT id, rev, body FROM documents WHERE id IN ({','.join('?' * len(batch))})",
+                                batch).fetchall()
+            found = {row[0]: row for row in rows}
+            docs.extend(Document(_document(found[id])) for id in batch if id in found)
+        return docs
+
+    def _save_one(self, conn, doc: dict, seq: int) -> str:
+        """Insert or update doc in a transaction; returns the new rev or raises ResourceConflict."""
+        if '_id' not in doc:
+            raise ValueError("SQLiteCouchDB documents need an _id")
+        row = conn.execute('SELECT rev FROM documents WHERE id = ?', (doc['_id'],)).fetchone()
+        if (row[0] if row is not None else None) != doc.get('_rev'):
+            raise ResourceConflict(('conflict', 'Document update conflict.'))
+
+        if doc.get('_deleted'):
+            conn.execute('DELETE FROM documents WHERE id = ?', (doc['_id'],))
+            return doc['_rev']
+        if row is None:
+            return conn.execute("INSERT INTO documents (id, rev, seq, body) VALUES (?, '1-' || lower(hex(randomblob(16))), ?, ?) "
+                                "RETURNING rev", (doc['_id'], seq, _body(doc))).fetchone()[0]
+        return conn.execute(f"UPDATE documents SET rev = {NEW_REV_SQL}, seq = ?, body = ? WHERE id = ? RETURNING rev",
+                            (seq, _body(doc), doc['_id'])).fetchone()[0]
+
+    def save(self, doc: Document) -> Document:
+        """
+        Save a Document to the database.
+
+        Updates the document to have the new _rev value.
+
+        :param doc: Document object
+        :throws couchdb.http.ResourceConflict: when document exists with
+                different revision or was deleted.
+        """
+        with self._transaction() as conn:
+            doc['_rev'] = self._save_one(conn, doc.value, self._next_seq(conn))
+        return doc
+
+    def save_documents(self, docs: list[Document]) -> list[bool]:
+        """
+        Save a sequence of Documents to the database, in one transaction.
+
+        :param docs: documents for which the save was succesful will get new
+                _rev values
+        :return: a sequence of [succeeded1, succeeded2, ...] values.
+        """
+        result = []
+        with self._transaction() as conn:
+            seq = self._next_seq(conn)
+            for doc in docs:
+                try:
+                    doc['_rev'] = self._save_one(conn, doc.value, seq)
+                    result.append(True)
+                except ResourceConflict:
+                    result.append(False)
+        return result
+
+    def delete(self, doc: Document) -> None:
+        """
+        Delete a Document from the database
+
+        :param doc: Document object with the current _rev
+        :raise: ResourceConflict: if the document was updated in the database
+        """
+        with self._transaction() as conn:
+            self._save_one(conn, dict(doc.value, _deleted=True), self._next_seq(conn))
+
+    def delete_documents(self, docs: list[Document], batch_size: int = 1000) -> list[bool]:
+        """
+        Delete a sequence of Documents from the database.
+
+        :param docs: Documents with their current _rev
+        :param batch_size: number of documents to delete per transaction
+        :return: a sequence of [succeeded1, succeeded2, ...] values.
+        """
+        result = []
+        for i in range(0, len(docs), batch_size):
+            result.extend(self.save_documents([Document(dict(doc.value, _deleted=True))
+                                               for doc in docs[i:i + batch_size]]))
+        return result
+
+    def doc_count(self) -> int:
+        """
+        Count number of documents in database
+        """
+        return self._connection().execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    # Views
+
+    def add_view(self, view: str, condition: str, design_doc: str = "Monitor") -> None:
+        """
+        Add a view to the database
+
+        :param view: name of the view
+        :param condition: SQL condition on the documents table, e.g.
+          "type = 'token' AND lock = 0 AND json_extract(body, '$.cores') = 4"
+        :param design_doc: name of the design document (default: Monitor)
+        :return: None
+        """
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO views (name, condition) VALUES (?, ?)',
+                         (design_doc + '/' + view, condition))
+
+    def add_bucketed_view(self, view: str = "todo_bucketed", n_buckets: int = 16,
+                          design_doc: str = "Monitor") -> None:
+        """
+        Add a view of the tokens in the 'todo' state. Claims are atomic in
+        SQLite, so they are not spread over buckets: this view has the same
+        rows as todo, for code that also runs against CouchDB.
+        """
+        if n_buckets < 1:
+            raise ValueError("n_buckets must be at least 1")
+        self.add_view(view, MONITOR_VIEWS['Monitor/todo'], design_doc=design_doc)
+
+    def _view_condition(self, name: str) -> str:
+        row = self._connection().execute('SELECT condition FROM views WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            return row[0]
+        if name in MONITOR_VIEWS:
+            return MONITOR_VIEWS[name]
+        raise ResourceNotFound(('not_found', 'missing_named_view'))
+
+    def view(self, view: str, design_doc: str = "Monitor", **view_params) -> ViewResults:
+        """
+        Get the rows of a view; the key and value of each row are the _id.
+
+        :param view: name of the view
+        :param view_params: limit, skip, startkey, endkey, key, descending
+          and include_docs are supported.
+        :return: list of rows, with a rows and total_rows property
+        """
+        condition = self._view_condition(design_doc + '/' + view)
+        conn = self._connection()
+        total_rows = conn.execute(f'SELECT COUNT(*) FROM documents WHERE {condition}').fetchone()[0]
+
+        descending = view_params.get('descending', False)
+        conditions, params = _key_range_sql(view_params)
+        conditions = [condition] + conditions
+        sql = (f"SELECT id, rev, body FROM documents WHERE {' AND '.join(f'({c})' for c in conditions)} "
+               f"ORDER BY id {'DESC' if descending else 'ASC'} LIMIT ? OFFSET ?")
+        params += [view_params.get('limit', -1), view_params.get('skip', 0)]
+
+        rows = []
+        for row in conn.execute(sql, params):
+            view_row = Row(id=row[0], key=row[0], value=row[0])
+            if view_params.get('include_docs'):
+                view_row['doc'] = _document(row)
+            rows.append(view_row)
+        return ViewResults(rows, total_rows)
+
+    def iter_view(self, view: str, batch_size: int = 1000, design_doc: str = "Monitor",
+                  **view_params) -> Iterator[Row]:
+        """
+        Iterate over the rows of a view, fetching them in pages.
+
+        :param view: name of the view
+        :param batch_size: number of rows to fetch per query. Default: 1000.
+        :param design_doc: name of the design document (default: Monitor)
+        :param view_params: the parameters of the view query
+        :return: iterator over the rows
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        view_params.pop('skip', None)
+        while True:
+            rows = self.view(view, design_doc=design_doc, limit=batch_size + 1, **view_params).rows
+            yield from rows[:batch_size]
+            if len(rows) <= batch_size:
+                return
+            view_params['startkey'] = rows[batch_size].key
+
+    def iter_from_view(self, view: str, batch_size: int = 1000, **view_params) -> Iterator[Document]:
+        """
+        Iterate over the documents of a view, fetching them in pages.
+        """
+        for row in self.iter_view(view, batch_size=batch_size, include_docs=True, **view_params):
+            yield Document(row['doc'])
+
+    def get_from_view(self, view: str, bulk: bool = True, batch_size: int = 1000,
+                      **view_params) -> list[Document]:
+        """
+        Get all documents of a view, fetching them in pages.
+
+        :param view: name of the view
+        :param bulk: not used, documents are always fetched in pages
+        :param batch_size: number of documents to fetch per query. Default: 1000.
+        :param view_params: the parameters of the view query; with limit, at
+          most that many documents are fetched.
+        :return: list of Document objects
+        """
+        limit = view_params.pop('limit', None)
+        docs = self.iter_from_view(view, batch_size=min(batch_size, limit or batch_size), **view_params)
+        return list(islice(docs, limit))
+
+    def get_single_id_from_view(self, view: str, window_size: int = 1, **view_params) -> str:
+        """
+        Get the _id of the first document of a view.
+
+        :raise: IndexError if the view is empty
+        """
+        return self.view(view, limit=1, **view_params).rows[0].id
+
+    def get_single_from_view(self, view: str, window_size: int = 1, **view_params) -> Document:
+        """
+        Get the first document of a view.
+
+        :raise: IndexError if the view is empty
+        """
+        return Document(self.view(view, limit=1, include_docs=True, **view_params).rows[0]['doc'])
+
+    def probe_view(self, view: str, design_doc: str = "Monitor", cache: TTLCache = None,
+                   count_selected: bool = False, **view_params) -> int:
+        """
+        Count the rows of a view; see CouchDB.probe_view.
+
+        :param cache: optional TTLCache to reuse recent results from
+        :param count_selected: count the rows selected by view_params
+        :return: the number of (selected) rows in the view
+        :raise: ValueError: if view_params select rows and count_selected is
+          not set.
+        """
+        selecting = ROW_FILTER_PARAMS.intersection(view_params)
+        if selecting and not count_selected:
+            raise ValueError(f"total_rows of view {view} ignores {', '.join(sorted(selecting))}; "
+                             "set count_selected to count the selected rows")
+        key = json.dumps([self.path, design_doc, view, view_params], sort_keys=True)
+        n_rows = cache.get(key) if cache is not None else None
+        if n_rows is None:
+            if selecting:
+                n_rows = len(self.view(view, design_doc=design_doc, **view_params))
+            else:
+                n_rows = self.view(view, design_doc=design_doc, limit=0).total_rows
+            if cache is not None:
+                cache.put(key, n_rows)
+        return n_rows
+
+    def is_view_nonempty(self, view: str, cache: TTLCache = None, **view_params) -> bool:
+        """
+        Bool: the view has rows; useful for starting pilot jobs automatically.
+        """
+        if ROW_FILTER_PARAMS.intersection(view_params):
+            view_params = dict(view_params, count_selected=True, limit=1)
+        try:
+            return self.probe_view(view, cache=cache, **view_params) > 0
+        except ResourceNotFound:
+            return False
+
+    def status(self, design_doc: str = "Status", cache: TTLCache = None) -> dict[str, int]:
+        """
+        Count the tokens per state.
+
+        :param design_doc: not used, for compatibility with CouchDB.status
+        :param cache: TTLCache to reuse recent counts from. Default:
+          self.status_cache, which reuses counts for 10 seconds.
+        :return: dict with the number of todo, locked, done and error tokens
+        """
+        if cache is None:
+            cache = self.status_cache
+        counts = cache.get(self.path)
+        if counts is None:
+            counts = dict.fromkeys(('todo', 'locked', 'done', 'error'), 0)
+            rows = self._connection().execute(
+                f"SELECT {STATE_SQL} AS state, COUNT(*) FROM documents WHERE type = 'token' GROUP BY state")
+            counts.update((state, count) for state, count in rows if state is not None)
+            cache.put(self.path, counts)
+        # a copy, so callers can not change the cached counts
+        return dict(counts)
+
+    # Claiming
+
+    def _lock_fields(self) -> str:
+        fields = {'lock': seconds(), 'hostname': socket.gethostname()}
+        jobid.add_job_id(fields)
+        return json.dumps(fields)
+
+    def claim_tasks(self, view: str, n_tasks: int = 1, design_doc: str = "Monitor", **view_params) -> list[Task]:
+        """
+        Lock the first n_tasks tasks of a view, with a single atomic UPDATE.
+
+        :param view: name of the view, e.g. todo
+        :param n_tasks: maximum number of tasks to lock. Default: 1.
+        :param design_doc: name of the design document (default: Monitor)
+        :param view_params: key, startkey, endkey and descending select the
+          tasks to lock, as in view.
+        :return: list of locked Tasks
+        :raise: IndexError if the view is empty
+        :raise: ValueError for other view parameters
+        """
+        unsupported = set(view_params) - {'key', 'startkey', 'endkey', 'descending'}
+        if unsupported:
+            raise ValueError(f"SQLiteCouchDB can not claim tasks with view parameters {', '.join(sorted(unsupported))}")
+        conditions, params = _key_range_sql(view_params)
+        conditions = [self._view_condition(design_doc + '/' + view)] + conditions
+        order = 'DESC' if view_params.get('descending', False) else 'ASC'
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f"UPDATE documents SET body = json_patch(body, ?), rev = {NEW_REV_SQL}, seq = ? "
+                f"WHERE id IN (SELECT id FROM documents WHERE {' AND '.join(f'({c})' for c in conditions)} "
+                f"ORDER BY id {order} LIMIT ?) RETURNING id, rev, body",
+                [self._lock_fields(), self._next_seq(conn)] + params + [n_tasks]).fetchall()
+        if not rows:
+            raise IndexError(f"No tasks available in view {view}")
+        return [Task(_document(row)) for row in sorted(rows)]
+
+    def add_claim_handler(self, design_doc: str = "Monitor") -> None:
+        """Claims are always atomic in SQLite, there is no handler to add."""
+
+    def claim(self, id: str, design_doc: str = "Monitor") -> Task:
+        """
+        Lock a task, if it is not locked yet.
+
+        :param id: _id string of the task
+        :return: the locked Task
+        :raise: ResourceConflict: if the task was already locked or deleted
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                f"UPDATE documents SET body = json_patch(body, ?), rev = {NEW_REV_SQL}, seq = ? "
+                "WHERE id = ? AND lock = 0 RETURNING id, rev, body",
+                (self._lock_fields(), self._next_seq(conn), id)).fetchone()
+        if row is None:
+            raise ResourceConflict(('conflict', 'Task is not available to claim.'))
+        return Task(_document(row))
+
+    # Mango queries
+
+    def find(self, selector: dict, limit: int = 25, **query) -> list[Document]:
+        """
+        Get Documents of which the fields have the values in selector.
+
+        :param selector: dict of field values, e.g. TODO_SELECTOR
+        :param limit: maximum number of documents to return. Default: 25.
+        :return: a list of Document objects
+        """
+        condition, params = _selector_sql(selector)
+        rows = self._connection().execute(
+            f'SELECT id, rev, body FROM documents WHERE {condition} ORDER BY id LIMIT ?', params + [limit])
+        return [Document(_document(row)) for row in rows]
+
+    def get_single_id_from_find(self, selector: dict, window_size: int = 1) -> str:
+        """
+        Get the _id of the first document that matches a selector.
+
+        :raise: IndexError: if no document matches the selector.
+        """
+        return self.get_single_from_find(selector).id
+
+    def get_single_from_find(self, selector: dict, window_size: int = 1) -> Document:
+        """
+        Get the first document that matches a selector.
+
+        :raise: IndexError: if no document matches the selector.
+        """
+        return self.find(selector, limit=1)[0]
+
+    def add_index(self, fields: list[str], design_doc: str = "picas", name: str = None) -> None:
+        """The fields of the Monitor views are always indexed."""
+
+    # Changes
+
+    def update_seq(self) -> int:
+        """
+        Get the current update sequence of the database
+
+        :return: sequence, to pass as since to wait_for_changes
+        """
+        return self._connection().execute("SELECT value FROM meta WHERE key = 'update_seq'").fetchone()[0]
+
+    def wait_for_changes(self, since: int, selector: dict = None, timeout: float = 60.,
+                         poll_interval: float = 0.5) -> tuple[bool, int]:
+        """
+        Wait until a document changes, by polling the update sequence.
+
+        :param since: update sequence to wait for changes after
+        :param selector: only wait for documents with these field values
+        :param timeout: maximum number of seconds to wait
+        :param poll_interval: seconds between polls. Default: 0.5.
+        :return: tuple of whether a document changed and the update sequence
+          to wait from next time.
+        """
+        condition, params = _selector_sql(selector)
+        conn = self._connection()
+        deadline = time.monotonic() + timeout
+        while True:
+            last_seq = self.update_seq()
+            if last_seq > since and conn.execute(
+                    f'SELECT 1 FROM documents WHERE seq > ? AND {condition} LIMIT 1', [since] + params).fetchone():
+                return True, last_seq
+            if time.monotonic() >= deadline:
+                return False, last_seq
+            time.sleep(min(poll_interval, max(0., deadline - time.monotonic())))
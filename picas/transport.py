@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+@licence: The MIT License (MIT)
+
+HTTP transport for the CouchDB clients: a keep-alive connection pool with a
+bounded number of idle connections per host, which recycles connections
+after a maximum age, and a thread-safe session that uses it.
+
+A single PooledSession can be shared by several CouchDB clients, and by
+threads, so they reuse each others TCP and TLS connections.
+"""
+
+import threading
+import time
+
+from couchdb import http, util
+
+
+class BoundedConnectionPool(http.ConnectionPool):
+    """
+    HTTP connection pool that keeps at most max_connections idle connections
+    per host alive, and closes connections that are older than max_age
+    seconds instead of reusing them.
+
+    Long-lived connections are the usual cause of SSLEOFError, when the
+    server or a proxy has closed them in the meantime.
+    """
+
+    def __init__(self, timeout, disable_ssl_verification=False, max_connections=10, max_age=300.):
+        """
+        @param timeout: socket timeout in seconds, or None for no timeout.
+        @param disable_ssl_verification: do not verify SSL certificates.
+        @param max_connections: maximum number of idle connections to keep
+                                per host. Default: 10.
+        @param max_age: number of seconds after which a connection is closed
+                        instead of reused, or None to reuse connections
+                        forever. Default: 300.
+        """
+        super().__init__(timeout, disable_ssl_verification=disable_ssl_verification)
+        self.max_connections = max_connections
+        self.max_age = max_age
+
+    def _is_expired(self, conn):
+        """Bool: connection is older than max_age"""
+        return (self.max_age is not None and
+                time.monotonic() - conn.picas_created > self.max_age)
+
+    def _new_connection(self, scheme, host):
+        """Open a new connection to host."""
+        if scheme == 'http':
+            cls = http.HTTPConnection
+        elif scheme == 'https':
+            if self.disable_ssl_verification:
+                cls = http.InsecureHTTPSConnection
+            else:
+                cls = http.HTTPSConnection
+        else:
+            raise ValueError(f'{scheme} is not a supported scheme')
+        conn = cls(host, timeout=self.timeout)
+        conn.connect()
+        return conn
+
+    def get(self, url):
+        """Get an idle connection to the host of url, or open a new one."""
+        scheme, host = util.urlsplit(url, 'http', False)[:2]
+
+        expired = []
+        conn = None
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            while conns and conn is None:
+                conn = conns.pop(-1)
+                if self._is_expired(conn):
+                    expired.append(conn)
+                    conn = None
+
+        for old_conn in expired:
+            old_conn.close()
+
+        if conn is None:
+            conn = self._new_connection(scheme, host)
+            conn.picas_created = time.monotonic()
+
+        return conn
+
+    def release(self, url, conn):
+        """Return a connection to the pool, or close it if it is expired or
+        the pool is full."""
+        scheme, host = util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            if len(conns) < self.max_connections and not self._is_expired(conn):
+                conns.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self.lock:
+            conns = [conn for host_conns in self.conns.values() for conn in host_conns]
+            self.conns = {}
+
+        for conn in conns:
+            conn.close()
+
+
+class LockedCache(http.Cache):
+    """HTTP response cache that can be used from several threads."""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            return super().get(url)
+
+    def put(self, url, response):
+        with self.lock:
+            super().put(url, response)
+
+    def remove(self, url):
+        with self.lock:
+            super().remove(url)
+
+
+class PooledSession(http.Session):
+    """
+    CouchDB HTTP session with a BoundedConnectionPool, that is safe to share
+    between CouchDB clients and threads.
+    """
+
+    def __init__(self, timeout=None, max_connections=10, max_age=300., **session_args):
+        """
+        @param timeout: socket timeout in seconds, or None for no timeout.
+        @param max_connections: maximum number of idle connections to keep
+                                per host. Default: 10.
+        @param max_age: number of seconds after which a connection is
+                        recycled. Default: 300.
+        @param session_args: extra arguments for couchdb.http.Session.
+        """
+        super().__init__(timeout=timeout, **session_args)
+        self.max_connections = max_connections
+        self.max_age = max_age
+        self.cache = LockedCache()
+        self.connection_pool = self._new_pool()
+
+    def _new_pool(self):
+        return BoundedConnectionPool(
+            self._timeout,
+            disable_ssl_verification=self._disable_ssl_verification,
+            max_connections=self.max_connections,
+            max_age=self.max_age)
+
+    def disable_ssl_verification(self):
+        """Disable verification of SSL certificates."""
+        self._disable_ssl_verification = True
+        self.connection_pool = self._new_pool()
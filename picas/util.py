@@ -2,9 +2,16 @@
 @author Joris Borgdorff
 """
 
+import json
+import os
+import tempfile
+import threading
 import time
 from copy import deepcopy
 
+# Number of bytes to send or receive at once when streaming attachments
+CHUNK_SIZE = 64 * 1024
+
 
 def time_elapsed(timer, max=30.):
     """
@@ -45,3 +52,102 @@ class Timer:
         diff = new_t - self.t
         self.t = new_t
         return diff
+
+
+class ViewResults(list):
+    """
+    List of view rows with the properties of couchdb.client.ViewResults, as
+    returned by the view methods of the local backends.
+    """
+
+    def __init__(self, rows, total_rows=None, offset=None):
+        """
+        @param rows: the couchdb.client.Row objects of the view.
+        @param total_rows: number of rows in the whole view, None for
+                           reduced views.
+        @param offset: index of the first row in the whole view.
+        """
+        super().__init__(rows)
+        self.total_rows = total_rows
+        self.offset = offset
+
+    @property
+    def rows(self):
+        return list(self)
+
+
+class TTLCache:
+    """
+    Cache of JSON-serializable values that expire after ttl seconds.
+
+    If a path is given, the cache is also stored in that JSON file, so that
+    short-lived processes such as cron jobs can share results.
+    """
+
+    def __init__(self, ttl=60., path=None):
+        """
+        @param ttl: number of seconds a value stays valid.
+        @param path: JSON file to persist the cache in. Default: None, only
+                     keep the cache in memory.
+        """
+        self.ttl = ttl
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path is not None:
+            self.entries = self._load()
+
+    def _load(self):
+        """Read the entries from disk, ignoring a missing or corrupt file."""
+        try:
+            with open(self.path, 'r') as fobj:
+                entries = json.load(fobj)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _refresh(self):
+        """Merge the entries on disk, keeping the newest value of each key."""
+        if self.path is None:
+            return
+        for key, entry in self._load().items():
+            if key not in self.entries or entry[0] > self.entries[key][0]:
+                self.entries[key] = entry
+
+    def _dump(self):
+        """Write the entries to disk atomically."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fobj:
+                json.dump(self.entries, fobj)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key, default=None):
+        """Get the value of key, or default if it is missing or expired."""
+        with self.lock:
+            self._refresh()
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return default
+            return entry[1]
+
+    def put(self, key, value):
+        """Store value under key."""
+        with self.lock:
+            now = time.time()
+            self._refresh()
+            self.entries = {k: entry for k, entry in self.entries.items() if now - entry[0] <= self.ttl}
+            self.entries[key] = [now, value]
+            if self.path is not None:
+                self._dump()
+
+    def clear(self):
+        """Remove all values."""
+        with self.lock:
+            self.entries = {}
+            if self.path is not None:
+                self._dump()
@@ -1,17 +1,19 @@
+import os
 import pytest
 import signal
 import subprocess
+import threading
 import time
 import unittest
 import ssl
 
 from test_mock import MockDB, MockEmptyDB
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from picas import actors
 from picas.documents import Task
 from picas.actors import RunActor
-from picas.iterators import EndlessViewIterator
+from picas.iterators import EndlessViewIterator, TaskViewIterator
 from couchdb.http import ResourceConflict
 
 
@@ -219,3 +221,490 @@ class TestHandler(unittest.TestCase):
 
         self.assertEqual(self.actor.current_task['lock'], self.lock_code)
         self.assertEqual(self.actor.current_task['done'], self.done_code)
+
+    def test_signal_handling_releases_buffer(self):
+        """
+        Test that tasks buffered by a batch claiming iterator are unlocked by the handler.
+        """
+        self.actor.iterator = TaskViewIterator(self.actor.db, 'view', batch_size=3)
+        next(self.actor.iterator)
+        buffered = list(self.actor.iterator.buffer)
+        self.assertEqual(len(buffered), 2)
+
+        with pytest.raises(SystemExit):
+            self.actor.handler(signal.SIGTERM, None)
+
+        self.assertEqual(len(self.actor.iterator.buffer), 0)
+        for task in buffered:
+            self.assertEqual(self.actor.db.saved[task.id]['lock'], 0)
+
+
+class TestParallelRun(unittest.TestCase):
+
+    def test_run(self):
+        """
+        Test that tasks are processed in parallel slots, each with its own current task.
+        """
+        barrier = threading.Barrier(3, timeout=5)
+        seen = []
+
+        def process_task(task):
+            seen.append(actor.current_task.id == task.id)
+            barrier.wait()  # fails unless the three tasks run at the same time
+            task['exit_code'] = 0
+
+        actor = actors.ParallelRunActor(MockDB(), slots=3)
+        actor.process_task = process_task
+        actor.run()
+        self.assertEqual(actor.tasks_processed, 3)
+        self.assertEqual(sorted(actor.db.saved), ['a', 'b', 'c'])
+        self.assertEqual(seen, [True] * 3)
+        self.assertEqual(actor.current_tasks, {})
+
+    def test_max_tasks(self):
+        actor = actors.ParallelRunActor(MockDB(), slots=2)
+        actor.process_task = lambda task: task.update({'exit_code': 0})
+        actor.run(max_tasks=2)
+        self.assertEqual(actor.tasks_processed, 2)
+        self.assertEqual(len(actor.db.tasks), 1)
+
+    @patch('signal.signal')
+    def test_signal_handling(self, sig):
+        """
+        Test that the handler resets the tasks of all slots in one bulk save.
+        """
+        db = MockDB()
+        actor = actors.ParallelRunActor(db, slots=2, token_reset_values=[2, 2])
+        tasks = [Task({'_id': 'a', 'lock': 1, 'done': 0}), Task({'_id': 'b', 'lock': 1, 'done': 0})]
+        processes = [subprocess.Popen(['sleep', '10']) for _ in tasks]
+        ready = threading.Barrier(3)
+
+        def slot(task, process):
+            actor.current_task = task
+            actor.subprocess = process
+            ready.wait()
+
+        threads = [threading.Thread(target=slot, args=args) for args in zip(tasks, processes)]
+        for thread in threads:
+            thread.start()
+        ready.wait()
+        for thread in threads:
+            thread.join()
+
+        with patch.object(db, 'save_documents', wraps=db.save_documents) as save_documents:
+            with patch('picas.actors.os._exit', side_effect=SystemExit) as os_exit:
+                with pytest.raises(SystemExit):
+                    actor.handler(signal.SIGTERM, None)
+        os_exit.assert_called_once_with(0)
+        save_documents.assert_called_once()
+        self.assertTrue(all(process.poll() is not None for process in processes))
+        self.assertEqual([db.saved[task.id]['lock'] for task in tasks], [2, 2])
+        # a slot that finishes after the handler does not overwrite the reset
+        actor._save_task(Task({'_id': 'a', 'lock': 1, 'done': 1}))
+        self.assertEqual(db.saved['a']['done'], 2)
+
+    @patch('signal.signal')
+    def test_signal_saves_processed_tasks(self, sig):
+        """
+        Test that the handler saves the processed tasks and flushes the logs before it exits.
+        """
+        db = MockDB()
+        actor = actors.ParallelRunActor(db, slots=2, commit_batch_size=10, token_reset_values=[2, 2])
+        actor.process_task = lambda task: task.update({'exit_code': 0})
+        actor._run(Task(db.tasks['a']), timeout=None)
+        running = Task(db.tasks['b'])
+        actor.current_task = running
+        log_handler = Mock(level=0)
+        actors.log.addHandler(log_handler)
+        try:
+            with patch('picas.actors.os._exit', side_effect=SystemExit) as os_exit:
+                with pytest.raises(SystemExit):
+                    actor.handler(signal.SIGTERM, None)
+        finally:
+            actors.log.removeHandler(log_handler)
+        os_exit.assert_called_once_with(0)
+        log_handler.flush.assert_called()
+        self.assertEqual(db.saved['a']['exit_code'], 0)
+        self.assertEqual(db.saved['b']['lock'], 2)
+        # the running task finishes after the handler, its result does not overwrite the reset
+        actor._commit(Task({'_id': 'b', 'lock': 1, 'done': 1, 'exit_code': 0}))
+        actor.flush()
+        self.assertEqual(db.saved['b']['done'], 2)
+        self.assertNotIn('exit_code', db.saved['b'])
+
+    def test_signal_does_not_wait_for_slots(self):
+        """
+        Test that a signal ends the run without waiting for running Python tasks, cleaning up once.
+        """
+        db = MockDB()
+        actor = actors.ParallelRunActor(db, slots=3, token_reset_values=[0, 0])
+        started = threading.Barrier(4, timeout=5)
+        release = threading.Event()
+        finished = []
+
+        def process_task(task):
+            started.wait()
+            # the tasks only finish once the test releases them, after the run ended
+            release.wait(10)
+            finished.append(task.id)
+            task['exit_code'] = 0
+
+        actor.process_task = process_task
+        actor.cleanup_env = Mock()
+        threading.Thread(target=lambda: started.wait() or os.kill(os.getpid(), signal.SIGTERM)).start()
+        previous = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+        try:
+            with patch('picas.actors.os._exit', side_effect=SystemExit):
+                with pytest.raises(SystemExit):
+                    actor.run()
+        finally:
+            signal.signal(signal.SIGTERM, previous[0])
+            signal.signal(signal.SIGINT, previous[1])
+            release.set()
+        self.assertEqual(finished, [])
+        actor.cleanup_env.assert_called_once()
+        self.assertEqual([db.saved[task_id]['lock'] for task_id in 'abc'], [0, 0, 0])
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def _callback(self, task):
+        task['exit_code'] = 0
+
+    def test_run(self):
+        """
+        Test that processed tasks are saved in the background, in order, before run returns.
+        """
+        db = MockDB()
+        save = db.save
+        saved = []
+
+        def slow_save(task):
+            if 'exit_code' in task.value:
+                # a processed task, not a claim
+                time.sleep(0.05)
+                saved.append(task.id)
+            return save(task)
+
+        db.save = slow_save
+        processed = []
+        actor = RunActor(db, write_behind=2)
+        actor.process_task = lambda task: processed.append(task.id) or self._callback(task)
+        actor.run()
+        self.assertEqual(saved, processed)
+        self.assertEqual(len(db.saved), 3)
+        self.assertIsNone(actor._committer)
+
+    @patch('test_mock.MockDB.save')
+    def test_conflict(self, mock_save):
+        """
+        Test that conflicts are handled as without write-behind: the actor continues.
+        """
+        mock_save.side_effect = ResourceConflict
+        actor = ExampleRun(self._callback)
+        actor.write_behind = 1
+        actor.save_retry_policy.sleep = lambda delay: None
+        actor._run(task=Task({'_id': 'c', 'lock': None, 'done': None}), timeout=None)
+        actor.flush()
+        self.assertEqual(actor.tasks_processed, 1)
+
+    @patch('test_mock.MockDB.save')
+    def test_exception(self, mock_save):
+        """
+        Test that an unexpected exception while saving is raised in the actor.
+        """
+        mock_save.side_effect = ValueError
+        actor = ExampleRun(self._callback)
+        actor.write_behind = 1
+        with pytest.raises(ValueError):
+            actor.run()
+
+    def test_signal_handling(self):
+        """
+        Test that the handler saves the processed tasks before resetting the current one.
+        """
+        db = MockDB()
+        actor = RunActor(db, write_behind=5, token_reset_values=[2, 2])
+        actor.process_task = self._callback
+        actor._run(Task(db.tasks['a']), timeout=None)
+        actor.current_task = Task({'_id': 'c', 'lock': 1, 'done': 0})
+        with pytest.raises(SystemExit):
+            actor.handler(signal.SIGTERM, None)
+        self.assertEqual(db.saved['a']['exit_code'], 0)
+        self.assertEqual(db.saved['c']['lock'], 2)
+
+    def test_signal_while_committing(self):
+        """
+        Test that a signal that interrupts the actor while it holds its lock does not deadlock the handler.
+        """
+        db = MockDB()
+        actor = RunActor(db, write_behind=5, token_reset_values=[2, 2])
+        actor.process_task = self._callback
+        actor._run(Task(db.tasks['a']), timeout=None)
+        actor.current_task = Task({'_id': 'c', 'lock': 1, 'done': 0})
+        result = []
+
+        def interrupted():
+            with actor._lock:
+                with pytest.raises(SystemExit):
+                    actor.handler(signal.SIGTERM, None)
+                result.append(True)
+
+        thread = threading.Thread(target=interrupted, daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertEqual(result, [True])
+        self.assertEqual(db.saved['a']['exit_code'], 0)
+        self.assertEqual(db.saved['c']['lock'], 2)
+
+    def test_reconnect_in_committer(self):
+        """
+        Test that a reconnect while saving in the background leaves the client that claims tasks alone.
+        """
+        db, other = MockDB(), MockDB()
+        db.copy = lambda: other
+        save = db.save
+        failed = []
+
+        def flaky_save(task):
+            if 'exit_code' in task.value and not failed:
+                failed.append(task.id)
+                raise ssl.SSLEOFError
+            return save(task)
+
+        db.save = flaky_save
+        actor = RunActor(db, write_behind=5)
+        actor.save_retry_policy.sleep = lambda delay: None
+        actor.process_task = self._callback
+        actor.run()
+        self.assertIs(actor.db, db)
+        self.assertIs(actor.iterator.database, db)
+        self.assertIs(actor.save_db, other)
+        # the task that failed, and the tasks after it, are saved through the new client
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(sorted(other.saved), ['a', 'b', 'c'])
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_run(self):
+        actor = RunActor(MockDB(), prefetch=1)
+        actor.process_task = lambda task: task.update({'exit_code': 0})
+        actor.run()
+        self.assertEqual(actor.tasks_processed, 3)
+
+    def test_release_on_stop(self):
+        """
+        Test that a prefetched task that will not be started is released.
+        """
+        db = MockDB()
+        save = db.save
+        claims = []
+        prefetched = threading.Event()
+
+        def counting_save(task):
+            if 'exit_code' not in task.value and task['lock'] > 0:
+                claims.append(task.id)
+                if len(claims) == 2:
+                    prefetched.set()
+            return save(task)
+
+        def process_task(task):
+            # the next task is prefetched meanwhile
+            self.assertTrue(prefetched.wait(5))
+            task['exit_code'] = 0
+
+        db.save = counting_save
+        actor = RunActor(db, prefetch=1)
+        actor.process_task = process_task
+        actor.run(max_tasks=1)
+        self.assertEqual(actor.tasks_processed, 1)
+        self.assertEqual(sorted(task['lock'] > 0 for task in db.saved.values()), [False, True])
+        self.assertEqual(len(db.tasks), 1)
+
+
+class FakeClock:
+    """
+    Clock that only advances when told to, with a Timer class that reads it.
+    on_timer is called whenever the main thread starts a Timer.
+    """
+
+    def __init__(self):
+        self.now = 0.
+        self.lock = threading.Lock()
+        self.on_timer = None
+        clock = self
+
+        class FakeTimer:
+            def __init__(self):
+                self.t = clock.now
+                if clock.on_timer is not None and threading.current_thread() is threading.main_thread():
+                    clock.on_timer()
+
+            def elapsed(self):
+                return clock.now - self.t
+
+        self.Timer = FakeTimer
+
+    def advance(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+
+class StagingRun(RunActor):
+
+    def __init__(self, db, stage_error=None, **kwargs):
+        super().__init__(db, **kwargs)
+        self.stage_error = stage_error
+        self.staged = []
+
+    def stage_inputs(self, task):
+        if self.stage_error is not None:
+            raise self.stage_error
+        self.staged.append(task.id)
+
+    def process_task(self, task):
+        # the inputs of the task are staged before it is processed
+        assert task.id in self.staged
+        task['exit_code'] = 0
+
+
+class TestStaging(unittest.TestCase):
+
+    def test_stage_ahead(self):
+        """
+        Test that the first task waits for its inputs, and the next ones are staged while it is processed.
+        """
+        db = MockDB()
+        clock = FakeClock()
+        waiting = threading.Event()
+        all_staged = threading.Event()
+        actor = StagingRun(db, stage_ahead=2)
+        stage_inputs, process_task, wait_for_inputs = actor.stage_inputs, actor.process_task, actor._wait_for_inputs
+
+        def slow_stage_inputs(task):
+            if not actor.staged:
+                # the inputs of the first task are not ready when the run starts waiting for them
+                assert waiting.wait(5)
+            # staging takes a second
+            clock.advance(1.)
+            stage_inputs(task)
+            if len(actor.staged) == 3:
+                all_staged.set()
+
+        def first_task_waits(task):
+            if actor.tasks_processed == 0:
+                assert all_staged.wait(5)
+            process_task(task)
+
+        actor.stage_inputs = slow_stage_inputs
+        actor.process_task = first_task_waits
+
+        def wait_for_first_inputs(task):
+            # the timer of the wait starts before the inputs of the first task are ready
+            clock.on_timer = waiting.set
+            wait_for_inputs(task)
+
+        actor._wait_for_inputs = wait_for_first_inputs
+        with patch('picas.actors.Timer', clock.Timer):
+            actor.run()
+        self.assertEqual(actor.tasks_processed, 3)
+        staging = sorted((task['staging'] for task in db.saved.values()), key=lambda staging: staging['overlap'])
+        self.assertTrue(all(s['time'] >= 1. for s in staging))
+        self.assertEqual([s['overlap'] for s in staging], [0., 1., 1.])
+
+    def test_without_stage_ahead(self):
+        db = MockDB()
+        actor = StagingRun(db)
+        actor.process_task = lambda task: task.update({'exit_code': 0})
+        actor.run()
+        self.assertEqual(actor.staged, [])
+        self.assertTrue(all('staging' not in task for task in db.saved.values()))
+
+    def test_stage_error(self):
+        db = MockDB()
+        actor = StagingRun(db, stage_error=IOError("input not found"), stage_ahead=1)
+        actor.run()
+        self.assertEqual(actor.tasks_processed, 3)
+        self.assertTrue(all(task['lock'] == 99 for task in db.saved.values()))
+
+
+class TestBatchedCommits(unittest.TestCase):
+
+    def _callback(self, task):
+        task['exit_code'] = 0
+
+    def test_batch_size(self):
+        """
+        Test that processed tasks are saved in bulk, and the last partial batch before run returns.
+        """
+        db = MockDB()
+        save_documents = db.save_documents
+        batches = []
+        db.save_documents = lambda docs: batches.append([doc.id for doc in docs]) or save_documents(docs)
+        actor = RunActor(db, commit_batch_size=2)
+        actor.process_task = self._callback
+        actor.run()
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 2)
+        self.assertEqual(sorted(db.saved), ['a', 'b', 'c'])
+        self.assertTrue(all(task['exit_code'] == 0 for task in db.saved.values()))
+
+    def test_interval(self):
+        """
+        Test that a batch that does not fill up is saved after commit_interval seconds.
+        """
+        db = MockDB()
+        save = db.save
+        saved = threading.Semaphore(0)
+        saved_before = []
+
+        def signalling_save(task):
+            result = save(task)
+            if 'exit_code' in task.value:
+                saved.release()
+            return result
+
+        def process_task(task):
+            if actor.tasks_processed:
+                # the batch of the previous task is far from full, but saved after the interval
+                self.assertTrue(saved.acquire(timeout=5))
+            saved_before.append(sum('exit_code' in doc for doc in db.saved.values()))
+            task['exit_code'] = 0
+
+        db.save = signalling_save
+        actor = RunActor(db, commit_batch_size=100, commit_interval=0.01)
+        actor.process_task = process_task
+        actor.run()
+        self.assertEqual(saved_before, [0, 1, 2])
+
+    def test_conflict(self):
+        """
+        Test that only the tasks that conflict are saved again, with their current revision.
+        """
+        db = MockDB()
+        save_documents = db.save_documents
+        results = [[False, True]]
+        db.save_documents = lambda docs: results.pop(0) if results else save_documents(docs)
+        actor = RunActor(db, commit_batch_size=2)
+        actor.save_retry_policy.sleep = lambda delay: None
+        tasks = [Task({'_id': 'a', '_rev': 'old', 'exit_code': 0}), Task({'_id': 'b', '_rev': '1', 'exit_code': 0})]
+        actor._save_tasks(tasks)
+        self.assertEqual(list(db.saved), ['a'])
+        self.assertEqual(db.saved['a']['exit_code'], 0)
+
+    def test_signal_handling(self):
+        """
+        Test that the handler saves the batched tasks before resetting the current one.
+        """
+        db = MockDB()
+        actor = RunActor(db, commit_batch_size=10, token_reset_values=[2, 2])
+        actor.process_task = self._callback
+        actor._run(Task(db.tasks['a']), timeout=None)
+        actor._run(Task(db.tasks['b']), timeout=None)
+        actor.current_task = Task({'_id': 'c', 'lock': 1, 'done': 0})
+        with pytest.raises(SystemExit):
+            actor.handler(signal.SIGTERM, None)
+        self.assertEqual(db.saved['a']['exit_code'], 0)
+        self.assertEqual(db.saved['b']['exit_code'], 0)
+        self.assertEqual(db.saved['c']['lock'], 2)
@@ -0,0 +1,93 @@
+import asyncio
+import unittest
+
+from couchdb.http import ResourceConflict
+
+from picas.async_clients import AsyncCouchDB
+from picas.documents import Task
+from test_mock import CouchDBStandIn
+
+
+class TestAsyncCouchDB(unittest.TestCase):
+
+    def setUp(self):
+        self.server = CouchDBStandIn(n_docs=25).__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def run_client(self, coroutine_function, **client_args):
+        async def run():
+            async with AsyncCouchDB(url=self.server.url, db='test', **client_args) as client:
+                return await coroutine_function(client)
+        return asyncio.run(run())
+
+    def test_get_and_save(self):
+        async def get_and_save(client):
+            doc = await client.get('token_00001')
+            doc['lock'] = 1
+            await client.save(doc)
+            with self.assertRaises(ValueError):
+                await client.get('nonexistent')
+            return doc
+
+        doc = self.run_client(get_and_save)
+        self.assertEqual(doc.rev, '2-a')
+        self.assertEqual(self.server.database.docs['token_00001']['lock'], 1)
+
+    def test_save_conflict(self):
+        async def save(client):
+            await client.save(Task({'_id': 'token_00001'}))
+
+        with self.assertRaises(ResourceConflict):
+            self.run_client(save)
+
+    def test_view_and_get_from_view(self):
+        async def get_from_view(client):
+            rows = await client.view('todo', limit=5)
+            docs = await client.get_from_view('todo', batch_size=10)
+            return rows, docs
+
+        rows, docs = self.run_client(get_from_view)
+        self.assertEqual([row.id for row in rows], sorted(self.server.database.docs)[:5])
+        self.assertEqual(len(docs), 25)
+        self.assertEqual(len([r for r in self.server.requests if r[1] == '/test/_all_docs']), 3)
+
+    def test_save_and_delete_documents(self):
+        tasks = [Task({'_id': f'new_{i}', 'type': 'token'}) for i in range(30)]
+
+        async def save_and_delete(client):
+            saved = await client.save_documents(tasks, batch_size=7)
+            count = await client.doc_count()
+            tasks[0]['_rev'] = '0-outdated'
+            deleted = await client.delete_documents(tasks, batch_size=7)
+            return saved, count, deleted
+
+        saved, count, deleted = self.run_client(save_and_delete, max_concurrency=3)
+        self.assertEqual(saved, [True] * 30)
+        self.assertEqual(count, 55)
+        self.assertEqual(deleted, [False] + [True] * 29)
+        self.assertEqual(len(self.server.database.docs), 26)
+
+    def test_delete_documents_without_rev(self):
+        async def delete(client):
+            docs = [await client.get('token_00001'), Task({'_id': 'token_00002'})]
+            return await client.delete_documents(docs)
+
+        self.assertEqual(self.run_client(delete), [True, False])
+        self.assertNotIn('token_00001', self.server.database.docs)
+        self.assertIn('token_00002', self.server.database.docs)
+
+        async def delete_none(client):
+            return await client.delete_documents([Task({'_id': 'token_00003'})])
+
+        self.server.requests.clear()
+        self.assertEqual(self.run_client(delete_none), [False])
+        self.assertFalse([r for r in self.server.requests if r[1] == '/test/_bulk_docs'])
+
+    def test_concurrency(self):
+        async def get_many(client):
+            return await asyncio.gather(*[client.get(f'token_{i:05d}') for i in range(25)])
+
+        docs = self.run_client(get_many, max_concurrency=4)
+        self.assertEqual(len(docs), 25)
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+from picas.benchmark import run_benchmark, compare, baseline_key, load_baselines, save_baselines, main
+
+# baselines of this machine, stored by make benchmark
+BASELINES = os.path.join(os.path.dirname(__file__), os.pardir, '.benchmark_baselines.json')
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_iterator(self):
+        for backend in ('memory', 'sqlite'):
+            result = run_benchmark(backend, 'iterator', workers=4, tasks=200, batch_size=5)
+            self.assertEqual(result['claims'], 200)
+            self.assertEqual(result['duplicates'], 0)
+            self.assertGreater(result['claims_per_sec'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertEqual(result['saves_per_sec'], 0)
+
+    def test_prioritized(self):
+        result = run_benchmark('memory', 'prioritized', workers=2, tasks=100)
+        self.assertEqual(result['claims'], 100)
+        self.assertEqual(result['duplicates'], 0)
+
+    def test_actor(self):
+        result = run_benchmark('memory', 'actor', workers=2, tasks=100, latency=0.001)
+        self.assertEqual(result['claims'], 100)
+        self.assertAlmostEqual(result['saves_per_sec'], result['claims_per_sec'])
+
+    def test_compare(self):
+        baseline = {'claims_per_sec': 1000., 'saves_per_sec': 0., 'p50_ms': 1., 'p99_ms': 10.,
+                    'conflicts_per_claim': 0.}
+        result = dict(baseline, duplicates=0)
+        self.assertEqual(compare(result, baseline), [])
+        result.update(claims_per_sec=400., p99_ms=20., conflicts_per_claim=0.005)
+        regressions = compare(result, baseline, tolerance=0.5)
+        self.assertEqual([r.split()[0] for r in regressions], ['claims_per_sec', 'p99_ms'])
+        self.assertEqual(len(compare(dict(result, duplicates=2), baseline, tolerance=1.)), 1)
+
+    def test_baselines(self):
+        result = run_benchmark('memory', 'iterator', workers=1, tasks=10)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baselines.json')
+            self.assertEqual(load_baselines(path), {})
+            save_baselines(path, [result])
+            self.assertEqual(list(load_baselines(path)), [baseline_key(result)])
+
+    def test_missing_baselines_are_stored(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baselines.json')
+            argv = ['--mode', 'iterator', '--workers', '1', '--tasks', '10', '--baseline', path]
+            self.assertEqual(main(argv), 0)
+            self.assertEqual(list(load_baselines(path)), ['memory/iterator/workers=1/batch_size=1/latency=0.0'])
+
+    @unittest.skipUnless(os.environ.get('PICAS_BENCHMARK'), "set PICAS_BENCHMARK=1 to check the benchmark baselines")
+    @unittest.skipUnless(os.path.exists(BASELINES), "run make benchmark first to store the baselines of this machine")
+    def test_regressions(self):
+        self.assertEqual(main(['--tasks', '1000', '--baseline', BASELINES]), 0)
@@ -0,0 +1,391 @@
+import errno
+import io
+import os
+import socket
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from couchdb.http import Resource, ResourceConflict, ResourceNotFound
+
+from picas.clients import CHUNK_SIZE, TODO_SELECTOR, CouchDB, bucket_of
+from picas.documents import Document
+from picas.iterators import TaskViewIterator
+from picas.transport import PooledSession
+from picas.util import TTLCache
+from test_mock import fake_couchdb
+
+
+class TestGetFromView(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_couchdb(n_docs=25)
+
+    def test_get_from_view_bulk(self):
+        docs = self.client.get_from_view('todo', batch_size=10)
+        self.assertEqual([doc.id for doc in docs], sorted(self.client.db.docs))
+        # one view request and three _all_docs requests, no single GETs
+        self.assertEqual(len(self.client.db.requests), 4)
+        self.assertFalse([r for r in self.client.db.requests if r[0] == 'get'])
+
+    def test_get_from_view_single(self):
+        docs = self.client.get_from_view('todo', bulk=False)
+        self.assertEqual(len(docs), 25)
+        self.assertEqual(len(self.client.db.requests), 26)
+
+    def test_get_documents_missing(self):
+        docs = self.client.get_documents(['token_00001', 'nonexistent', 'token_00002'])
+        self.assertEqual([doc.id for doc in docs], ['token_00001', 'token_00002'])
+        self.assertEqual(docs[0].rev, '1-a')
+
+    def test_get_documents_batch_size(self):
+        with self.assertRaises(ValueError):
+            self.client.get_documents(['token_00001'], batch_size=0)
+
+
+class TestIterView(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_couchdb(n_docs=25)
+
+    def test_iter_view_pages(self):
+        rows = list(self.client.iter_view('todo', batch_size=10))
+        self.assertEqual([row.id for row in rows], sorted(self.client.db.docs))
+        views = [r for r in self.client.db.requests if r[0] == 'view']
+        self.assertEqual(len(views), 3)
+        self.assertTrue(all(r[2]['limit'] == 11 for r in views))
+        self.assertEqual(views[1][2]['startkey_docid'], 'token_00010')
+
+    def test_iter_view_exact_pages(self):
+        rows = list(self.client.iter_view('todo', batch_size=5))
+        self.assertEqual(len(rows), 25)
+
+    def test_iter_from_view(self):
+        docs = list(self.client.iter_from_view('todo', batch_size=7))
+        self.assertEqual(len(docs), 25)
+        self.assertEqual(docs[0]['lock'], 0)
+        self.assertFalse([r for r in self.client.db.requests if r[0] == 'get'])
+
+    def test_iter_view_batch_size(self):
+        with self.assertRaises(ValueError):
+            list(self.client.iter_view('todo', batch_size=0))
+
+
+class TestClaim(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_couchdb(n_docs=3)
+
+    def test_add_claim_handler(self):
+        self.client.add_claim_handler()
+        ddoc = self.client.db.docs['_design/Monitor']
+        self.assertIn('claim', ddoc['updates'])
+        # unchanged handlers are not saved again
+        self.client.add_claim_handler()
+        self.assertEqual(self.client.db.docs['_design/Monitor']['_rev'], ddoc['_rev'])
+
+    def test_claim(self):
+        self.client.add_claim_handler()
+        task = self.client.claim('token_00001')
+        self.assertTrue(task['lock'] > 0)
+        self.assertEqual(task.rev, '2-a')
+        self.assertEqual(self.client.db.docs['token_00001']['lock'], task['lock'])
+
+        with self.assertRaises(ResourceConflict):
+            self.client.claim('token_00001')
+
+    def test_claim_missing_handler(self):
+        with self.assertRaises(ResourceNotFound):
+            self.client.claim('token_00001')
+        n_requests = len(self.client.db.requests)
+        with self.assertRaises(ResourceNotFound):
+            self.client.claim('token_00001')
+        self.assertEqual(len(self.client.db.requests), n_requests)
+
+    def test_iterator_claim_handler(self):
+        self.client.add_claim_handler()
+        self.client.db.requests = []
+        task = next(TaskViewIterator(self.client, 'todo', claim_handler='Monitor'))
+        self.assertTrue(task['lock'] > 0)
+        self.assertEqual([r[0] for r in self.client.db.requests], ['view', 'update_doc'])
+
+    def test_iterator_claim_handler_fallback(self):
+        tasks = list(TaskViewIterator(self.client, 'todo', claim_handler='Monitor'))
+        self.assertEqual(len(tasks), 3)
+        self.assertTrue(all(task['lock'] > 0 for task in tasks))
+
+
+class TestFind(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_couchdb(n_docs=5)
+
+    def test_find(self):
+        docs = self.client.find(TODO_SELECTOR, limit=3)
+        self.assertEqual([doc.id for doc in docs], ['token_00000', 'token_00001', 'token_00002'])
+        self.assertIsInstance(docs[0], Document)
+
+        with self.assertRaises(IndexError):
+            self.client.get_single_from_find({'lock': 1})
+
+    def test_add_index(self):
+        self.client.add_index(['type', 'lock', 'done'])
+        self.assertEqual(len(self.client.db.mango_indexes), 1)
+        # an index on the same fields is not created twice
+        self.client.add_index(['type', 'lock', 'done'])
+        self.assertEqual(len(self.client.db.mango_indexes), 1)
+
+    def test_iterator_selector(self):
+        self.client.db.requests = []
+        tasks = list(TaskViewIterator(self.client, None, selector=TODO_SELECTOR))
+        self.assertEqual(len(tasks), 5)
+        self.assertTrue(all(task['lock'] > 0 for task in tasks))
+        self.assertEqual(len(self.client.db.mango_indexes), 1)
+        # only the _ids of the candidates are found, and only claimed tasks are fetched
+        self.assertFalse([r for r in self.client.db.requests if r[0] == 'view'])
+        finds = [r[1] for r in self.client.db.requests if r[0] == 'find']
+        self.assertTrue(finds)
+        self.assertTrue(all(mango['fields'] == ['_id'] for mango in finds))
+        self.assertEqual(len([r for r in self.client.db.requests if r[0] == 'get']), 5)
+
+    def test_get_single_id_from_find(self):
+        self.client.db.requests = []
+        doc_id = self.client.get_single_id_from_find(TODO_SELECTOR, window_size=3)
+        self.assertIn(doc_id, ['token_00000', 'token_00001', 'token_00002'])
+        self.assertEqual(self.client.db.requests[-1][1]['fields'], ['_id'])
+
+    def test_iterator_selector_batch(self):
+        tasks = list(TaskViewIterator(self.client, None, batch_size=2, selector=TODO_SELECTOR))
+        self.assertEqual(len(tasks), 5)
+        self.assertEqual(len([r for r in self.client.db.requests if r[0] == 'update']), 3)
+
+
+class TestProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_couchdb(n_docs=5)
+
+    def test_probe_view(self):
+        self.assertEqual(self.client.probe_view('todo'), 5)
+        self.assertEqual(self.client.probe_view('locked'), 0)
+        self.assertEqual(self.client.db.requests[-1], ('view', 'Monitor/locked', {'limit': 1, 'reduce': False}))
+        self.assertFalse([r for r in self.client.db.requests if r[0] == 'get'])
+
+    def test_probe_view_filtered(self):
+        # total_rows ignores the key range, so counting the selected rows is opt-in
+        with self.assertRaises(ValueError):
+            self.client.probe_view('todo', startkey='token_00003')
+        self.assertEqual(self.client.probe_view('todo', count_selected=True, startkey='token_00003'), 2)
+
+    def test_is_view_nonempty_filtered(self):
+        self.client.db.requests = []
+        self.assertTrue(self.client.is_view_nonempty('todo', startkey='token_00003'))
+        self.assertEqual(self.client.db.requests, [('view', 'Monitor/todo', {'startkey': 'token_00003', 'limit': 1, 'reduce': False})])
+        self.assertFalse(self.client.is_view_nonempty('todo', startkey='token_00009'))
+
+    def test_is_view_nonempty(self):
+        self.assertTrue(self.client.is_view_nonempty('todo'))
+        self.assertFalse(self.client.is_view_nonempty('locked'))
+
+    def test_probe_view_cache(self):
+        cache = TTLCache(ttl=60)
+        self.assertTrue(self.client.is_view_nonempty('todo', cache=cache))
+        self.assertTrue(self.client.is_view_nonempty('todo', cache=cache))
+        self.assertFalse(self.client.is_view_nonempty('locked', cache=cache))
+        self.assertEqual(len(self.client.db.requests), 2)
+
+
+class TestStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_couchdb(n_docs=5)
+
+    def test_status(self):
+        docs = self.client.db.docs
+        docs['token_00001'].update(lock=1)
+        docs['token_00002'].update(lock=1, done=2, exit_code=0)
+        docs['token_00003'].update(lock=1, done=2, exit_code=1)
+        self.assertEqual(self.client.status(), {'todo': 2, 'locked': 1, 'done': 1, 'error': 1})
+        self.assertEqual(docs['_design/Status']['views']['status']['reduce'], '_count')
+
+    def test_status_cache(self):
+        self.assertEqual(self.client.status()['todo'], 5)
+        self.client.db.save(dict(self.client.db.docs['token_00001'], lock=1))
+        n_requests = len(self.client.db.requests)
+        # the cached counts are returned without a request
+        self.assertEqual(self.client.status()['todo'], 5)
+        self.assertEqual(len(self.client.db.requests), n_requests)
+        self.assertEqual(self.client.status(cache=TTLCache(ttl=0))['todo'], 4)
+
+    def test_status_cache_copy(self):
+        self.client.status()['todo'] = 0
+        # changing a result does not change the cached counts
+        self.assertEqual(self.client.status()['todo'], 5)
+
+
+class TestBuckets(unittest.TestCase):
+
+    def test_bucket_of(self):
+        # same buckets as the hash in BUCKETED_TODO_VIEW_CODE, evaluated by a JavaScript engine
+        ids = ['token_0', 'abc', '\u00e9\U0001f600x', 'a_rather_long_token_identifier_12345678']
+        self.assertEqual([bucket_of(doc_id, 7) for doc_id in ids], [6, 6, 5, 4])
+
+    def test_bucket_of_double_arithmetic(self):
+        # the view computes the hash with doubles, without Math.imul, which old couchjs builds lack
+        def js_hash(doc_id):
+            units = doc_id.encode('utf-16-be')
+            hash_value = 0.
+            for i in range(0, len(units), 2):
+                hash_value = (hash_value * 31 + (units[i] << 8 | units[i + 1])) % 4294967296.
+            return hash_value
+
+        for doc_id in ['token_0', '\uffff' * 50, 'a_rather_long_token_identifier_12345678']:
+            self.assertEqual(js_hash(doc_id) % 13, bucket_of(doc_id, 13))
+
+    def test_add_bucketed_view(self):
+        client = fake_couchdb()
+        client.add_bucketed_view(n_buckets=8)
+        view = client.db.docs['_design/Monitor']['views']['todo_bucketed']
+        self.assertIn('emit([hash % 8, doc._id], doc._id);', view['map'])
+        self.assertNotIn('Math.imul', view['map'])
+        with self.assertRaises(ValueError):
+            client.add_bucketed_view(n_buckets=0)
+
+
+class TestAttachment(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_couchdb(n_docs=1)
+        self.doc = Document(self.client.get('token_00000'))
+
+    def break_first_upload(self):
+        """Let the first upload fail with a connection reset after part of the content is sent."""
+        put_attachment = self.client.db.put_attachment
+        attempts = []
+
+        def flaky_put_attachment(doc, content, **kwargs):
+            attempts.append(doc['_rev'])
+            if len(attempts) == 1:
+                content.read()
+                raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+            return put_attachment(doc, content, **kwargs)
+
+        self.client.db.put_attachment = flaky_put_attachment
+        return attempts
+
+    def test_put_attachment_file(self):
+        data = os.urandom(200000)
+        self.client.put_attachment(self.doc, 'out.bin', io.BytesIO(data), content_type='application/octet-stream')
+        self.assertEqual(self.client.db.attachments['token_00000']['out.bin'], data)
+        self.assertEqual(self.doc.rev, '2-a')
+        stub = self.doc['_attachments']['out.bin']
+        self.assertEqual((stub['content_type'], stub['length'], stub['stub']), ('application/octet-stream', len(data), True))
+        # the document stays saveable, without the attachment data
+        self.client.save(self.doc)
+        self.assertEqual(self.doc.rev, '3-a')
+
+    def test_put_attachment_path(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'log.txt')
+            with open(path, 'w') as fobj:
+                fobj.write('hello\n')
+            self.client.put_attachment(self.doc, 'log.txt', path)
+        self.assertEqual(self.client.db.attachments['token_00000']['log.txt'], b'hello\n')
+        self.assertEqual(self.doc['_attachments']['log.txt']['content_type'], 'text/plain')
+
+    def test_put_attachment_iterator(self):
+        self.client.put_attachment(self.doc, 'out.log', (f'line {i}\n' for i in range(3)))
+        self.assertEqual(self.client.db.attachments['token_00000']['out.log'], b'line 0\nline 1\nline 2\n')
+        self.assertEqual(self.doc['_attachments']['out.log']['length'], 21)
+
+    def test_put_attachment_retry_file(self):
+        """Test that a file is sent again from the start after a connection error."""
+        attempts = self.break_first_upload()
+        data = os.urandom(3 * CHUNK_SIZE)
+        self.client.put_attachment(self.doc, 'out.bin', io.BytesIO(data))
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.client.db.attachments['token_00000']['out.bin'], data)
+        self.assertEqual(self.doc['_attachments']['out.bin']['length'], len(data))
+
+    def test_put_attachment_no_retry_iterator(self):
+        """Test that chunks that cannot be read again are not sent again."""
+        attempts = self.break_first_upload()
+        with self.assertRaises(socket.error):
+            self.client.put_attachment(self.doc, 'out.log', iter([b'0123456789', b'abc']))
+        self.assertEqual(len(attempts), 1)
+        self.assertNotIn('token_00000', self.client.db.attachments)
+        self.assertEqual(self.doc.rev, '1-a')
+
+    def test_put_attachment_stub_from_server(self):
+        """Test that an attachment that the server stored incompletely is reported."""
+        put_attachment = self.client.db.put_attachment
+
+        def truncating_put_attachment(doc, content, **kwargs):
+            content.read(CHUNK_SIZE)
+            return put_attachment(doc, content, **kwargs)
+
+        self.client.db.put_attachment = truncating_put_attachment
+        with self.assertRaises(IOError):
+            self.client.put_attachment(self.doc, 'out.bin', io.BytesIO(os.urandom(2 * CHUNK_SIZE)))
+
+    def test_attachment_database(self):
+        """Test that attachments are uploaded on a session without retries, with the same credentials."""
+        client = fake_couchdb()
+        client.db.resource = Resource('http://localhost:5984/test', PooledSession())
+        client.db.resource.credentials = ('user', 'secret')
+        database = CouchDB._attachment_database(client)
+        self.assertEqual(database.resource.url, 'http://localhost:5984/test')
+        self.assertEqual(database.resource.credentials, ('user', 'secret'))
+        self.assertEqual(database.resource.session.retryable_errors, frozenset())
+        self.assertIsNot(database.resource.session, client.db.resource.session)
+
+    def test_put_attachment_conflict(self):
+        self.doc['_rev'] = '0-b'
+        with self.assertRaises(ResourceConflict):
+            self.client.put_attachment(self.doc, 'out.log', [b'data'])
+
+
+class TestCopy(unittest.TestCase):
+
+    def test_copy_shares_session(self):
+        client = fake_couchdb()
+        client.db.resource = Resource('http://localhost:5984/test', PooledSession())
+        client.db.resource.credentials = ('user', 'secret')
+        with patch('picas.clients.couchdb.Server') as server:
+            client.copy()
+        server.assert_called_once_with('http://localhost:5984', session=client.db.resource.session)
+
+    def test_shared_session_ssl_verification(self):
+        session = PooledSession()
+        with patch('picas.clients.couchdb.Server'), self.assertRaises(ValueError):
+            CouchDB(ssl_verification=False, session=session)
+        self.assertFalse(session._disable_ssl_verification)
+
+        with patch('picas.clients.couchdb.Server') as server:
+            CouchDB(ssl_verification=False)
+        self.assertTrue(server.call_args[1]['session']._disable_ssl_verification)
+
+
+class TestDelete(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_couchdb(n_docs=25)
+
+    def test_delete_documents(self):
+        docs = self.client.get_documents(['token_00000', 'token_00001', 'token_00002'])
+        docs[1]['_rev'] = '0-outdated'
+        docs.append(Document({'_id': 'token_00003'}))
+
+        with self.assertLogs('PiCaS', level='INFO') as logs:
+            result = self.client.delete_documents(docs, batch_size=2)
+
+        self.assertEqual(result, [True, False, True, False])
+        self.assertEqual(sorted(self.client.db.docs)[:2], ['token_00001', 'token_00003'])
+        self.assertEqual(len([r for r in self.client.db.requests if r[0] == 'update']), 2)
+        self.assertTrue(any('resource conflict' in line for line in logs.output))
+        self.assertTrue(any('Deleted 2 of 4 documents, 2 failed' in line for line in logs.output))
+
+    def test_delete_from_view(self):
+        result = self.client.delete_from_view('todo', batch_size=10)
+        self.assertEqual(result, [True] * 25)
+        self.assertEqual(self.client.db.docs, {})
@@ -3,10 +3,13 @@
 """
 
 import base64
+import hashlib
+import io
 import unittest
 
 from picas.documents import Document, Task
 from picas.util import seconds
+from test_mock import fake_couchdb
 
 
 test_id = 'mydoc'
@@ -55,6 +58,35 @@ class TestTask(unittest.TestCase):
         attach = doc.get_attachment(jsonfile)
         self.assertEqual(attach['content_type'], 'application/json')
 
+    def test_stream_attachment(self):
+        doc = Document()
+        data = b"This is it" * 1000
+        doc.put_attachment("mytest.txt", data)
+        buffer = io.BytesIO()
+        info = doc.stream_attachment("mytest.txt", buffer, chunk_size=1024)
+        self.assertEqual(buffer.getvalue(), data)
+        self.assertEqual(info, {'content_type': 'text/plain', 'length': len(data),
+                                'digest': 'md5-' + base64.b64encode(hashlib.md5(data).digest()).decode()})
+        with self.assertRaises(KeyError):
+            doc.stream_attachment("missing.txt", buffer)
+
+    def test_stream_attachment_from_database(self):
+        client = fake_couchdb(n_docs=1)
+        doc = Document(client.get('token_00000'))
+        data = bytes(range(256)) * 1000
+        client.put_attachment(doc, 'out.bin', io.BytesIO(data), content_type='application/octet-stream')
+        before = dict(doc['_attachments']['out.bin'])
+
+        buffer = io.BytesIO()
+        info = doc.stream_attachment('out.bin', buffer, retrieve_from_database=client)
+        self.assertEqual(buffer.getvalue(), data)
+        self.assertEqual(info['length'], len(data))
+        self.assertEqual(info['content_type'], 'application/octet-stream')
+        # the document is not modified
+        self.assertEqual(doc['_attachments']['out.bin'], before)
+        with self.assertRaises(KeyError):
+            doc.stream_attachment('missing.bin', buffer, retrieve_from_database=client)
+
     def test_id(self):
         self.assertEqual(self.task.id, test_id)
         self.assertEqual(self.task.value['_id'], test_id)
@@ -74,6 +106,13 @@ class TestTask(unittest.TestCase):
         self.task.lock()
         self.assertTrue(self.task['lock'] >= seconds() - 1)
 
+    def test_unlock(self):
+        self.task.lock()
+        self.task.unlock()
+        self.assertEqual(self.task['lock'], 0)
+        self.assertEqual(self.task['done'], 0)
+        self.assertEqual(self.task['scrub_count'], 0)
+
     def test_scrub(self):
         self.task.lock()
         self.task.done()
@@ -1,7 +1,14 @@
+import threading
+import time
 import unittest
 
-from picas.iterators import TaskViewIterator, EndlessViewIterator
-from test_mock import MockDB
+from couchdb.http import ResourceConflict
+
+from picas.documents import Task
+from picas.iterators import MIN_CHANGES_TIMEOUT, ClaimWindow, TaskViewIterator, EndlessViewIterator, PrefetchIterator, ViewIterator
+from picas.retry import RetryPolicy
+from picas.util import Timer, time_elapsed
+from test_mock import MockDB, fake_couchdb
 
 
 class TestTask(unittest.TestCase):
@@ -30,3 +37,223 @@ class TestTask(unittest.TestCase):
 
         self.assertEqual(len(self.db.saved), self.stop_value)
         self.assertEqual(len(self.db.TASKS), 3)
+
+    def test_taskviewiterator_batch(self):
+        self.db = MockDB()
+        iterator = TaskViewIterator(self.db, 'view', batch_size=2)
+        task = next(iterator)
+        self.assertTrue(task['lock'] > 0)
+        # two tasks were locked at once, one is kept in the buffer
+        self.assertEqual(len(self.db.saved), 2)
+        self.assertEqual(len(iterator.buffer), 1)
+        buffered = iterator.buffer[0]
+
+        iterator.release()
+        self.assertEqual(len(iterator.buffer), 0)
+        self.assertEqual(self.db.saved[buffered.id]['lock'], 0)
+        self.assertEqual(self.db.saved[task.id], task.value)
+
+    def test_taskviewiterator_batch_all(self):
+        self.db = MockDB()
+        tasks = list(TaskViewIterator(self.db, 'view', batch_size=2))
+        self.assertEqual(len(tasks), len(MockDB.TASKS))
+        self.assertTrue(all(task['lock'] > 0 for task in tasks))
+
+    def test_taskviewiterator_skips_locked(self):
+        # tasks that were claimed by another client after the view was queried
+        self.db = MockDB()
+        self.db.tasks['a']['lock'] = 1
+        self.db.tasks['b']['lock'] = 1
+        policy = RetryPolicy(max_attempts=3, retry_on=(ResourceConflict,), sleep=lambda delay: None)
+        iterator = TaskViewIterator(self.db, 'view', batch_size=3, retry_policy=policy)
+        self.assertEqual(next(iterator).id, 'c')
+        self.assertEqual(len(iterator.buffer), 0)
+        with self.assertRaises(EnvironmentError):
+            next(TaskViewIterator(self.db, 'view', retry_policy=policy))
+        self.assertEqual(list(self.db.saved), ['c'])
+
+
+class TestClaimWindow(unittest.TestCase):
+
+    def test_adapt(self):
+        window = ClaimWindow(size=10, min_size=5, max_size=100)
+        for _ in range(5):
+            window.record(conflict=True)
+        self.assertEqual(window.size, 100)
+        for _ in range(50):
+            window.record(conflict=False)
+        self.assertEqual(window.size, 5)
+
+        # never larger than the view
+        window.view_size = 20
+        for _ in range(5):
+            window.record(conflict=True)
+        self.assertEqual(window.size, 20)
+
+    def test_candidates(self):
+        db = MockDB()
+        db.tasks['a']['lock'] = 1
+        db.tasks['b']['lock'] = 1
+        queries = []
+        view = db.view
+        db.view = lambda *args, **kwargs: queries.append(kwargs) or view(*args, **kwargs)
+
+        iterator = TaskViewIterator(db, 'view', window_size=3)
+        # conflicts move on to the next candidate of the same window
+        self.assertEqual(next(iterator).id, 'c')
+        self.assertEqual(queries, [{'limit': 3}])
+        self.assertEqual(iterator.window.view_size, 3)
+
+    def test_buckets(self):
+        queries = []
+
+        def fetch(**params):
+            queries.append(params)
+            return [] if 'startkey' in params else ['row']
+
+        self.assertEqual(ClaimWindow(buckets=4, bucket=6).query(fetch, skip=0), ['row'])
+        # nothing from bucket 2 on, so the rows start at the first bucket
+        self.assertEqual(queries, [{'startkey': [2], 'skip': 0}, {'skip': 0}])
+        with self.assertRaises(ValueError):
+            ClaimWindow(bucket=1)
+
+    def test_sizes(self):
+        with self.assertRaises(ValueError):
+            ClaimWindow(size=5, min_size=10)
+
+
+class ListIterator(ViewIterator):
+    """Iterator that hands out the tasks of a list, locking each one."""
+
+    def __init__(self, tasks, error=None):
+        super().__init__()
+        self.tasks = list(tasks)
+        self.error = error
+        self.claimed = 0
+
+    def claim_task(self):
+        if not self.tasks and self.error is not None:
+            raise self.error
+        task = self.tasks.pop(0)
+        self.claimed += 1
+        return task.lock()
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def wait_for(self, condition):
+        timer = Timer()
+        while not condition() and timer.elapsed() < 5:
+            time.sleep(0.01)
+
+    def test_prefetch(self):
+        db = MockDB()
+        inner = ListIterator(Task({'_id': f't{i}'}) for i in range(10))
+        iterator = PrefetchIterator(inner, db, depth=2)
+        self.assertEqual(next(iterator).id, 't0')
+        # the next two tasks are claimed in the background
+        self.wait_for(lambda: inner.claimed == 3)
+        time.sleep(0.05)
+        self.assertEqual(inner.claimed, 3)
+        self.assertEqual(next(iterator).id, 't1')
+        self.wait_for(lambda: inner.claimed == 4)
+
+        iterator.release()
+        self.assertEqual([db.saved[task_id]['lock'] for task_id in db.saved], [0, 0])
+        self.assertEqual(sorted(db.saved), ['t2', 't3'])
+
+    def test_release_during_batch_claim(self):
+        """
+        Test that all tasks of a batch claim that is in progress on release are unlocked.
+        """
+        db = MockDB()
+        db.tasks = {f't{i}': {'_id': f't{i}', '_rev': '1', 'lock': 0} for i in range(6)}
+        get_from_view = db.get_from_view
+        claiming = threading.Event()
+
+        def slow_get_from_view(*args, **kwargs):
+            if len(db.saved) == 2:
+                claiming.set()
+                time.sleep(0.1)
+            return get_from_view(*args, **kwargs)
+
+        db.get_from_view = slow_get_from_view
+        iterator = PrefetchIterator(TaskViewIterator(db, 'todo', batch_size=2), db)
+        self.assertEqual([next(iterator).id, next(iterator).id], ['t0', 't1'])
+        self.assertTrue(claiming.wait(5))
+        iterator.release()
+        self.assertEqual({task_id: bool(doc['lock']) for task_id, doc in db.saved.items()},
+                         {'t0': True, 't1': True, 't2': False, 't3': False})
+
+    def test_end(self):
+        iterator = PrefetchIterator(ListIterator([Task({'_id': 'a'})]), MockDB(), depth=3)
+        self.assertEqual([task.id for task in iterator], ['a'])
+        self.assertTrue(iterator.is_stopped())
+
+    def test_on_claim(self):
+        claimed = []
+        iterator = PrefetchIterator(ListIterator(Task({'_id': f't{i}'}) for i in range(3)), MockDB(),
+                                    on_claim=lambda task: claimed.append(task.id))
+        self.assertEqual([task.id for task in iterator], ['t0', 't1', 't2'])
+        self.assertEqual(claimed, ['t0', 't1', 't2'])
+
+    def test_error(self):
+        iterator = PrefetchIterator(ListIterator([Task({'_id': 'a'})], error=EnvironmentError("Unable to claim task.")),
+                                    MockDB())
+        next(iterator)
+        with self.assertRaises(EnvironmentError):
+            next(iterator)
+
+
+class TestChangesFeed(unittest.TestCase):
+
+    def test_endlessviewiterator_changes_feed(self):
+        client = fake_couchdb()
+        self.tasks = []
+
+        def push_token():
+            time.sleep(0.3)
+            client.save_documents([Task({'_id': 'token_late', 'type': 'token'})])
+
+        def stop():
+            return len(self.tasks) == 1
+
+        thread = threading.Thread(target=push_token)
+        thread.start()
+        start = time.time()
+        iterator = EndlessViewIterator(TaskViewIterator(client, 'todo'), sleep_sec=10,
+                                       use_changes_feed=True, stop_callback=stop)
+        for task in iterator:
+            self.tasks.append(task)
+        thread.join()
+
+        # woken up by the new token, long before sleep_sec
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.tasks[0].id, 'token_late')
+        self.assertTrue(self.tasks[0]['lock'] > 0)
+        # one view query before waiting on the changes feed and one after
+        self.assertEqual(len([r for r in client.db.requests if r[0] == 'view']), 2)
+
+    def test_endlessviewiterator_changes_feed_min_timeout(self):
+        client = fake_couchdb()
+        timeouts = []
+
+        def wait_for_changes(since, selector, timeout):
+            timeouts.append(timeout)
+            iterator.stop()
+            return False, since
+
+        client.wait_for_changes = wait_for_changes
+        iterator = EndlessViewIterator(TaskViewIterator(client, 'todo'), sleep_sec=0, use_changes_feed=True)
+        self.assertEqual(list(iterator), [])
+        # a sleep_sec of 0 does not poll the changes feed in a busy loop
+        self.assertEqual(timeouts, [MIN_CHANGES_TIMEOUT])
+
+    def test_endlessviewiterator_changes_feed_ignores_locked(self):
+        client = fake_couchdb()
+        client.save_documents([Task({'_id': 'token_locked', 'type': 'token', 'lock': 1})])
+        iterator = EndlessViewIterator(TaskViewIterator(client, 'todo'), sleep_sec=0.2,
+                                       use_changes_feed=True, stop_callback=time_elapsed,
+                                       timer=Timer(), max=0.5)
+        self.assertEqual(list(iterator), [])
+        self.assertEqual(len([r for r in client.db.requests if r[0] == 'view']), 1)
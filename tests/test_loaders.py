@@ -0,0 +1,66 @@
+import socket
+import unittest
+
+from picas.documents import Task
+from picas.loaders import BulkLoader
+from picas.retry import RetryPolicy
+from test_mock import fake_couchdb
+
+
+def tasks(n, start=0):
+    for i in range(start, start + n):
+        yield Task({'_id': f'task_{i:05d}', 'input': i})
+
+
+class TestBulkLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_couchdb()
+
+    def test_load(self):
+        loader = BulkLoader(self.client, chunk_size=7, workers=3)
+        results = list(loader.load(tasks(50)))
+        self.assertEqual([doc.id for doc, _ in results], [task.id for task in tasks(50)])
+        self.assertTrue(all(saved for _, saved in results))
+        self.assertTrue(all(doc.rev == '1-a' for doc, _ in results))
+        self.assertEqual(len(self.client.db.docs), 50)
+        self.assertEqual([r for r in self.client.db.requests if r[0] == 'update'],
+                         [('update', 7)] * 7 + [('update', 1)])
+        self.assertEqual((loader.saved, loader.failed), (50, 0))
+        self.assertGreater(loader.throughput, 0)
+
+    def test_load_conflicts(self):
+        BulkLoader(self.client, chunk_size=10).load_all(tasks(10))
+        saved, failed = BulkLoader(self.client, chunk_size=10).load_all(tasks(20, start=5))
+        self.assertEqual((saved, failed), (15, 5))
+
+    def test_lazy(self):
+        consumed = []
+
+        def generate():
+            for task in tasks(1000):
+                consumed.append(task)
+                yield task
+
+        loader = BulkLoader(self.client, chunk_size=10, workers=2)
+        next(loader.load(generate()))
+        # only the chunks in flight are read from the input
+        self.assertLessEqual(len(consumed), 10 * 2 * 2 + 10)
+
+    def test_retry_chunk(self):
+        save_documents = self.client.save_documents
+        failures = [socket.error('connection reset')]
+
+        def flaky_save(docs):
+            if failures:
+                raise failures.pop()
+            return save_documents(docs)
+
+        self.client.save_documents = flaky_save
+        policy = RetryPolicy(max_attempts=2, retry_on=(socket.error,), sleep=lambda delay: None)
+        loader = BulkLoader(self.client, chunk_size=5, workers=1, retry_policy=policy)
+        self.assertEqual(loader.load_all(tasks(10)), (10, 0))
+
+    def test_chunk_size(self):
+        with self.assertRaises(ValueError):
+            BulkLoader(self.client, chunk_size=0)
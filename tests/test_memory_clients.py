@@ -0,0 +1,213 @@
+import io
+import threading
+import unittest
+from itertools import islice
+
+from couchdb.http import ResourceConflict, ResourceNotFound
+
+from picas.actors import RunActor
+from picas.benchmark import BenchmarkStats, InstrumentedClient
+from picas.clients import TODO_SELECTOR, bucket_of
+from picas.documents import Document, Task
+from picas.iterators import TaskViewIterator, EndlessViewIterator
+from picas.loaders import BulkLoader
+from picas.memory_clients import MemoryCouchDB, UnsupportedOperation
+
+
+def tokens(n):
+    for i in range(n):
+        yield Task({'_id': f'token_{i:05d}', 'type': 'token', 'input': i})
+
+
+class CountingActor(RunActor):
+
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        self.processed = []
+
+    def process_task(self, task):
+        self.processed.append(task.id)
+        task['exit_code'] = 0
+        task.done()
+
+
+class TestMemoryDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MemoryCouchDB()
+
+    def test_revisions(self):
+        doc = self.client.save(Document({'_id': 'a', 'value': 1}))
+        self.assertTrue(doc.rev.startswith('1-'))
+        stale = Document(dict(doc.value))
+        self.client.save(doc)
+        self.assertTrue(doc.rev.startswith('2-'))
+        with self.assertRaises(ResourceConflict):
+            self.client.save(stale)
+        with self.assertRaises(ResourceConflict):
+            self.client.save(Document({'_id': 'a'}))
+        self.assertEqual(self.client.save_documents([stale, Document({'_id': 'b'})]), [False, True])
+
+        self.client.delete(doc)
+        with self.assertRaises(ValueError):
+            self.client.get('a')
+        self.assertEqual(self.client.doc_count(), 1)
+
+    def test_stored_documents_are_copies(self):
+        doc = self.client.save(Document({'_id': 'a', 'value': [1]}))
+        doc['value'].append(2)
+        self.assertEqual(self.client.get('a')['value'], [1])
+
+    def test_views(self):
+        BulkLoader(self.client, chunk_size=10).load_all(tokens(25))
+        self.assertEqual(len(self.client.get_from_view('todo')), 25)
+        self.assertEqual([row.id for row in self.client.iter_view('todo', batch_size=10)],
+                         [f'token_{i:05d}' for i in range(25)])
+        rows = self.client.view('todo', startkey='token_00010', endkey='token_00012').rows
+        self.assertEqual([row.key for row in rows], ['token_00010', 'token_00011', 'token_00012'])
+        rows = self.client.view('todo', descending=True, limit=2).rows
+        self.assertEqual([row.key for row in rows], ['token_00024', 'token_00023'])
+        self.assertEqual(self.client.probe_view('todo'), 25)
+        self.assertEqual(self.client.probe_view('todo', count_selected=True, key='token_00007'), 1)
+        self.assertTrue(self.client.is_view_nonempty('todo', key='token_00007'))
+        # the rows of a reduce view are counted before they are reduced
+        self.assertEqual(self.client.probe_view('status', design_doc='Status'), 25)
+        self.assertEqual(self.client.probe_view('locked'), 0)
+
+        with self.assertRaises(ResourceNotFound):
+            self.client.view('missing')
+
+    def test_python_view(self):
+        BulkLoader(self.client).load_all(tokens(10))
+
+        def by_parity(doc):
+            yield doc['input'] % 2, doc['input']
+
+        self.client.add_view('parity', by_parity, reduce_fun='_sum', design_doc='Test')
+        rows = self.client.view('parity', design_doc='Test', group=True).rows
+        self.assertEqual([(row.key, row.value) for row in rows], [(0, 20), (1, 25)])
+        self.assertEqual(len(self.client.view('parity', design_doc='Test', key=1, reduce=False).rows), 5)
+        with self.assertRaises(TypeError):
+            self.client.add_view('parity', 'function(doc) { emit(doc.input, 1); }')
+
+    def test_bucketed_view(self):
+        BulkLoader(self.client).load_all(tokens(50))
+        self.client.add_bucketed_view(n_buckets=4)
+        rows = self.client.view('todo_bucketed').rows
+        self.assertEqual(len(rows), 50)
+        self.assertEqual([row.key for row in rows], sorted([bucket_of(row.id, 4), row.id] for row in rows))
+        rows = self.client.view('todo_bucketed', startkey=[3]).rows
+        self.assertTrue(rows and all(row.key[0] == 3 for row in rows))
+
+        tasks = list(islice(TaskViewIterator(self.client, 'todo_bucketed', buckets=4), 20))
+        tasks += list(TaskViewIterator(self.client, 'todo_bucketed', batch_size=5, buckets=4, bucket=2))
+        self.assertEqual(len(tasks), 50)
+
+    def test_status(self):
+        BulkLoader(self.client).load_all(tokens(4))
+        tasks = list(TaskViewIterator(self.client, 'todo'))
+        tasks[0].done()
+        tasks[0]['exit_code'] = 0
+        tasks[1].done()
+        tasks[1]['exit_code'] = 1
+        self.client.save_documents(tasks[:2])
+        self.assertEqual(self.client.status(), {'todo': 0, 'locked': 2, 'done': 1, 'error': 1})
+
+    def test_find(self):
+        BulkLoader(self.client).load_all(tokens(10))
+        self.assertEqual(len(self.client.find(TODO_SELECTOR, limit=100)), 10)
+        docs = self.client.find({'input': {'$gte': 7}}, sort=[{'input': 'desc'}])
+        self.assertEqual([doc['input'] for doc in docs], [9, 8, 7])
+        tasks = list(TaskViewIterator(self.client, None, selector=TODO_SELECTOR))
+        self.assertEqual(len(tasks), 10)
+
+    def test_attachments(self):
+        doc = self.client.save(Document({'_id': 'a'}))
+        self.client.put_attachment(doc, 'out.log', io.BytesIO(b'output'))
+        doc.put_attachment('err.log', b'error')
+        self.client.save(doc)
+        self.assertTrue(self.client.get('a')['_attachments']['err.log']['stub'])
+
+        saved = self.client.get('a')
+        for name, data in [('out.log', b'output'), ('err.log', b'error')]:
+            buffer = io.BytesIO()
+            saved.stream_attachment(name, buffer, retrieve_from_database=self.client)
+            self.assertEqual(buffer.getvalue(), data)
+        self.assertEqual(saved.get_attachment('out.log', retrieve_from_database=self.client)['data'], b'output')
+
+    def test_changes(self):
+        since = self.client.update_seq()
+        self.assertEqual(self.client.wait_for_changes(since, TODO_SELECTOR, timeout=0.01)[0], False)
+        threading.Timer(0.05, lambda: self.client.save(next(tokens(1)))).start()
+        changed, since = self.client.wait_for_changes(since, TODO_SELECTOR, timeout=5)
+        self.assertTrue(changed)
+
+    def test_client_state(self):
+        self.assertEqual(self.client.missing_claim_handlers, set())
+        self.assertEqual(self.client.status_cache.ttl, 10.)
+        self.assertIsNot(self.client.copy().status_cache, self.client.status_cache)
+
+    def test_set_users(self):
+        self.client.set_users(admins=['admin'], members=['alice', 'bob'])
+        self.client.set_users(member_roles=['workers'])
+        self.assertEqual(self.client.db.security, {'admins': {'names': ['admin']},
+                                                   'members': {'names': ['alice', 'bob'], 'roles': ['workers']}})
+        self.assertEqual(self.client.copy()._get_security(), self.client.db.security)
+
+    def test_unsupported_update_handler(self):
+        self.client.save(Document({'_id': '_design/Monitor', 'updates': {'touch': 'function(doc, req) {}'}}))
+        self.client.save(next(tokens(1)))
+        with self.assertRaises(UnsupportedOperation):
+            self.client.db.update_doc('Monitor/touch', 'token_00000', {})
+        with self.assertRaises(ResourceNotFound):
+            self.client.db.update_doc('Monitor/missing', 'token_00000', {})
+
+
+class TestMemoryActors(unittest.TestCase):
+
+    def test_claim_handler(self):
+        client = MemoryCouchDB()
+        BulkLoader(client).load_all(tokens(5))
+        client.add_claim_handler()
+        tasks = list(TaskViewIterator(client, 'todo', claim_handler='Monitor'))
+        self.assertEqual(len(tasks), 5)
+        self.assertTrue(all(task.rev.startswith('2-') for task in tasks))
+        with self.assertRaises(ResourceConflict):
+            client.claim(tasks[0].id)
+
+    def test_run(self):
+        client = MemoryCouchDB()
+        BulkLoader(client, chunk_size=100).load_all(tokens(200))
+        actors = [CountingActor(client.copy(), iterator=TaskViewIterator(client, 'todo', batch_size=10))
+                  for _ in range(4)]
+        for actor in actors:
+            actor.setup_handler = lambda: None
+        threads = [threading.Thread(target=actor.run) for actor in actors]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        processed = [task_id for actor in actors for task_id in actor.processed]
+        self.assertEqual(sorted(processed), [f'token_{i:05d}' for i in range(200)])
+        self.assertEqual(client.status(), {'todo': 0, 'locked': 0, 'done': 200, 'error': 0})
+
+    def test_prefetch_batches(self):
+        """
+        Test that tasks locked by a batch claim that is in progress when the run stops are unlocked.
+        """
+        client = MemoryCouchDB()
+        BulkLoader(client).load_all(tokens(20))
+        for _ in range(5):
+            db = InstrumentedClient(client.copy(), BenchmarkStats(), latency=0.01)
+            actor = CountingActor(db, iterator=TaskViewIterator(db, 'todo', batch_size=5), prefetch=1)
+            actor.setup_handler = lambda: None
+            actor.run(max_tasks=5)
+            self.assertEqual(client.probe_view('locked'), 0)
+
+    def test_endless_iterator(self):
+        client = MemoryCouchDB()
+        iterator = EndlessViewIterator(TaskViewIterator(client, 'todo'), sleep_sec=5,
+                                       use_changes_feed=True)
+        threading.Timer(0.05, lambda: client.save(next(tokens(1)))).start()
+        self.assertEqual(next(iterator).id, 'token_00000')
@@ -1,6 +1,17 @@
+import json
 import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qsl, unquote, urlsplit
 
+from couchdb.client import Row
+from couchdb.http import ResourceNotFound
+
+from picas.clients import CouchDB
 from picas.documents import Document
+from picas.memory_clients import MemoryDatabase
+from picas.util import ViewResults
 
 
 class MockDB(object):
@@ -17,7 +28,14 @@ class MockDB(object):
 
     def get_single_from_view(self, view, **view_params):
         idx = random.choice(list(self.tasks.keys()))
-        return Document(self.tasks[idx])
+        return Document(dict(self.tasks[idx]))
+
+    def get_from_view(self, view, limit=None, **view_params):
+        return [Document(t) for t in list(self.tasks.values())[:limit]]
+
+    def view(self, view, limit=None, **view_params):
+        rows = [Row(id=idx, key=idx, value=None) for idx in self.tasks]
+        return ViewResults(rows[:limit], len(rows))
 
     def get(self, idx):
         if idx in self.saved:
@@ -41,6 +59,9 @@ class MockDB(object):
 
         return doc
 
+    def save_documents(self, docs):
+        return [self.save(doc) is not None for doc in docs]
+
     def copy(self):
         return self
 
@@ -54,3 +75,156 @@ class MockEmptyDB(MockDB):
                           for t in MockEmptyDB.TASKS)  # deep copy
         self.jobs = dict((t['_id'], t.copy()) for t in MockEmptyDB.JOBS)
         self.saved = {}
+
+
+class FakeCouchDatabase(MemoryDatabase):
+    """
+    MemoryDatabase that records the requests a CouchDB server would receive,
+    to test picas.clients.CouchDB without a server. Revisions are predictable
+    and views other than Monitor views only exist once their design
+    document is saved, like on a server.
+    """
+
+    def __init__(self, n_docs=0):
+        super().__init__()
+        self.requests = []
+        self.update([{'_id': f'token_{i:05d}', 'type': 'token', 'lock': 0, 'done': 0} for i in range(n_docs)])
+        self.requests = []
+
+    def _new_rev(self, current):
+        generation = int(current['_rev'].split('-')[0]) if current is not None else 0
+        return f'{generation + 1}-a'
+
+    def view(self, name, wrapper=None, **options):
+        self.requests.append(('view', name, options))
+        design_doc, _, view_name = name.partition('/')
+        if design_doc not in ('_all_docs', 'Monitor') and \
+                view_name not in self.docs.get('_design/' + design_doc, {}).get('views', {}):
+            raise ResourceNotFound(('not_found', 'missing_named_view'))
+        return super().view(name, wrapper, **options)
+
+    def find(self, mango, wrapper=None):
+        self.requests.append(('find', mango))
+        return super().find(mango, wrapper)
+
+    def get(self, id, default=None, **options):
+        self.requests.append(('get', id))
+        return super().get(id, default, **options)
+
+    def save(self, doc, **options):
+        self.requests.append(('save', doc.get('_id')))
+        return super().save(doc, **options)
+
+    def update(self, documents, **options):
+        documents = list(documents)
+        self.requests.append(('update', len(documents)))
+        return super().update(documents, **options)
+
+    def update_doc(self, name, docid=None, body=None, **options):
+        self.requests.append(('update_doc', name, docid))
+        return super().update_doc(name, docid, body, **options)
+
+    def put_attachment(self, doc, content, filename=None, content_type=None):
+        self.requests.append(('put_attachment', doc['_id'], filename))
+        return super().put_attachment(doc, content, filename, content_type)
+
+    def get_attachment(self, id_or_doc, filename, default=None):
+        self.requests.append(('get_attachment', id_or_doc, filename))
+        return super().get_attachment(id_or_doc, filename, default)
+
+    def changes(self, **options):
+        self.requests.append(('changes', options.get('since')))
+        return super().changes(**options)
+
+
+def fake_couchdb(n_docs=0):
+    """Create a CouchDB client that is connected to a FakeCouchDatabase."""
+    with patch('picas.clients.couchdb.Server') as server:
+        server.return_value.__getitem__.return_value = FakeCouchDatabase(n_docs)
+        client = CouchDB()
+    # there is no HTTP session to upload attachments with
+    client._attachment_database = lambda: client.db
+    return client
+
+
+class CouchDBStandInHandler(BaseHTTPRequestHandler):
+    """HTTP front-end for a FakeCouchDatabase, for clients that speak HTTP."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        db = self.server.database
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        query = {key: json.loads(value) for key, value in parse_qsl(url.query)}
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.requests.append((method, url.path))
+
+        if parts[0] != db.name:
+            return self._reply(404, {'error': 'not_found', 'reason': 'Database does not exist.'})
+        if len(parts) == 1:
+            return self._reply(200, db.info())
+        if parts[1] == '_all_docs':
+            rows = db.view('_all_docs', keys=body['keys'], include_docs=query.get('include_docs'))
+            return self._reply(200, {'total_rows': rows.total_rows, 'rows': rows})
+        if parts[1] == '_design' and parts[3] == '_view':
+            rows = db.view(parts[2] + '/' + parts[4], **query)
+            return self._reply(200, {'total_rows': rows.total_rows, 'offset': 0, 'rows': rows})
+        if parts[1] == '_bulk_docs':
+            rows = []
+            for success, _id, rev_or_exc in db.update(body['docs']):
+                if success:
+                    rows.append({'ok': True, 'id': _id, 'rev': rev_or_exc})
+                else:
+                    rows.append({'id': _id, 'error': 'conflict', 'reason': str(rev_or_exc)})
+            return self._reply(201, rows)
+        if method == 'GET':
+            doc = db.get(parts[1])
+            if doc is None:
+                return self._reply(404, {'error': 'not_found', 'reason': 'missing'})
+            return self._reply(200, doc)
+        if method == 'PUT':
+            success, _id, rev_or_exc = db.update([dict(body, _id=parts[1])])[0]
+            if not success:
+                return self._reply(409, {'error': 'conflict', 'reason': 'Document update conflict.'})
+            return self._reply(201, {'ok': True, 'id': _id, 'rev': rev_or_exc})
+        return self._reply(405, {'error': 'method_not_allowed', 'reason': method})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+
+class CouchDBStandIn(ThreadingHTTPServer):
+    """Local HTTP server that emulates a CouchDB database with a FakeCouchDatabase."""
+    daemon_threads = True
+
+    def __init__(self, n_docs=0):
+        super().__init__(('127.0.0.1', 0), CouchDBStandInHandler)
+        self.database = FakeCouchDatabase(n_docs)
+        self.requests = []
+        self.url = f'http://127.0.0.1:{self.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
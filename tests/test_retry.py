@@ -0,0 +1,132 @@
+import logging
+import unittest
+from unittest.mock import MagicMock, patch
+
+from couchdb.http import ResourceConflict
+
+from picas.actors import RunActor
+from picas.couchdblogger import CouchDBLogger
+from picas.documents import Task
+from picas.iterators import _claim_task
+from picas.retry import RetryPolicy
+from test_mock import MockDB
+
+
+class Flaky:
+    """Callable that raises the given exceptions in turn, then returns 'ok'."""
+
+    def __init__(self, *exceptions):
+        self.exceptions = list(exceptions)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.exceptions:
+            raise self.exceptions.pop(0)
+        return 'ok'
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.delays = []
+        self.policy = RetryPolicy(max_attempts=4, base_delay=0.1, max_delay=1.,
+                                  retry_on=(ResourceConflict, OSError), give_up_on=(FileNotFoundError,),
+                                  sleep=self.delays.append)
+
+    def test_retry(self):
+        func = Flaky(ResourceConflict(), OSError())
+        self.assertEqual(self.policy.call(func), 'ok')
+        self.assertEqual(func.calls, 3)
+        self.assertEqual(len(self.delays), 2)
+        self.assertTrue(all(0.1 <= delay <= 1. for delay in self.delays))
+
+    def test_max_attempts(self):
+        func = Flaky(*[ResourceConflict()] * 5)
+        with self.assertRaises(ResourceConflict):
+            self.policy.call(func)
+        self.assertEqual(func.calls, 4)
+
+    def test_classification(self):
+        for exc in (ValueError(), FileNotFoundError()):
+            func = Flaky(exc)
+            with self.assertRaises(type(exc)):
+                self.policy.call(func)
+            self.assertEqual(func.calls, 1)
+
+    def test_max_elapsed(self):
+        self.policy.max_elapsed = 0.05
+        func = Flaky(ResourceConflict(), ResourceConflict())
+        with self.assertRaises(ResourceConflict):
+            self.policy.call(func)
+        self.assertEqual(func.calls, 1)
+
+    def test_on_retry(self):
+        retries = []
+        self.policy.call(Flaky(OSError()), on_retry=lambda exc, attempt, delay: retries.append(attempt))
+        self.assertEqual(retries, [1])
+
+    def test_decorrelated_jitter(self):
+        policy = RetryPolicy(base_delay=1., max_delay=5.)
+        delays = [policy.next_delay(2.) for _ in range(100)]
+        self.assertTrue(all(1. <= delay <= 5. for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+
+class ConflictingDB(MockDB):
+    """MockDB of which the first saves conflict with other clients."""
+
+    def __init__(self, n_conflicts):
+        super().__init__()
+        self.n_conflicts = n_conflicts
+
+    def save(self, doc):
+        if self.n_conflicts:
+            self.n_conflicts -= 1
+            raise ResourceConflict()
+        return super().save(doc)
+
+
+class TestClaimRetry(unittest.TestCase):
+
+    def test_claim_backoff(self):
+        delays = []
+        policy = RetryPolicy(max_attempts=5, retry_on=(ResourceConflict,), sleep=delays.append)
+        task = _claim_task(ConflictingDB(n_conflicts=3), 'todo', retry_policy=policy)
+        self.assertTrue(task['lock'] > 0)
+        self.assertEqual(len(delays), 3)
+
+    def test_claim_gives_up(self):
+        policy = RetryPolicy(max_attempts=2, retry_on=(ResourceConflict,), sleep=lambda delay: None)
+        with self.assertRaises(EnvironmentError):
+            _claim_task(ConflictingDB(n_conflicts=3), 'todo', retry_policy=policy)
+
+
+class TestSaveRetry(unittest.TestCase):
+
+    def test_run_overwrites_conflict(self):
+        db = ConflictingDB(n_conflicts=1)
+        policy = RetryPolicy(max_attempts=3, retry_on=(ResourceConflict,), sleep=lambda delay: None)
+        actor = RunActor(db, save_retry_policy=policy)
+        actor.process_task = lambda task: task.done()
+        actor._run(Task({'_id': 'a', '_rev': '1', 'lock': 1, 'done': 0}), timeout=None)
+        self.assertTrue(db.saved['a']['done'] > 0)
+
+
+class TestLoggerRetry(unittest.TestCase):
+
+    def test_logger_gives_up_in_time(self):
+        db = MagicMock()
+        db.__setitem__.side_effect = OSError('unreachable')
+        with patch('picas.couchdblogger.Server') as server:
+            server.return_value.__getitem__.return_value = db
+            logger = CouchDBLogger('http://localhost:5984', 'logs')
+        delays = []
+        logger.retry_policy.sleep = delays.append
+        record = logging.LogRecord('picas', logging.ERROR, __file__, 1, 'message', None, None)
+        # the clock only advances while waiting between attempts
+        with patch('picas.retry.time.monotonic', side_effect=lambda: sum(delays)), patch('builtins.print'):
+            logger.emit(record)
+        # as before the retry policy, a message is given up after about 5 seconds
+        self.assertLessEqual(sum(delays), 5.)
+        self.assertEqual(db.__setitem__.call_count, len(delays) + 1)
@@ -0,0 +1,137 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from couchdb.http import ResourceConflict, ResourceNotFound
+
+from picas.actors import RunActor
+from picas.clients import TODO_SELECTOR
+from picas.documents import Document, Task
+from picas.iterators import TaskViewIterator, EndlessViewIterator
+from picas.loaders import BulkLoader
+from picas.sqlite_clients import SQLiteCouchDB
+
+
+def tokens(n):
+    for i in range(n):
+        yield Task({'_id': f'token_{i:05d}', 'type': 'token', 'input': i})
+
+
+class CountingActor(RunActor):
+
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        self.processed = []
+
+    def setup_handler(self):
+        pass
+
+    def process_task(self, task):
+        self.processed.append(task.id)
+        task['exit_code'] = 0 if task['input'] % 10 else 1
+        task.done()
+
+
+class TestSQLiteCouchDB(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.client = SQLiteCouchDB(os.path.join(self.tmpdir.name, 'tokens.db'))
+
+    def tearDown(self):
+        self.client.close()
+        self.tmpdir.cleanup()
+
+    def test_revisions(self):
+        doc = self.client.save(Document({'_id': 'a', 'value': 1}))
+        self.assertTrue(doc.rev.startswith('1-'))
+        stale = Document(dict(doc.value))
+        self.client.save(doc)
+        self.assertTrue(doc.rev.startswith('2-'))
+        with self.assertRaises(ResourceConflict):
+            self.client.save(stale)
+        self.assertEqual(self.client.save_documents([stale, Document({'_id': 'b'})]), [False, True])
+        self.assertEqual(self.client.get('a').value, doc.value)
+
+        self.client.delete(doc)
+        with self.assertRaises(ValueError):
+            self.client.get('a')
+        self.assertEqual(self.client.doc_count(), 1)
+
+    def test_views(self):
+        BulkLoader(self.client, chunk_size=10).load_all(tokens(25))
+        self.assertEqual(self.client.probe_view('todo'), 25)
+        self.assertEqual(self.client.probe_view('todo', count_selected=True, startkey='token_00010', endkey='token_00012'), 3)
+        with self.assertRaises(ValueError):
+            self.client.probe_view('todo', key='token_00010')
+        self.assertTrue(self.client.is_view_nonempty('todo', key='token_00010'))
+        self.assertEqual([row.id for row in self.client.iter_view('todo', batch_size=10)],
+                         [f'token_{i:05d}' for i in range(25)])
+        rows = self.client.view('todo', startkey='token_00010', endkey='token_00012').rows
+        self.assertEqual([row.key for row in rows], ['token_00010', 'token_00011', 'token_00012'])
+        self.assertFalse(self.client.is_view_nonempty('locked'))
+        with self.assertRaises(ResourceNotFound):
+            self.client.view('missing')
+
+        self.client.add_view('even', "type = 'token' AND json_extract(body, '$.input') % 2 = 0")
+        self.assertEqual(self.client.probe_view('even'), 13)
+
+    def test_get_from_view(self):
+        BulkLoader(self.client).load_all(tokens(25))
+        with patch.object(self.client, 'view', wraps=self.client.view) as view:
+            docs = self.client.get_from_view('todo', batch_size=10)
+        self.assertEqual([doc.id for doc in docs], [f'token_{i:05d}' for i in range(25)])
+        self.assertEqual(view.call_count, 3)
+        docs = self.client.get_from_view('todo', batch_size=10, limit=4, startkey='token_00020')
+        self.assertEqual([doc.id for doc in docs], [f'token_{i:05d}' for i in range(20, 24)])
+
+    def test_claim(self):
+        BulkLoader(self.client).load_all(tokens(5))
+        task = next(TaskViewIterator(self.client, 'todo'))
+        self.assertEqual(task.id, 'token_00000')
+        self.assertTrue(task['lock'] > 0)
+        self.assertTrue(task.rev.startswith('2-'))
+        # the claimed task can be saved with its new revision
+        self.client.save(task.done())
+
+        tasks = list(TaskViewIterator(self.client, 'todo', batch_size=3))
+        self.assertEqual(len(tasks), 4)
+        with self.assertRaises(ResourceConflict):
+            self.client.claim(tasks[0].id)
+        self.assertEqual(self.client.status(), {'todo': 0, 'locked': 4, 'done': 0, 'error': 1})
+
+    def test_claim_key_range(self):
+        BulkLoader(self.client).load_all(tokens(5))
+        tasks = self.client.claim_tasks('todo', 2, startkey='token_00002', descending=True)
+        self.assertEqual(sorted(task.id for task in tasks), ['token_00001', 'token_00002'])
+        self.assertEqual(next(TaskViewIterator(self.client, 'todo', key='token_00004')).id, 'token_00004')
+        with self.assertRaises(ValueError):
+            self.client.claim_tasks('todo', 1, skip=1)
+
+    def test_find(self):
+        BulkLoader(self.client).load_all(tokens(5))
+        self.assertEqual(len(self.client.find(TODO_SELECTOR)), 5)
+        self.assertEqual(len(list(TaskViewIterator(self.client, None, selector=TODO_SELECTOR))), 5)
+
+    def test_changes(self):
+        since = self.client.update_seq()
+        self.assertFalse(self.client.wait_for_changes(since, TODO_SELECTOR, timeout=0.01)[0])
+        threading.Timer(0.05, lambda: self.client.copy().save(next(tokens(1)))).start()
+        iterator = EndlessViewIterator(TaskViewIterator(self.client, 'todo'), sleep_sec=5,
+                                       use_changes_feed=True)
+        self.assertEqual(next(iterator).id, 'token_00000')
+
+    def test_run_concurrent(self):
+        BulkLoader(self.client, chunk_size=100).load_all(tokens(300))
+        actors = [CountingActor(self.client.copy()) for _ in range(4)]
+        threads = [threading.Thread(target=actor.run) for actor in actors]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        processed = [task_id for actor in actors for task_id in actor.processed]
+        self.assertEqual(sorted(processed), [f'token_{i:05d}' for i in range(300)])
+        self.assertEqual(self.client.status(), {'todo': 0, 'locked': 0, 'done': 270, 'error': 30})
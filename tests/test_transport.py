@@ -0,0 +1,97 @@
+import threading
+import time
+import unittest
+
+from picas.transport import BoundedConnectionPool, PooledSession
+
+
+class FakeConnection(object):
+
+    def __init__(self, host):
+        self.host = host
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(BoundedConnectionPool):
+
+    def _new_connection(self, scheme, host):
+        return FakeConnection(host)
+
+
+class TestBoundedConnectionPool(unittest.TestCase):
+
+    url = 'http://localhost:5984/test'
+
+    def test_reuse(self):
+        pool = FakePool(None)
+        conn = pool.get(self.url)
+        pool.release(self.url, conn)
+        self.assertIs(pool.get(self.url), conn)
+        self.assertIsNot(pool.get('http://otherhost:5984/test'), conn)
+
+    def test_max_age(self):
+        pool = FakePool(None, max_age=10.)
+        conn = pool.get(self.url)
+        pool.release(self.url, conn)
+        conn.picas_created -= 11.
+        new_conn = pool.get(self.url)
+        self.assertIsNot(new_conn, conn)
+        self.assertTrue(conn.closed)
+
+        # expired connections are not returned to the pool
+        new_conn.picas_created -= 11.
+        pool.release(self.url, new_conn)
+        self.assertTrue(new_conn.closed)
+
+    def test_max_connections(self):
+        pool = FakePool(None, max_connections=2)
+        conns = [pool.get(self.url) for _ in range(3)]
+        for conn in conns:
+            pool.release(self.url, conn)
+        self.assertEqual([conn.closed for conn in conns], [False, False, True])
+
+    def test_clear(self):
+        pool = FakePool(None)
+        conn = pool.get(self.url)
+        pool.release(self.url, conn)
+        pool.clear()
+        self.assertTrue(conn.closed)
+        self.assertIsNot(pool.get(self.url), conn)
+
+    def test_threads(self):
+        pool = FakePool(None, max_connections=4)
+        in_use = set()
+        errors = []
+
+        def worker():
+            for _ in range(200):
+                conn = pool.get(self.url)
+                if conn in in_use:
+                    errors.append(conn)
+                in_use.add(conn)
+                time.sleep(0)
+                in_use.discard(conn)
+                pool.release(self.url, conn)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(pool.conns[('http', 'localhost:5984')]), 4)
+
+
+class TestPooledSession(unittest.TestCase):
+
+    def test_pool(self):
+        session = PooledSession(max_connections=3, max_age=60.)
+        self.assertIsInstance(session.connection_pool, BoundedConnectionPool)
+        session.disable_ssl_verification()
+        self.assertTrue(session.connection_pool.disable_ssl_verification)
+        self.assertEqual(session.connection_pool.max_connections, 3)
+        self.assertEqual(session.connection_pool.max_age, 60.)
@@ -1,6 +1,8 @@
+import os
+import tempfile
 import unittest
 
-from picas.util import merge_dicts, Timer
+from picas.util import merge_dicts, Timer, TTLCache
 import time
 
 
@@ -42,3 +44,32 @@ class TestTimer(unittest.TestCase):
         self.assertTrue(timer.elapsed() < 0.4)
         timer.reset()
         self.assertTrue(timer.elapsed() < 0.2)
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_expire(self):
+        cache = TTLCache(ttl=0.2)
+        cache.put('a', 3)
+        self.assertEqual(cache.get('a'), 3)
+        time.sleep(0.3)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 0), 0)
+
+    def test_persist(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.json')
+            TTLCache(ttl=10, path=path).put('a', {'todo': 1})
+            self.assertEqual(TTLCache(ttl=10, path=path).get('a'), {'todo': 1})
+            self.assertIsNone(TTLCache(ttl=10, path=path).get('b'))
+            self.assertEqual(os.listdir(tmpdir), ['cache.json'])
+
+    def test_corrupt_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.json')
+            with open(path, 'w') as fobj:
+                fobj.write('{')
+            cache = TTLCache(ttl=10, path=path)
+            self.assertIsNone(cache.get('a'))
+            cache.put('a', 1)
+            self.assertEqual(cache.get('a'), 1)